@@ -27,6 +27,19 @@ from copy import deepcopy
 import logging
 import struct
 import re
+import bisect
+import collections
+import hashlib
+import shelve
+import functools
+import threading
+import types
+
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    asyncio = None  # Python 2, async APIs are unavailable
 
 IDADIR = idc.idadir()
 PAGESIZE = 0x1000
@@ -36,15 +49,569 @@ ARMTHUMBNOP = "\x00\xbf"
 ARMNOP = "\x00\xf0\x20\xe3"
 ARM64NOP = "\x1f\x20\x03\xd5"
 MAX_ALLOC_SIZE = 10 * 1024 * 1024
+CACHE_PTR_BYTES = 0x1000
+# characters the string harvester considers printable
+HARVEST_CHARS = "[\\x20-\\x7e\\t\\r\\n]"
 
 try:
     long        # Python 2
 except NameError:
     long = int  # Python 3
 
+# register tables keyed by (arch, mode, filetype), built by the first EmuHelper for an architecture and shared by the
+# rest. each EmuHelper gets its own copy of regs so that changes made through one cannot leak into the others
+ARCH_TABLES = {}
+
+# EmuHelper.API_HOOKS resolved to the unbound methods of each EmuHelper class, keyed by the class
+API_HOOK_TABLES = {}
+
+# EmuHelper attributes that describe the state of an emulator and its memory, handed over with it by the engine pool
+ENGINE_STATE = ["uc", "cleanContext", "baseAddr", "binaryEnd", "binaryRegions", "binaryRegionStarts", "addrSpace",
+                "stack", "stackReserve", "stackCommitted", "sentinel", "lazySegStarts", "lazySegEnds", "lazyPages",
+                "imageFile", "thumbRangeStarts", "thumbRangeValues", "deferredSegPages"]
+
+# register snapshot returned by EmuHelper.getEmuState, values are accessed by register name and are only formatted
+# when the snapshot is converted to a string
+class EmuState(dict):
+    def __init__(self, regVals, layout, width):
+        dict.__init__(self, regVals)
+        self.layout = layout
+        self.width = width
+
+    def __str__(self):
+        fmt = "%%s: %%0%dX" % self.width
+        return "".join("\t".join(fmt % (name, self[name]) for name in line) + "\n" for line in self.layout)
+
+
+# least recently used cache of emulateRange results with an optional on-disk tier. entries map a digest of the
+# emulation inputs to the declared outputs of the run
+class EmuResultCache(object):
+    def __init__(self, maxEntries=4096, path=None):
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.shelf = None
+        if path is not None:
+            self.shelf = shelve.open(path)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            entry = self.entries.pop(key)
+        elif self.shelf is not None and key in self.shelf:
+            entry = self.shelf[key]
+        else:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = entry
+        self._evict()
+        return entry
+
+    def put(self, key, entry):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        self._evict()
+        if self.shelf is not None:
+            self.shelf[key] = entry
+
+    def clear(self):
+        self.entries.clear()
+        if self.shelf is not None:
+            self.shelf.clear()
+
+    def _evict(self):
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def close(self):
+        if self.shelf is not None:
+            self.shelf.close()
+            self.shelf = None
+
+
+# tracks which ranges of the emulator's address space are used by the binary, the stack, allocations and memory
+# mapped on faults, and which are free. used ranges are indexed by address and free gaps are additionally kept sorted
+# by size, so the best fitting gap for an allocation is found with a binary search instead of scanning every mapped
+# region. all ranges are page aligned with exclusive ends
+class EmuAddressSpace(object):
+    def __init__(self, end, minAddr=0x10000):
+        # allocations are not placed below minAddr to avoid collisions with null pointer dereferences
+        self.minAddr = minAddr
+        self.usedStarts = []
+        self.used = {}
+        self.gapStarts = []
+        self.gapEnds = {}
+        self.gapsBySize = []
+        self._addGap(0, end)
+
+    def _addGap(self, start, end):
+        bisect.insort(self.gapStarts, start)
+        self.gapEnds[start] = end
+        bisect.insort(self.gapsBySize, (end - start, start))
+
+    def _removeGap(self, start):
+        end = self.gapEnds.pop(start)
+        del self.gapStarts[bisect.bisect_left(self.gapStarts, start)]
+        del self.gapsBySize[bisect.bisect_left(self.gapsBySize, (end - start, start))]
+        return end
+
+    # returns the (start, end) of the free gap containing addr, or None if addr is in use
+    def getGap(self, addr):
+        i = bisect.bisect_right(self.gapStarts, addr) - 1
+        if i >= 0 and addr < self.gapEnds[self.gapStarts[i]]:
+            return (self.gapStarts[i], self.gapEnds[self.gapStarts[i]])
+        return None
+
+    # returns the (start, end, kind) of the used range containing addr, or None if addr is free
+    def getUsed(self, addr):
+        i = bisect.bisect_right(self.usedStarts, addr) - 1
+        if i >= 0 and addr < self.used[self.usedStarts[i]][0]:
+            start = self.usedStarts[i]
+            return (start, self.used[start][0], self.used[start][1])
+        return None
+
+    def isFree(self, start, end):
+        gap = self.getGap(start)
+        return gap is not None and end <= gap[1]
+
+    # returns the start of the smallest free gap that fits size bytes with an unused guard page on either side
+    def findFree(self, size):
+        i = bisect.bisect_left(self.gapsBySize, (size + 2 * PAGESIZE, 0))
+        for gapSize, gapStart in self.gapsBySize[i:]:
+            start = max(gapStart, self.minAddr) + PAGESIZE
+            if start + size + PAGESIZE <= gapStart + gapSize:
+                return start
+        return None
+
+    # marks start..end as used, removing it from any free gaps it overlaps. raises ValueError if part of it is
+    # already in use
+    def reserve(self, start, end, kind):
+        j = bisect.bisect_left(self.usedStarts, end) - 1
+        if j >= 0 and self.used[self.usedStarts[j]][0] > start:
+            raise ValueError("range %x-%x overlaps used range @%x" % (start, end, self.usedStarts[j]))
+        i = max(bisect.bisect_right(self.gapStarts, start) - 1, 0)
+        while i < len(self.gapStarts) and self.gapStarts[i] < end:
+            gapStart = self.gapStarts[i]
+            gapEnd = self.gapEnds[gapStart]
+            if gapEnd <= start:
+                i += 1
+                continue
+            self._removeGap(gapStart)
+            if gapStart < start:
+                self._addGap(gapStart, start)
+                i += 1
+            if end < gapEnd:
+                self._addGap(end, gapEnd)
+                break
+        bisect.insort(self.usedStarts, start)
+        self.used[start] = (end, kind)
+
+    # marks the free parts of start..end as used, leaving the parts that are already in use as they are
+    def reserveFree(self, start, end, kind):
+        gaps = []
+        i = max(bisect.bisect_right(self.gapStarts, start) - 1, 0)
+        while i < len(self.gapStarts) and self.gapStarts[i] < end:
+            gapEnd = self.gapEnds[self.gapStarts[i]]
+            if gapEnd > start:
+                gaps.append((max(self.gapStarts[i], start), min(gapEnd, end)))
+            i += 1
+        for gapStart, gapEnd in gaps:
+            self.reserve(gapStart, gapEnd, kind)
+
+    # returns the used range starting at start to the free gaps, merging it with adjacent gaps
+    def release(self, start):
+        end = self.used.pop(start)[0]
+        del self.usedStarts[bisect.bisect_left(self.usedStarts, start)]
+        prev = self.getGap(start - 1) if start > 0 else None
+        if prev is not None:
+            self._removeGap(prev[0])
+            start = prev[0]
+        if end in self.gapEnds:
+            end = self._removeGap(end)
+        self._addGap(start, end)
+
+
+# forwards IDB change notifications to an EmuHelper so that its emulator memory and caches follow patches, code and
+# function changes and segment changes made in IDA after the binary was loaded. IDB_Hooks callbacks must return 0
+class EmuIDBHooks(idaapi.IDB_Hooks):
+    def __init__(self, eh):
+        idaapi.IDB_Hooks.__init__(self)
+        self.eh = eh
+
+    def byte_patched(self, ea, *args):
+        self.eh._syncPatchedByte(ea)
+        # pooled emulators were loaded before the change
+        ENGINE_POOL.clear()
+        return 0
+
+    def func_added(self, pfn, *args):
+        self.eh._invalidateFunc(pfn.start_ea)
+        return 0
+
+    def func_updated(self, pfn, *args):
+        self.eh._invalidateFunc(pfn.start_ea)
+        return 0
+
+    def set_func_start(self, pfn, newStart, *args):
+        self.eh._invalidateFunc(pfn.start_ea)
+        self.eh._invalidateFunc(newStart)
+        return 0
+
+    def set_func_end(self, pfn, *args):
+        self.eh._invalidateFunc(pfn.start_ea)
+        return 0
+
+    def deleting_func(self, pfn, *args):
+        self.eh._invalidateFunc(pfn.start_ea)
+        return 0
+
+    def func_tail_appended(self, pfn, *args):
+        self.eh._invalidateFunc(pfn.start_ea)
+        return 0
+
+    def func_tail_deleted(self, pfn, *args):
+        self.eh._invalidateFunc(pfn.start_ea)
+        return 0
+
+    def make_code(self, insn, *args):
+        self.eh._invalidateCode(insn.ea)
+        return 0
+
+    def make_data(self, ea, *args):
+        self.eh._invalidateCode(ea)
+        return 0
+
+    def destroyed_items(self, ea1, ea2, *args):
+        self.eh._invalidateCode(ea1, ea2)
+        return 0
+
+    def renamed(self, ea, newName, localName, *args):
+        # api hooks are looked up by name, so cached results may no longer apply if a hooked name was involved. the
+        # old name is only passed by newer IDA versions, without it any rename is assumed to matter
+        oldName = args[0] if args else None
+        if oldName is None or self.eh._isApiHookName(oldName) or self.eh._isApiHookName(newName):
+            self.eh._invalidateResultCache()
+        return 0
+
+    def sgr_changed(self, *args):
+        self.eh._invalidateThumbMap()
+        ENGINE_POOL.clear()
+        return 0
+
+    def segm_added(self, s, *args):
+        self.eh._addBinarySegment(s.start_ea, s.end_ea)
+        ENGINE_POOL.clear()
+        return 0
+
+    def segm_deleted(self, startEA, endEA, *args):
+        self.eh._removeBinarySegment(startEA, endEA)
+        ENGINE_POOL.clear()
+        return 0
+
+
+# process wide pool of emulators released by pooled EmuHelpers. emulators are kept with their ENGINE_STATE, loaded and
+# restored to a clean state, keyed by (arch, mode, input file MD5, lazyLoad, imagePath, maxStackSize)
+class EmuEnginePool(object):
+    def __init__(self):
+        self.engines = collections.defaultdict(list)
+
+    def checkout(self, key):
+        if self.engines[key]:
+            return self.engines[key].pop()
+        return None
+
+    def checkin(self, key, engine):
+        self.engines[key].append(engine)
+
+    # drops all pooled emulators, e.g. after the IDB was changed
+    def clear(self):
+        self.engines.clear()
+
+
+ENGINE_POOL = EmuEnginePool()
+
+
+# the IDA API modules as imported. while async jobs run, the module names refer to _IdaModule wrappers instead
+IDA_MODULES = {"idc": idc, "idaapi": idaapi, "idautils": idautils}
+
+# holds the event loop of the async job the current thread is a worker for, if any
+_asyncThread = threading.local()
+_asyncJobsLock = threading.Lock()
+_asyncJobsRunning = 0
+
+
+# calls func on the thread running the event loop of the async job the current thread works for, which must be IDA's
+# main thread, and returns its result. generators are consumed there too. on any other thread func is called
+# directly. use it for IDA API calls made by your own hooks and callbacks during emulateRangeAsync and iterateAsync
+def callOnMainThread(func, *args, **kwargs):
+    loop = getattr(_asyncThread, "loop", None)
+    if loop is None:
+        return func(*args, **kwargs)
+    done = concurrent.futures.Future()
+
+    def run():
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            done.set_result(result)
+        except Exception as e:
+            done.set_exception(e)
+
+    loop.call_soon_threadsafe(run)
+    return done.result()
+
+
+# stands in for an IDA API module while async jobs run, so that the IDA calls flare-emu makes from a worker thread are
+# made on the main thread through callOnMainThread. calls made on other threads go straight to the module
+class _IdaModule(object):
+    def __init__(self, idaModule):
+        self.idaModule = idaModule
+
+    def __getattr__(self, name):
+        attr = getattr(self.idaModule, name)
+        if callable(attr) and getattr(_asyncThread, "loop", None) is not None:
+            return functools.partial(callOnMainThread, attr)
+        return attr
+
+
+# marks the current thread as the worker of an async job for loop. the IDA API modules are only wrapped while a job
+# runs, so that synchronous emulation does not pay for the indirection
+def _enterAsyncJob(loop):
+    global _asyncJobsRunning
+    _asyncThread.loop = loop
+    with _asyncJobsLock:
+        _asyncJobsRunning += 1
+        if _asyncJobsRunning == 1:
+            globals().update((name, _IdaModule(module)) for name, module in IDA_MODULES.items())
+
+
+def _exitAsyncJob():
+    global _asyncJobsRunning
+    with _asyncJobsLock:
+        _asyncJobsRunning -= 1
+        if _asyncJobsRunning == 0:
+            globals().update(IDA_MODULES)
+    _asyncThread.loop = None
+
+
+# tracks an emulation run started by one of EmuHelper's async APIs
+class _AsyncJob(object):
+    def __init__(self):
+        self.cancelled = False
+        self.future = None
+
+
+# asynchronous iterator returned by EmuHelper.iterateAsync. results are pushed from the emulation thread through the
+# event loop and handed to the consumer as they arrive
+class EmuAsyncIterator(object):
+    def __init__(self, eh, loop):
+        self.eh = eh
+        self.loop = loop
+        self.results = collections.deque()
+        self.waiter = None
+        self.job = None
+        self.done = False
+        self.error = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        fut = self.loop.create_future()
+        if len(self.results) > 0:
+            fut.set_result(self.results.popleft())
+        elif self.done:
+            fut.set_exception(self.error or StopAsyncIteration())
+        else:
+            self.waiter = fut
+            fut.add_done_callback(self._waiterDone)
+        return fut
+
+    # stops emulation, results that were already produced can still be consumed
+    def cancel(self):
+        if self.job is not None:
+            self.job.cancel()
+
+    def _start(self, fut):
+        self.job = fut
+        fut.add_done_callback(self._finish)
+
+    def _push(self, result):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(result)
+            self.waiter = None
+        else:
+            self.results.append(result)
+
+    def _finish(self, fut):
+        self.done = True
+        if not fut.cancelled() and fut.exception() is not None:
+            self.error = fut.exception()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(self.error or StopAsyncIteration())
+            self.waiter = None
+
+    def _waiterDone(self, fut):
+        if fut.cancelled():
+            self.cancel()
+
+
 class EmuHelper():
-    def __init__(self, verbose = 0):
+    # API hooks by the normalized name of the function they emulate, as the name of the EmuHelper method that
+    # implements them. each EmuHelper starts with a copy of these in its own apiHooks dict, which can be changed per
+    # EmuHelper
+    API_HOOKS = {
+        "GetProcessHeap": "_returnHandleHook",
+        "HeapCreate": "_returnHandleHook",
+        "HeapAlloc": "_allocMem3Hook",
+        "HeapReAlloc": "_heapReAllocHook",
+        "RtlAllocateHeap": "_allocMem3Hook",
+        "AllocateHeap": "_allocMem1Hook",
+
+        # ignore LMEM_MOVEABLE flag, return mem ptr anyway, have Lock return ptr param
+        "LocalAlloc": "_allocMem2Hook",
+        "LocalLock": "_returnParam1Hook",
+        "GlobalAlloc": "_allocMem2Hook",
+        "GlobalLock": "_returnParam1Hook",
+
+        # these ignore flags for now
+        "LocalReAlloc": "_reallocHook",
+        "GlobalReAlloc": "_reallocHook",
+
+        "VirtualAlloc": "_virtualAllocHook",
+        "VirtualAllocEx": "_virtualAllocExHook",
+        "malloc": "_allocMem1Hook",
+
+        # release allocations so their address ranges can be reused
+        "HeapFree": "_heapFreeHook",
+        "RtlFreeHeap": "_heapFreeHook",
+        "LocalFree": "_localFreeHook",
+        "GlobalFree": "_localFreeHook",
+        "VirtualFree": "_virtualFreeHook",
+        "free": "_freeHook",
+        "calloc": "_callocHook",
+        "realloc": "_reallocHook",
+        "memcpy": "_memcpyHook",
+        "memmove": "_memcpyHook",
+        "strlen": "_strlenHook",
+        "lstrlenA": "_strlenHook",
+        "strnlen": "_strnlenHook",
+        "strnlen_s": "_strnlenHook",
+        "strcmp": "_strcmpHook",
+        "lstrcmpA": "_strcmpHook",
+        "strncmp": "_strncmpHook",
+        "stricmp": "_stricmpHook",
+        "lstrcmpiA": "_stricmpHook",
+        "strnicmp": "_strnicmpHook",
+        "wcscmp": "_wcscmpHook",
+        "lstrcmpW": "_wcscmpHook",
+        "wcsncmp": "_wcsncmpHook",
+        "wcsicmp": "_wcsicmpHook",
+        "lstrcmpiW": "_wcsicmpHook",
+        "wcsnicmp": "_wcsnicmpHook",
+        "mbscmp": "_strcmpHook",
+        "mbsncmp": "_strncmpHook",
+        "mbsicmp": "_stricmpHook",
+        "mbsnicmp": "_strnicmpHook",
+        "strcpy": "_strcpyHook",
+        "strncpy": "_strncpyHook",
+        "lstrcpyA": "_strcpyHook",
+        "lstrcpynA": "_strncpyHook",
+        "strncpy_s": "_strncpysHook",
+        "wcscpy": "_wcscpyHook",
+        "wcsncpy": "_wcsncpyHook",
+        "lstrcpyW": "_wcscpyHook",
+        "lstrcpynW": "_wcsncpyHook",
+        "wcsncpy_s": "_wcsncpysHook",
+        "mbscpy": "_strcpyHook",
+        "mbsncpy": "_strncpyHook",
+        "mbsncpy_s": "_strncpysHook",
+        "memchr": "_memchrHook",
+        "strchr": "_strchrHook",
+        "wcschr": "_wcschrHook",
+        "mbschr": "_strchrHook",
+        "strrchr": "_strrchrHook",
+        "wcsrchr": "_wcsrchrHook",
+        "mbsrchr": "_strrchrHook",
+        "wcslen": "_wcslenHook",
+        "lstrlenW": "_wcslenHook",
+        "mbslen": "_strlenHook",
+        "mbstrlen": "_strlenHook",
+        "wcsnlen": "_wcsnlenHook",
+        "wcsnlen_s": "_wcsnlenHook",
+        "mbsnlen": "_strnlenHook",
+        "mbstrnlen": "_strnlenHook",
+        "strcat": "_strcatHook",
+        "lstrcatA": "_strcatHook",
+        "strncat": "_strncatHook",
+        "wcscat": "_wcscatHook",
+        "lstrcatW": "_wcscatHook",
+        "wcsncat": "_wcsncatHook",
+        "mbscat": "_strcatHook",
+        "mbsncat": "_strncatHook",
+        "strlwr": "_strlwrHook",
+        "strupr": "_struprHook",
+        "wcslwr": "_wcslwrHook",
+        "wcsupr": "_wcsuprHook",
+        "mbslwr": "_strlwrHook",
+        "mbsupr": "_struprHook",
+        "strdup": "_strdupHook",
+        "wcsdup": "_wcsdupHook",
+        "mbsdup": "_strdupHook",
+        "mbtowc": "_mbtowcHook",
+        "mbstowcs": "_mbstowcsHook",
+        "wctomb": "_wctombHook",
+        "wcstombs": "_wcstombsHook",
+        "MultiByteToWideChar": "_multiByteToWideCharHook",
+        "WideCharToMultiByte": "_wideCharToMultiByteHook",
+        "memset": "_memsetHook",
+        "ZeroMemory": "_bzeroHook",
+        "bzero": "_bzeroHook",
+
+        # builtins
+        "umodsi3": "_modHook"
+    }
+
+    # lazyLoad: if True, binary segments are not mapped up front. each page is
+    #     loaded from the IDB, or from imagePath if provided, the first time it
+    #     is accessed, so startup time does not depend on the size of the
+    #     binary and memory use is proportional to the pages actually used
+    # imagePath: file produced by exportBinaryImage to load pages from instead
+    #     of the IDB in lazyLoad mode
+    # maxStackSize: size of the address range reserved for the emulated stack
+    #     to grow into. stack pages are mapped as they are first used, if
+    #     emulation runs past this limit it is stopped and stopReason is set
+    #     to "stack overflow"
+    # pooled: if True, takes a loaded emulator from ENGINE_POOL when one was
+    #     released for the same binary and settings, instead of creating one
+    #     and loading the binary. call release when done with the EmuHelper
+    #     to return its emulator to the pool
+    def __init__(self, verbose = 0, lazyLoad=False, imagePath=None, maxStackSize=0x100000, pooled=False):
         self.verbose = verbose
+        self.pooled = pooled
+        self.engineKey = None
+        self.engineReused = False
+        self.maxStackSize = maxStackSize
+        self.stackReserve = None
+        self.stackCommitted = 0
+        self.stackGuardMapped = False
+        self.stopReason = None
+        self.memFaultPolicy = {"read": "map", "write": "map", "fetch": "map", "chunkSize": 0x10000,
+                               "maxAutoMapped": 0x4000000}
+        self.memFaultRanges = []
+        self.memFaults = collections.defaultdict(int)
+        self.autoMappedBytes = 0
+        self.lazyLoad = lazyLoad
+        self.imagePath = imagePath
+        self.imageFile = None
+        self.lazySegStarts = []
+        self.lazySegEnds = []
+        self.lazyPages = set()
+        # sorted starts and inclusive ends of the contiguous runs of mapped memory, built by getEmuMemExtent
+        self.memExtentStarts = None
+        self.memExtentEnds = None
         self.stack = 0
         self.stackSize = 0x2000
         self.size_DWORD = 4
@@ -59,9 +626,54 @@ class EmuHelper():
         self.h_codehook = None
         self.h_memhook = None
         self.h_inthook = None
+        self.h_sitehooks = []
+        self.instructionHooks = []
+        self.hookSeq = 0
+        self.h_filteredhooks = []
+        self.memAccessHooks = []
+        self.h_memaccesshooks = []
+        self.h_regmemaccesshooks = []
+        self.h_snapshothook = None
+        self.watchLogs = {}
+        # incremented each time the emulator context is reset for a run, including each iterate path
+        self.runCount = 0
+        self.traceRing = None
+        self.traceHook = None
+        self.traceRegs = []
+        self.traceRegIds = []
+        self.traceLast = None
+        self.harvestHook = None
+        self.harvestMinLength = 0
+        self.harvestWrites = {}
+        self.harvestedStrings = []
+        # True while unicorn is running, i.e. while hooks are being called
+        self.emulating = False
+        self.sentinel = None
+        self.thumbRangeStarts = None
+        self.thumbRangeValues = None
+        self.canonicalRegs = []
+        self.cleanContext = None
+        self.asyncExecutor = None
+        self.asyncJob = None
+        self.h_binarywritehooks = []
+        self.binaryRegions = []
+        self.binaryRegionStarts = []
+        # pages of segments added to the IDB that were already in use by the stack or heap, left out of binaryRegions
+        # until the next reloadBinary
+        self.deferredSegPages = set()
+        self.addrSpace = None
+        self.pristinePages = {}
+        self.resultCache = None
+        self.resultCacheStale = False
+        self.idbHooks = None
+        self.pathSnapshots = []
         self.enteredBlock = False
         self.initEmuHelper()
-        self.reloadBinary()
+        if not self.engineReused:
+            self.reloadBinary()
+        if self.pooled:
+            # lets release undo this EmuHelper's writes to the binary
+            self.trackBinaryWrites()
 
     # startAddr: address to start emulation
     # endAddr: address to end emulation, this instruction is not executed. 
@@ -91,43 +703,113 @@ class EmuHelper():
     # returns the emulation object in its state after the emulation completes
     # count: Value passed to unicorn's uc_emu_start to indicate max number of
     #     instructions to emulate, Defaults to 0 (all code available).
+    # fastMode: for leaf functions or when skipCalls is True, plants a sentinel
+    #     return address and uses native unicorn exits instead of inspecting
+    #     every instruction from Python. only call sites and indirect branches
+    #     are hooked, verbose instruction logging and interrupt patching are
+    #     not available in this mode. defaults to False
+    # cacheOutputs: when a result cache is enabled with enableResultCache,
+    #     a list of the outputs to cache for this run. each entry is a
+    #     register name, whose value is recorded after emulation, or a
+    #     (pointer, size) tuple, where pointer is an address or a key of
+    #     registers and size is a byte count or None for a null-terminated
+    #     string. the return value is always cached. if a previous run had the
+    #     same inputs, emulation is skipped and the outputs are written back
+    #     to the emulator instead, hooks are not called in that case
     def emulateRange(self, startAddr, endAddr=None, registers=None, stack=None, instructionHook=None, callHook=None,
-                     memAccessHook=None, hookData=None, skipCalls=True, hookApis=True, count=0):
+                     memAccessHook=None, hookData=None, skipCalls=True, hookApis=True, count=0, fastMode=False,
+                     cacheOutputs=None):
         if registers is None:
             registers = {}
         if stack is None:
             stack = []
+        if self.resultCache is not None and cacheOutputs is not None:
+            if self.resultCacheStale:
+                self.resultCache.clear()
+                self.resultCacheStale = False
+            key = self._getResultCacheKey(startAddr, endAddr, registers, stack, cacheOutputs,
+                                          (skipCalls, hookApis, count, fastMode))
+            entry = self.resultCache.get(key)
+            strRegs = [reg for reg in registers if isinstance(registers[reg], str)]
+            strArgs = [i for i in range(len(stack)) if isinstance(stack[i], str)]
+            self._prepEmuContext(registers, stack)
+            self.resetEmuHooks()
+            ptrs = self._getCacheOutputPtrs(registers, cacheOutputs)
+            if entry is not None:
+                logging.debug("result cache hit for %s" % self.hexString(startAddr))
+                self._applyCachedOutputs(entry, ptrs)
+                # nothing reads the buffers _prepEmuContext allocated for string arguments unless they are outputs
+                for buf in [registers[reg] for reg in strRegs] + [stack[i] for i in strArgs]:
+                    if buf not in ptrs:
+                        self.freeEmuMem(buf)
+                return self.uc
+            self._emulateRange(startAddr, endAddr, registers, stack, instructionHook, callHook, memAccessHook,
+                               hookData, skipCalls, hookApis, count, fastMode)
+            self.resultCache.put(key, self._getCachedOutputs(ptrs, cacheOutputs))
+            return self.uc
+        self._prepEmuContext(registers, stack)
+        self.resetEmuHooks()
+        return self._emulateRange(startAddr, endAddr, registers, stack, instructionHook, callHook, memAccessHook,
+                                  hookData, skipCalls, hookApis, count, fastMode)
+
+    # runs emulateRange on an already prepared emulator context
+    def _emulateRange(self, startAddr, endAddr, registers, stack, instructionHook, callHook, memAccessHook,
+                      hookData, skipCalls, hookApis, count, fastMode):
         userData = {"EmuHelper": self, "funcStart": idc.get_func_attr(startAddr, idc.FUNCATTR_START),
                     "funcEnd": idc.get_func_attr(startAddr, idc.FUNCATTR_END), "skipCalls": skipCalls,
                     "endAddr": endAddr, "func_t": idaapi.get_func(startAddr), "callHook": callHook, "hookApis": hookApis, "count": count}
         if hookData:
             userData.update(hookData)
         mu = self.uc
-        self._prepEmuContext(registers, stack)
-        self.resetEmuHooks()
-        self.h_codehook = mu.hook_add(
-            unicorn.UC_HOOK_CODE, self._emulateRangeCodeHook, userData)
-        if instructionHook:
-            self.h_userhook = mu.hook_add(unicorn.UC_HOOK_CODE, instructionHook, userData)
-        if memAccessHook:
-            self.h_memaccesshook = self.uc.hook_add(unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE, memAccessHook,
-                                                    userData)
+        if fastMode:
+            sites, hasCalls = self._getFastModeSites(userData["funcStart"])
+            if hasCalls and skipCalls is False:
+                logging.debug("fastMode requires a leaf function or skipCalls, using instruction hooks instead")
+                fastMode = False
+        if fastMode:
+            return self._emulateRangeFast(startAddr, sites, instructionHook, memAccessHook, userData)
+        self._installCodeHook(self._emulateRangeCodeHook, instructionHook, userData)
+        self._installMemAccessHooks(memAccessHook, userData)
         self.h_memhook = mu.hook_add(unicorn.UC_HOOK_MEM_READ_UNMAPPED | unicorn.UC_HOOK_MEM_WRITE_UNMAPPED |
                                      unicorn.UC_HOOK_MEM_FETCH_UNMAPPED, self._hookMemInvalid, userData)
         self.h_inthook = mu.hook_add(
             unicorn.UC_HOOK_INTR, self._hookInterrupt, userData)
-        if self.arch == unicorn.UC_ARCH_ARM:
-            userData["changeThumbMode"] = True
-        mu.emu_start(startAddr, userData["funcEnd"], count=count)
+        self._emuStart(self._getModePC(startAddr), userData["funcEnd"], count)
         return mu
         
     # call emulateRange using selected instructions in IDA Pro as start/end addresses
     def emulateSelection(self, registers=None, stack=None, instructionHook=None, callHook=None,
-                     memAccessHook=None, hookData=None, skipCalls=True, hookApis=True, count=0):
+                     memAccessHook=None, hookData=None, skipCalls=True, hookApis=True, count=0, fastMode=False):
         selection = idaapi.read_selection()
         if selection[0]:
             self.emulateRange(selection[1], selection[2], registers, stack, instructionHook, 
-                              callHook, memAccessHook, hookData, skipCalls, hookApis, count=count)
+                              callHook, memAccessHook, hookData, skipCalls, hookApis, count=count, fastMode=fastMode)
+
+    # emulateRange without a per-instruction hook. the return address is replaced with a sentinel address that is a
+    # native exit, and _emulateRangeCodeHook is only attached to the addresses in sites
+    def _emulateRangeFast(self, startAddr, sites, instructionHook, memAccessHook, userData):
+        mu = self.uc
+        if self.arch == unicorn.UC_ARCH_X86:
+            self.writeEmuPtr(self.getRegVal("sp"), self.sentinel)
+        else:
+            mu.reg_write(self.regs["LR"], self.sentinel)
+        for site in sites:
+            self.h_sitehooks.append(mu.hook_add(unicorn.UC_HOOK_CODE, self._fastSiteHook, userData, site, site))
+        # returning to the sentinel stops emulation even when an endAddr was specified
+        self.h_sitehooks.append(mu.hook_add(unicorn.UC_HOOK_CODE, self._fastSentinelHook, userData,
+                                            self.sentinel, self.sentinel))
+        self._installCodeHook(None, instructionHook, userData)
+        self._installMemAccessHooks(memAccessHook, userData)
+        self.h_memhook = mu.hook_add(unicorn.UC_HOOK_MEM_READ_UNMAPPED | unicorn.UC_HOOK_MEM_WRITE_UNMAPPED |
+                                     unicorn.UC_HOOK_MEM_FETCH_UNMAPPED, self._fastHookMemInvalid, userData)
+        self.h_inthook = mu.hook_add(
+            unicorn.UC_HOOK_INTR, self._fastHookInterrupt, userData)
+        startAddr = self._getModePC(startAddr)
+        if userData["endAddr"] is not None:
+            self._emuStart(startAddr, userData["endAddr"], userData["count"])
+        else:
+            self._emuStart(startAddr, self.sentinel, userData["count"])
+        return mu
 
     # target: finds first path through function to target using depth first
     #     search for each address in list, if a single address is specified,
@@ -139,24 +821,32 @@ class EmuHelper():
     # hookData: user-defined data to be made available in instruction hook
     #     function, care must be taken to not use key names already used by
     #     flare_emu in userData dictionary
-    # preEmuCallback: a callback that is called BEFORE each emulation run
+    # preEmuCallback: a callback that is called BEFORE each emulation run that starts at the beginning of a
+    #     function. with sharePrefixes, paths that resume from a shared prefix are not preceded by it
     # callHook: a callback that is called whenever the emulator encounters a
     #     "call" instruction. hook or no, after a call instruction, the
     #     program counter is advanced to the next instruction and the stack is
     #     automatically cleaned up
     # resetEmuMem: if set to True, unmaps all allocated emulator memory and
     #     reloads the binary from the IDB into emulator memory before each
-    #     emulation run. can significantly increase script run time, defaults
-    #     to False
+    #     emulation run that starts at the beginning of a function. can
+    #     significantly increase script run time, defaults to False
     # hookApis: set to False if you don't want flare-emu to emulate common 
     # runtime memory and string functions, defaults to True
     # memAccessHook: hook function that runs when the emulator encounters a
     #     memory read or write
+    # sharePrefixes: if set to True, paths that share leading basic blocks with
+    #     the path emulated before them resume from the engine state saved at
+    #     the end of those blocks instead of starting from the beginning of the
+    #     function. preEmuCallback and resetEmuMem only run before paths that
+    #     start from the beginning, so their effects on the shared blocks carry
+    #     over to the resumed paths. defaults to False
     def iterate(self, target, targetCallback, preEmuCallback=None, callHook=None, instructionHook=None,
-                hookData=None, resetEmuMem=False, hookApis=True, memAccessHook=None):
+                hookData=None, resetEmuMem=False, hookApis=True, memAccessHook=None, sharePrefixes=False):
         if target is None:
             return
 
+        # getPath walks IDA flowchart objects, so under iterateAsync it runs on the main thread as a whole
         targetInfo = {}
         if type(target) in [int, long]:
             logging.debug("iterate target function: %s" %
@@ -172,14 +862,14 @@ class EmuHelper():
 
                 logging.debug("getting a path to %s, %d of %d" %
                               (self.hexString(x.frm), i + 1, len(xrefs)))
-                flow, paths = self.getPath(x.frm)
+                flow, paths = callOnMainThread(self.getPath, x.frm)
                 if flow is not None:
                     targetInfo[x.frm] = (flow, paths)
         elif isinstance(target, list):
             for i, t in enumerate(target):
                 logging.debug("getting a path to %s, %d of %d" %
                               (self.hexString(t), i + 1, len(target)))
-                flow, paths = self.getPath(t)
+                flow, paths = callOnMainThread(self.getPath, t)
                 if flow is not None:
                     targetInfo[t] = (flow, paths)
         if len(targetInfo) <= 0:
@@ -195,61 +885,154 @@ class EmuHelper():
         if hookData:
             userData.update(hookData)
         self.internalRun = False
+        self.harvestedStrings = []
         self.resetEmuHooks()
-        self.h_codehook = self.uc.hook_add(
-            unicorn.UC_HOOK_CODE, self._guidedHook, userData)
-        if instructionHook:
-            self.h_userhook = self.uc.hook_add(unicorn.UC_HOOK_CODE, instructionHook, userData)
-        if memAccessHook:
-            self.h_memaccesshook = self.uc.hook_add(unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE, memAccessHook,
-                                                    userData)
+        self._installCodeHook(self._guidedHook, instructionHook, userData)
+        self._installMemAccessHooks(memAccessHook, userData)
         self.h_memhook = self.uc.hook_add(unicorn.UC_HOOK_MEM_READ_UNMAPPED | unicorn.UC_HOOK_MEM_WRITE_UNMAPPED |
                                           unicorn.UC_HOOK_MEM_FETCH_UNMAPPED, self._hookMemInvalid, userData)
         self.h_inthook = self.uc.hook_add(
             unicorn.UC_HOOK_INTR, self._hookInterrupt, userData)
         self.blockIdx = 0
-        cnt = 1
-
-        # read targets from dict to go from higher to lower addresses
-        # this is done to optimize loop by allowing hook to check for and remove other targets visited en route to
-        # current target
-        while len(userData["targetInfo"]) > 0:
-            userData["targetVA"] = targetVA = sorted(
-                userData["targetInfo"].keys(), reverse=True)[0]
+
+        # paths are emulated one function at a time, from higher to lower addresses, and sorted by their blocks so
+        # that paths sharing leading blocks are adjacent. with sharePrefixes, where a path starts with the same blocks
+        # as the one before it, it resumes from the engine state saved at the end of those blocks instead of from the
+        # start of the function. a path that is a prefix of another is sorted after it, as its target may be visited
+        # on the way
+        leaves = []
+        for targetVA in userData["targetInfo"]:
             flow, paths = userData["targetInfo"][targetVA]
-            funcStart = flow[0][0]
+            for pathIdx, path in enumerate(paths):
+                leaves.append((flow[0][0], path, targetVA, pathIdx))
+        leaves.sort(key=lambda leaf: (-leaf[0], leaf[1] + [float("inf")]))
+        self.pathSnapshots = []
+        lastLeaf = None
+        for i, (funcStart, path, targetVA, pathIdx) in enumerate(leaves):
+            if self.asyncJob is not None and self.asyncJob.cancelled:
+                logging.debug("iterate cancelled")
+                return
+            if targetVA not in userData["targetInfo"]:
+                # visited on the way to an earlier target
+                continue
+            userData["targetVA"] = targetVA
             userData["func_t"] = idaapi.get_func(funcStart)
-            self.pathIdx = 0
-            numTargets = len(userData["targetInfo"])
-            logging.debug("run #%d, %d targets remaining: %s (%d paths)" % (
-                cnt, numTargets, self.hexString(targetVA), len(paths)))
-            cnt2 = 1
-            numPaths = len(paths)
-            for path in paths:
-                logging.debug("emulating path #%d of %d from %s to %s via basic blocks: %s" % (
-                    cnt2, numPaths, self.hexString(funcStart), self.hexString(targetVA), repr(path)))
-                for reg in self.regs:
-                    self.uc.reg_write(self.regs[reg], 0)
+            self.pathIdx = pathIdx
+            # the last block holds the target, so a path can at most resume from the end of the one before it
+            shared = 0
+            if sharePrefixes and lastLeaf is not None and lastLeaf[0] == funcStart:
+                shared = min(self._getSharedBlocks(lastLeaf[1], path), len(path) - 1)
+            userData["sharedBlocks"] = 0
+            if sharePrefixes and i + 1 < len(leaves) and leaves[i + 1][0] == funcStart:
+                userData["sharedBlocks"] = min(self._getSharedBlocks(path, leaves[i + 1][1]), len(path) - 1)
+            lastLeaf = (funcStart, path)
+            stale = []
+            while self.pathSnapshots and self.pathSnapshots[-1][0] > shared:
+                stale.append(self.pathSnapshots.pop())
+            if self.pathSnapshots:
+                for snapshot in stale:
+                    self._restorePathSnapshot(snapshot)
+            userData["visitedTargets"] = []
+            if self.pathSnapshots:
+                self.blockIdx = self.pathSnapshots[-1][0]
+                logging.debug("resuming path to %s after %d shared basic blocks: %s" % (
+                    self.hexString(targetVA), self.blockIdx, repr(path[self.blockIdx:])))
+                self._resetEmuContext()
+                self._restorePathSnapshot(self.pathSnapshots[-1])
+                start = userData["targetInfo"][targetVA][0][path[self.blockIdx]][0]
+            else:
+                logging.debug("emulating path from %s to %s via basic blocks: %s" % (
+                    self.hexString(funcStart), self.hexString(targetVA), repr(path)))
+                self.blockIdx = 0
                 if resetEmuMem:
                     self.reloadBinary()
-                self.uc.reg_write(self.regs["sp"], self.stack)
-                self.enteredBlock = False
-                userData["visitedTargets"] = []
+                self._resetEmuContext()
                 if preEmuCallback:
                     preEmuCallback(self, userData, funcStart)
-                if self.arch == unicorn.UC_ARCH_ARM:
-                    userData["changeThumbMode"] = True
-
-                self.uc.emu_start(funcStart, idc.get_func_attr(
-                    funcStart, idc.FUNCATTR_END))
-                self.pathIdx += 1
-                self.blockIdx = 0
-                cnt2 += 1
-                # remove visited targets during this run from our dict
-                for addr in userData["visitedTargets"]:
-                    del(userData["targetInfo"][addr])
-
-            cnt += 1
+                # paths resumed from a snapshot keep the hooks resolved here, as they started from the same context
+                self._installRegMemAccessHooks(userData)
+                start = funcStart
+            # writes only need to be recorded while this run may take or add to a snapshot
+            if self.pathSnapshots or userData["sharedBlocks"] > 0:
+                if not self.h_snapshothook:
+                    self.h_snapshothook = self.uc.hook_add(unicorn.UC_HOOK_MEM_WRITE, self._pathSnapshotWriteHook,
+                                                           userData)
+            elif self.h_snapshothook:
+                self.uc.hook_del(self.h_snapshothook)
+                self.h_snapshothook = None
+            self.enteredBlock = False
+            self._emuStart(self._getModePC(start), idc.get_func_attr(funcStart, idc.FUNCATTR_END))
+            # remove visited targets during this run from our dict
+            for addr in userData["visitedTargets"]:
+                userData["targetInfo"].pop(addr, None)
+        self.pathSnapshots = []
+        if self.h_snapshothook:
+            self.uc.hook_del(self.h_snapshothook)
+            self.h_snapshothook = None
+
+    # returns the number of leading basic blocks two paths have in common
+    def _getSharedBlocks(self, path1, path2):
+        shared = 0
+        for bb1, bb2 in zip(path1, path2):
+            if bb1 != bb2:
+                break
+            shared += 1
+        return shared
+
+    # an iterate path snapshot is a (number of blocks emulated, cpu context, saved pages, memory state) tuple. saved
+    # pages holds the contents the pages written since the snapshot was taken had at that time, so restoring a
+    # snapshot only writes back the pages that changed since. emulated writes are recorded by a write hook and
+    # flare-emu's own writes, e.g. from API hooks, by _writeEmuMem. the memory state, from _getPathSnapshotMem,
+    # describes the memory that was mapped and allocated
+    def _pathSnapshotWriteHook(self, uc, access, address, size, value, userData):
+        self._savePathSnapshotPages(address, size)
+
+    def _savePathSnapshotPages(self, address, size):
+        if self.pathSnapshots:
+            savedPages = self.pathSnapshots[-1][2]
+            for page in range(address & self.pageMask, address + size, PAGESIZE):
+                if page not in savedPages:
+                    savedPages[page] = str(self.uc.mem_read(page, PAGESIZE))
+
+    # returns the mapped regions, allocations and stack and fault handling state that a path snapshot restores
+    def _getPathSnapshotMem(self):
+        regions = frozenset((start, end) for start, end, perms in self.uc.mem_regions())
+        return (regions, dict(self.allocMap), deepcopy(self.addrSpace), self.stackCommitted, self.stackGuardMapped,
+                self.autoMappedBytes)
+
+    # returns emulator memory to the mappings of a snapshot: memory mapped since, e.g. by allocations, stack growth
+    # or memory faults, is unmapped and memory unmapped since, e.g. by frees, is mapped again. the contents of the
+    # latter were saved to the snapshot's pages before it was unmapped. binary pages loaded by lazyLoad stay mapped
+    def _restorePathSnapshotMem(self, memState):
+        regions, allocMap, addrSpace, stackCommitted, stackGuardMapped, autoMappedBytes = memState
+        current = set((start, end) for start, end, perms in self.uc.mem_regions())
+        for start, end in current - regions:
+            if not self._isBinaryAddr(start):
+                self.uc.mem_unmap(start, end - start + 1)
+        for start, end in regions - current:
+            try:
+                self.uc.mem_map(start, end - start + 1)
+            except unicorn.UcError:
+                logging.debug("could not map %s for path snapshot" % self.hexString(start))
+        self._invalidateMemExtents()
+        self.allocMap = dict(allocMap)
+        self.addrSpace = deepcopy(addrSpace)
+        self.stackCommitted = stackCommitted
+        self.stackGuardMapped = stackGuardMapped
+        self.autoMappedBytes = autoMappedBytes
+
+    # restores the mappings and the pages saved by a snapshot and its cpu context. snapshots taken after it must have
+    # been restored first, latest first
+    def _restorePathSnapshot(self, snapshot):
+        blocks, context, savedPages, memState = snapshot
+        self._restorePathSnapshotMem(memState)
+        for page in savedPages:
+            try:
+                self.uc.mem_write(page, savedPages[page])
+            except unicorn.UcError:
+                logging.debug("page %s saved by path snapshot is no longer mapped" % self.hexString(page))
+        savedPages.clear()
+        self.uc.context_restore(context)
 
     # simply emulates to the end of whatever bytes are provided
     # these bytes are not loaded into IDB, only emulator memory; IDA APIs are not available for use in hooks here
@@ -268,20 +1051,128 @@ class EmuHelper():
         mu = self.uc
         self._prepEmuContext(registers, stack)
         self.resetEmuHooks()
-        self.h_codehook = mu.hook_add(
-            unicorn.UC_HOOK_CODE, self._emulateBytesCodeHook, userData)
-        if instructionHook:
-            self.h_userhook = mu.hook_add(unicorn.UC_HOOK_CODE, instructionHook, userData)
-        if memAccessHook:
-            self.h_memaccesshook = self.uc.hook_add(unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE, memAccessHook,
-                                                    userData)
+        self._installCodeHook(self._emulateBytesCodeHook, instructionHook, userData)
+        self._installMemAccessHooks(memAccessHook, userData)
         self.h_memhook = mu.hook_add(unicorn.UC_HOOK_MEM_READ_UNMAPPED | unicorn.UC_HOOK_MEM_WRITE_UNMAPPED |
                                      unicorn.UC_HOOK_MEM_FETCH_UNMAPPED, self._hookMemInvalid, userData)
         self.h_inthook = mu.hook_add(
             unicorn.UC_HOOK_INTR, self._hookInterrupt, userData)
-        mu.emu_start(baseAddr, endAddr)
+        self._emuStart(baseAddr, endAddr)
         return mu
 
+    # emulates each function in the binary once from its entry and yields a result dict for each function as soon as
+    # it has run, with its "funcStart", "ret" value, "outputs", "stopReason", "error", the exception that ended the
+    # run or None, and "strings", its harvestedStrings if enableStringHarvest was called. an exception in one function
+    # does not stop the others
+    # filter: a function called as filter(emuHelper, funcStart) that returns True for the functions to emulate,
+    #     defaults to all functions
+    # budget: maximum number of instructions to emulate per function, defaults to 0 (no limit)
+    # outputs: registers and (pointer, size) buffers to report for each function, in the format of emulateRange's
+    #     cacheOutputs. "outputs" maps each entry to its value after the function has run
+    # emulator memory is returned to its loaded state between functions with restoreBinary, the remaining arguments
+    # are passed to emulateRange for each function
+    def emulateFunctions(self, filter=None, budget=0, outputs=None, registers=None, stack=None, instructionHook=None,
+                         callHook=None, memAccessHook=None, hookData=None, skipCalls=True, hookApis=True,
+                         fastMode=False):
+        if outputs is None:
+            outputs = []
+        self.trackBinaryWrites()
+        for funcStart in idautils.Functions():
+            if self.asyncJob is not None and self.asyncJob.cancelled:
+                logging.debug("emulateFunctions cancelled")
+                return
+            if filter is not None and not filter(self, funcStart):
+                continue
+            logging.debug("emulating function %s" % self.hexString(funcStart))
+            self.restoreBinary()
+            # registers and stack are rewritten with the addresses of any strings they contain
+            funcRegisters = dict(registers) if registers else {}
+            funcStack = list(stack) if stack else []
+            result = {"funcStart": funcStart, "ret": None, "outputs": None, "stopReason": None, "error": None,
+                      "strings": []}
+            try:
+                self._prepEmuContext(funcRegisters, funcStack)
+                self.resetEmuHooks()
+                ptrs = self._getCacheOutputPtrs(funcRegisters, outputs)
+                self._emulateRange(funcStart, None, funcRegisters, funcStack, instructionHook, callHook,
+                                   memAccessHook, hookData, skipCalls, hookApis, budget, fastMode)
+                regVals, bufs = self._getCachedOutputs(ptrs, outputs)
+                bufs = iter(bufs)
+                result["ret"] = regVals["ret"]
+                result["outputs"] = dict((output, next(bufs) if isinstance(output, tuple) else regVals[output])
+                                         for output in outputs)
+            except Exception as e:
+                logging.debug("exception emulating function %s: %s" % (self.hexString(funcStart), str(e)))
+                result["error"] = e
+            result["stopReason"] = self.stopReason
+            result["strings"] = self.harvestedStrings
+            yield result
+
+    # awaitable counterpart of emulateRange for use from asyncio code, accepts the same arguments as emulateRange.
+    # emulation runs on executor, which defaults to a single worker thread owned by this EmuHelper so that runs are
+    # serialized on its emulator. cancelling the returned future stops emulation.
+    # the IDA API may only be called from IDA's main thread, which runs the event loop. the IDA calls flare-emu makes
+    # on the worker thread are handed to the event loop and wait for it to run them, see callOnMainThread, so the
+    # loop must keep running until the job is done. execute_sync cannot be used for this, as IDA does not process
+    # its requests while the main thread is in the event loop. each IDA call costs a round trip between threads, so
+    # fastMode, which makes IDA calls only at call sites, is much faster here
+    def emulateRangeAsync(self, *args, **kwargs):
+        executor = kwargs.pop("executor", None)
+        return self._runAsync(self.emulateRange, args, kwargs, executor)
+
+    # asynchronous iterator counterpart of iterate for use with "async for", accepts the same arguments as iterate.
+    # targetCallback is called on the executor thread when each target is reached and its return value is delivered
+    # to the async for loop as soon as it is produced. if no targetCallback is provided, (address, argv) tuples are
+    # delivered instead. cancelling the consuming task, or calling cancel() on the iterator, stops emulation
+    def iterateAsync(self, target, targetCallback=None, *args, **kwargs):
+        executor = kwargs.pop("executor", None)
+        loop = asyncio.get_event_loop()
+        results = EmuAsyncIterator(self, loop)
+
+        def asyncTargetCallback(eh, address, argv, userData):
+            if targetCallback is not None:
+                # the callback is free to use the IDA API
+                result = callOnMainThread(targetCallback, eh, address, argv, userData)
+            else:
+                result = (address, argv)
+            loop.call_soon_threadsafe(results._push, result)
+
+        fut = self._runAsync(self.iterate, (target, asyncTargetCallback) + args, kwargs, executor)
+        results._start(fut)
+        return results
+
+    # runs func on executor, tracking it as the current async job so that it can be stopped on cancellation
+    def _runAsync(self, func, args, kwargs, executor):
+        if executor is None:
+            if self.asyncExecutor is None:
+                self.asyncExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            executor = self.asyncExecutor
+        job = _AsyncJob()
+        loop = asyncio.get_event_loop()
+
+        def run():
+            if job.cancelled:
+                return None
+            _enterAsyncJob(loop)
+            self.asyncJob = job
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.asyncJob = None
+                _exitAsyncJob()
+
+        fut = loop.run_in_executor(executor, run)
+        fut.add_done_callback(lambda f: f.cancelled() and self._cancelAsyncJob(job))
+        job.future = fut
+        return fut
+
+    # a job cancelled before it starts emulating is stopped by the checks of job.cancelled in _emuStart and between
+    # iterate paths, as emu_stop has no effect on an idle emulator
+    def _cancelAsyncJob(self, job):
+        job.cancelled = True
+        if self.asyncJob is job:
+            self.uc.emu_stop()
+
     def hexString(self, va):
         if va > 0xffffffff:
             return "%016X" % va
@@ -317,14 +1208,10 @@ class EmuHelper():
     # useIDA option was added to handle cases where IDA folds multiple instructions
     # do not call multiple times in a row, depends on userData being updated by hook
     def skipInstruction(self, userData, useIDA=False):
-        if self.arch == unicorn.UC_ARCH_ARM:
-            userData["changeThumbMode"] = True
         if useIDA:
-            self.uc.reg_write(self.regs["pc"], idc.next_head(
-                userData["currAddr"], idc.get_inf_attr(idc.INF_MAX_EA)))
+            self._setPC(idc.next_head(userData["currAddr"], idc.get_inf_attr(idc.INF_MAX_EA)))
         else:
-            self.uc.reg_write(
-                self.regs["pc"], userData["currAddr"] + userData["currAddrSize"])
+            self._setPC(userData["currAddr"] + userData["currAddrSize"])
         # get IDA's SP delta value for next instruction to adjust stack accordingly since we are skipping
         # this instruction
         self.uc.reg_write(self.regs["sp"], self.getRegVal(
@@ -333,26 +1220,78 @@ class EmuHelper():
             
     # call from an emulation hook to change program counter
     def changeProgramCounter(self, userData, newPC):
+        self._setPC(newPC)
+
+    # writes the program counter, for ARM the low bit is set according to the mode of newPC so the cpu mode is
+    # switched along with it
+    def _setPC(self, newPC):
+        self.uc.reg_write(self.regs["pc"], self._getModePC(newPC))
+
+    # returns addr with the low bit set if it is in an ARM thumb region, cleared otherwise
+    def _getModePC(self, addr):
         if self.arch == unicorn.UC_ARCH_ARM:
-            userData["changeThumbMode"] = True
-        self.uc.reg_write(self.regs["pc"], newPC)
+            if self.isThumbMode(addr):
+                self.mode = unicorn.UC_MODE_THUMB
+                return addr | 1
+            self.mode = unicorn.UC_MODE_ARM
+            return addr & ~1
+        return addr
 
     # retrieves the value of a register, handling subregister addressing
     def getRegVal(self, regName):
-        regVal = self.uc.reg_read(self.regs[regName])
-        # handle various subregister addressing
-        if self.arch == unicorn.UC_ARCH_X86:
-            if regName[:-1] in ["l", "b"]:
-                regVal = regVal & 0xFF
-            elif regName[:-1] == "h":
-                regVal = (regVal & 0xFF00) >> 8
-            elif len(regName) == 2 and regName[:-1] == "x":
-                regVal = regVal & 0xFFFF
-        elif self.arch == unicorn.UC_ARCH_ARM64:
-            if regName[0] == "W":
-                regVal = regVal & 0xFFFFFFFF
+        regId, shift, mask = self.regAccessors[regName]
+        regVal = self.uc.reg_read(regId)
+        if mask is not None:
+            regVal = (regVal >> shift) & mask
         return regVal
 
+    # returns a dict of register values for a list of register names, handling subregister addressing. unicorn's
+    # batch register API is used when available
+    def readRegs(self, regNames):
+        regIds = list(set(self.regAccessors[name][0] for name in regNames))
+        regVals = dict(zip(regIds, self._readRegIds(regIds)))
+        out = {}
+        for name in regNames:
+            regId, shift, mask = self.regAccessors[name]
+            if mask is None:
+                out[name] = regVals[regId]
+            else:
+                out[name] = (regVals[regId] >> shift) & mask
+        return out
+
+    # writes a dict of register names and values, handling subregister addressing. 8 and 16-bit subregisters are
+    # merged into the current value of their parent register, wider subregisters are zero extended
+    def writeRegs(self, regs):
+        merge = [self.regAccessors[name][0] for name in regs if self.regAccessors[name][2] in [0xFF, 0xFFFF]]
+        curVals = dict(zip(merge, self._readRegIds(merge)))
+        newVals = {}
+        for name in regs:
+            regId, shift, mask = self.regAccessors[name]
+            val = regs[name]
+            if mask is None:
+                newVals[regId] = val
+                continue
+            if regId in newVals:
+                cur = newVals[regId]
+            else:
+                cur = curVals.get(regId, 0)
+            if mask in [0xFF, 0xFFFF]:
+                newVals[regId] = (cur & ~(mask << shift)) | ((val & mask) << shift)
+            else:
+                newVals[regId] = val & mask
+        if hasattr(self.uc, "reg_write_batch"):
+            self.uc.reg_write_batch(list(newVals.items()))
+        else:
+            for regId in newVals:
+                self.uc.reg_write(regId, newVals[regId])
+
+    def _readRegIds(self, regIds):
+        if len(regIds) == 0:
+            return []
+        if hasattr(self.uc, "reg_read_batch"):
+            return list(self.uc.reg_read_batch(regIds))
+        return [self.uc.reg_read(regId) for regId in regIds]
+
     def stopEmulation(self, userData):
         self.enteredBlock = False
         if "visitedTargets" in userData and userData["targetVA"] not in userData["visitedTargets"]:
@@ -380,116 +1319,369 @@ class EmuHelper():
         if self.h_inthook:
             self.uc.hook_del(self.h_inthook)
             self.h_inthook = None
+        for h in self.h_sitehooks:
+            self.uc.hook_del(h)
+        self.h_sitehooks = []
+        for h in self.h_filteredhooks:
+            self.uc.hook_del(h)
+        self.h_filteredhooks = []
+        for h in self.h_memaccesshooks:
+            self.uc.hook_del(h)
+        self.h_memaccesshooks = []
+        for h in self.h_regmemaccesshooks:
+            self.uc.hook_del(h)
+        self.h_regmemaccesshooks = []
+        if self.h_snapshothook:
+            self.uc.hook_del(self.h_snapshothook)
+            self.h_snapshothook = None
+
+    # registers an instruction hook that runs during every emulation run until it is removed, in addition to the
+    # instructionHook passed to the run. hooks have the same prototype as instructionHook and run in ascending
+    # priority order, a run's instructionHook has priority 0. addresses limits the hook to a list of instruction
+    # addresses and (start, end) address ranges, end exclusive, if not given the hook runs on every instruction.
+    # limited hooks are bound to their addresses by unicorn and run after the unlimited ones, so priority only orders
+    # hooks within each of those groups. returns a handle for removeInstructionHook
+    def addInstructionHook(self, hook, priority=0, addresses=None):
+        addrs = None
+        ranges = []
+        if addresses is not None:
+            addrs = set()
+            for addr in addresses:
+                if isinstance(addr, tuple):
+                    ranges.append(addr)
+                else:
+                    addrs.add(addr)
+        self.hookSeq += 1
+        self.instructionHooks.append((priority, self.hookSeq, hook, addrs, ranges))
+        self.instructionHooks.sort(key=lambda entry: entry[:2])
+        return self.hookSeq
+
+    def removeInstructionHook(self, handle):
+        self.instructionHooks = [entry for entry in self.instructionHooks if entry[1] != handle]
+
+    # registers a memory access hook with the same prototype as memAccessHook that runs during every emulation run
+    # until it is removed. access is "read", "write" or "both". ranges limits the hook to a list of (start, end)
+    # address ranges, end exclusive, where start may also be a register name, e.g. "arg1", in which case the range is
+    # the end bytes of the buffer the register points to when emulation starts. iterate resolves these ranges at
+    # the start of each path, after preEmuCallback has run. the filtering is done by unicorn, so accesses outside the
+    # ranges never call into Python. returns a handle for removeMemAccessHook
+    def addMemAccessHook(self, hook, access="both", ranges=None):
+        self.hookSeq += 1
+        self.memAccessHooks.append((self.hookSeq, hook, access, ranges))
+        return self.hookSeq
+
+    def removeMemAccessHook(self, handle):
+        self.memAccessHooks = [entry for entry in self.memAccessHooks if entry[0] != handle]
+
+    # sets a watchpoint on the size bytes at addr that records each access of type on, "read", "write" or "both",
+    # during emulation. if stopAfter is given, emulation is stopped with a "watchpoint" stopReason once that many
+    # accesses have been recorded during a run, each iterate path counting as a run. the log is kept across emulation
+    # runs until unwatch is called and can be read with getWatchLog. returns a handle for getWatchLog and unwatch
+    def watch(self, addr, size, on="write", stopAfter=None):
+        # a flat list of pc, address, size, value entries avoids building a tuple for each access
+        log = []
+        # the run the accesses counted towards stopAfter were made in, and their number
+        runAccesses = [None, 0]
+
+        def watchHook(uc, access, address, size, value, userData):
+            if access == unicorn.UC_MEM_READ:
+                # read hooks run before the access, so the value is read from memory
+                value = 0
+                for b in reversed(bytearray(uc.mem_read(address, size))):
+                    value = (value << 8) | b
+            log.extend((uc.reg_read(self.regs["pc"]), address, size, value))
+            if stopAfter is not None:
+                if runAccesses[0] != self.runCount:
+                    runAccesses[0] = self.runCount
+                    runAccesses[1] = 0
+                runAccesses[1] += 1
+                if runAccesses[1] >= stopAfter:
+                    self.stopReason = "watchpoint"
+                    self.stopEmulation(userData)
 
-    # for debugging purposes
-    def getEmuState(self):
-        if self.arch == unicorn.UC_ARCH_X86:
-            if self.uc._mode == unicorn.UC_MODE_64:
-                out = "RAX: %016X\tRBX: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_RAX), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_RBX))
-                out += "RCX: %016X\tRDX: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_RCX), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_RDX))
-                out += "RDI: %016X\tRSI: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_RDI), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_RSI))
-                out += "R8: %016X\tR9: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_R8), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_R9))
-                out += "RBP: %016X\tRSP: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_RBP), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_RSP))
-                out += "RIP: %016X\n" % (self.uc.reg_read(unicorn.x86_const.UC_X86_REG_RIP))
-            elif self.uc._mode == unicorn.UC_MODE_32:
-                out = "EAX: %016X\tEBX: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_EAX), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_EBX))
-                out += "ECX: %016X\tEDX: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_ECX), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_EDX))
-                out += "EDI: %016X\tESI: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_EDI), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_ESI))
-                out += "EBP: %016X\tESP: %016X\n" % (self.uc.reg_read(
-                    unicorn.x86_const.UC_X86_REG_EBP), self.uc.reg_read(unicorn.x86_const.UC_X86_REG_ESP))
-                out += "EIP: %016X\n" % (self.uc.reg_read(unicorn.x86_const.UC_X86_REG_EIP))
-        elif self.arch == unicorn.UC_ARCH_ARM64:
-            out = "X0: %016X\tX1: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X0), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X1))
-            out += "X2: %016X\tX3: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X2), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X3))
-            out += "X4: %016X\tX5: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X4), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X5))
-            out += "X6: %016X\tX7: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X6), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X7))
-            out += "X8: %016X\tX9: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X8), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X9))
-            out += "X10: %016X\tX11: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X10), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X11))
-            out += "X12: %016X\tX13: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X12), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X13))
-            out += "X14: %016X\tX15: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X14), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X15))
-            out += "X16: %016X\tX17: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X16), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X17))
-            out += "X18: %016X\tX19: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X18), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X19))
-            out += "X20: %016X\tX21: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X20), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X21))
-            out += "X22: %016X\tX23: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X22), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X23))
-            out += "X24: %016X\tX25: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X24), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X25))
-            out += "X26: %016X\tX27: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X26), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X27))
-            out += "X28: %016X\tX29: %016X\n" % (self.uc.reg_read(
-                unicorn.arm64_const.UC_ARM64_REG_X28), self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X29))
-            out += "X30: %016X\n" % (self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_X30))
-            out += "PC: %016X\n" % (self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_PC))
-            out += "SP: %016X\n" % (self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_SP))
-        elif self.arch == unicorn.UC_ARCH_ARM:
-            out = "R0: %08X\tR1: %08X\n" % (self.uc.reg_read(
-                unicorn.arm_const.UC_ARM_REG_R0), self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R1))
-            out += "R2: %08X\tR3: %08X\n" % (self.uc.reg_read(
-                unicorn.arm_const.UC_ARM_REG_R2), self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R3))
-            out += "R4: %08X\tR5: %08X\n" % (self.uc.reg_read(
-                unicorn.arm_const.UC_ARM_REG_R4), self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R5))
-            out += "R6: %08X\tR7: %08X\n" % (self.uc.reg_read(
-                unicorn.arm_const.UC_ARM_REG_R6), self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R7))
-            out += "R8: %08X\tR9: %08X\n" % (self.uc.reg_read(
-                unicorn.arm_const.UC_ARM_REG_R8), self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R9))
-            out += "R10: %08X\tR11: %08X\n" % (self.uc.reg_read(
-                unicorn.arm_const.UC_ARM_REG_R10), self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R11))
-            out += "R12: %08X\tR13: %08X\n" % (self.uc.reg_read(
-                unicorn.arm_const.UC_ARM_REG_R12), self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R13))
-            out += "R14: %08X\tR15: %08X\n" % (self.uc.reg_read(
-                unicorn.arm_const.UC_ARM_REG_R14), self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R15))
-            out += "PC: %08X\n" % self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R15)
-            out += "SP: %08X\n" % self.uc.reg_read(unicorn.arm_const.UC_ARM_REG_R13)
-        else:
+        handle = self.addMemAccessHook(watchHook, on, [(addr, addr + size)])
+        self.watchLogs[handle] = log
+        return handle
+
+    # returns the accesses recorded by a watchpoint as a list of (pc, address, size, value) tuples
+    def getWatchLog(self, handle):
+        log = self.watchLogs[handle]
+        return list(zip(log[0::4], log[1::4], log[2::4], log[3::4]))
+
+    def unwatch(self, handle):
+        self.removeMemAccessHook(handle)
+        del self.watchLogs[handle]
+
+    # installs the memory access hooks of a run: memAccessHook for all reads and writes and the registered hooks
+    # bound to their ranges. register relative ranges are resolved against the current register values, so the
+    # emulator context must already be prepared for the run
+    def _installMemAccessHooks(self, memAccessHook, userData):
+        if memAccessHook:
+            self.h_memaccesshook = self.uc.hook_add(unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE, memAccessHook,
+                                                    userData)
+        accessTypes = {"read": unicorn.UC_HOOK_MEM_READ, "write": unicorn.UC_HOOK_MEM_WRITE,
+                       "both": unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE}
+        for handle, hook, access, ranges in self.memAccessHooks:
+            if ranges is None:
+                self.h_memaccesshooks.append(self.uc.hook_add(accessTypes[access], hook, userData))
+                continue
+            for start, end in ranges:
+                if not isinstance(start, str) and end > start:
+                    self.h_memaccesshooks.append(self.uc.hook_add(accessTypes[access], hook, userData, start,
+                                                                  end - 1))
+        self._installRegMemAccessHooks(userData)
+
+    # (re)installs the registered memory access hooks whose ranges are relative to a register, resolving them against
+    # the current register values. iterate calls this again for each path it emulates from the start of a function
+    def _installRegMemAccessHooks(self, userData):
+        for h in self.h_regmemaccesshooks:
+            self.uc.hook_del(h)
+        self.h_regmemaccesshooks = []
+        accessTypes = {"read": unicorn.UC_HOOK_MEM_READ, "write": unicorn.UC_HOOK_MEM_WRITE,
+                       "both": unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE}
+        for handle, hook, access, ranges in self.memAccessHooks:
+            for start, end in ranges or []:
+                if isinstance(start, str):
+                    start = self.getRegVal(start)
+                    end += start
+                    if end > start:
+                        self.h_regmemaccesshooks.append(self.uc.hook_add(accessTypes[access], hook, userData, start,
+                                                                         end - 1))
+
+    # installs the unicorn code hooks of a run. internalHook is flare-emu's own instruction hook, or None in
+    # fastMode, and runs first. the unlimited instruction hooks and instructionHook are called from the same unicorn
+    # hook, so each instruction crosses from unicorn into Python only once however many of them are registered.
+    # hooks limited to addresses get their own unicorn hook per address and range, added after the dispatcher so they
+    # run after it, and other instructions never call them
+    def _installCodeHook(self, internalHook, instructionHook, userData):
+        entries = list(self.instructionHooks)
+        if instructionHook:
+            # sorts after registered hooks of the same priority
+            entries.append((0, self.hookSeq + 1, instructionHook, None, []))
+            entries.sort(key=lambda entry: entry[:2])
+        userData["internalCodeHook"] = internalHook
+        userData["codeHooks"] = [entry[2] for entry in entries if entry[3] is None]
+        if userData["codeHooks"]:
+            self.h_codehook = self.uc.hook_add(unicorn.UC_HOOK_CODE, self._dispatchCodeHook, userData)
+        elif internalHook is not None:
+            self.h_codehook = self.uc.hook_add(unicorn.UC_HOOK_CODE, internalHook, userData)
+        for priority, seq, hook, addrs, ranges in entries:
+            if addrs is None:
+                continue
+            for start, end in [(addr, addr + 1) for addr in sorted(addrs)] + ranges:
+                if end > start:
+                    self.h_filteredhooks.append(self.uc.hook_add(unicorn.UC_HOOK_CODE, hook, userData, start,
+                                                                 end - 1))
+
+    def _dispatchCodeHook(self, uc, address, size, userData):
+        if userData["internalCodeHook"] is not None:
+            userData["internalCodeHook"](uc, address, size, userData)
+        for hook in userData["codeHooks"]:
+            hook(uc, address, size, userData)
+
+    # low overhead alternative to verbose logging that can be left enabled. the address of each emulated instruction
+    # and, if regs is True, the registers it changed are kept for the last size instructions. nothing is
+    # disassembled or formatted until the trace is dumped, which happens when emulation raises an error or stops for
+    # a stopReason, when one of flare-emu's hooks raises an exception, or when dumpTrace is called
+    def enableTrace(self, size=256, regs=True):
+        self.disableTrace()
+        self.traceRing = collections.deque(maxlen=size)
+        self.traceRegs = [name for line in self.stateLayout for name in line] if regs else []
+        self.traceRegIds = [self.stateRegs[name] for name in self.traceRegs]
+        self.traceLast = None
+        # runs before other registered hooks so that they see the instruction in the trace
+        self.traceHook = self.addInstructionHook(self._traceInstructionHook, priority=-1)
+
+    def disableTrace(self):
+        if self.traceHook is not None:
+            self.removeInstructionHook(self.traceHook)
+        self.traceHook = None
+        self.traceRing = None
+
+    # records the instruction about to be emulated and the registers changed since the previous instruction, which
+    # are the changes made by the previous instruction
+    def _traceInstructionHook(self, uc, address, size, userData):
+        delta = None
+        if self.traceRegs:
+            vals = self._readRegIds(self.traceRegIds)
+            if self.traceLast is not None:
+                delta = [(i, val) for i, val in enumerate(vals) if val != self.traceLast[i]]
+            self.traceLast = vals
+        self.traceRing.append((address, delta))
+
+    # returns the trace as one line per instruction with its disassembly and the registers it changed
+    def dumpTrace(self):
+        if self.traceRing is None:
             return ""
-        return out
+        entries = list(self.traceRing)
+        lines = []
+        for i, (address, _) in enumerate(entries):
+            line = "%s: %s" % (self.hexString(address), idc.generate_disasm_line(address, 0))
+            if self.traceRegs:
+                if i + 1 < len(entries):
+                    delta = entries[i + 1][1]
+                else:
+                    vals = self._readRegIds(self.traceRegIds)
+                    delta = [(j, val) for j, val in enumerate(vals) if val != self.traceLast[j]]
+                if delta:
+                    line += "\t; " + ", ".join("%s=%s" % (self.traceRegs[j], self.hexString(val))
+                                               for j, val in delta)
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _logTrace(self, reason):
+        if self.traceRing:
+            logging.debug("%s, last %d instructions:\n%s" % (reason, len(self.traceRing), self.dumpTrace()))
+
+    # opt-in detection of strings produced by emulation. the start address, size and pc of each memory write,
+    # including those made by API hooks through _writeEmuMem, are recorded, and when emulation stops the written
+    # ranges are scanned for runs of at least minLength printable ASCII or UTF-16LE characters. the strings found by
+    # the last emulateRange, iterate or emulateBytes call are in harvestedStrings as (string, address, pc) tuples,
+    # where pc is the instruction that wrote the string's first character and wide strings are returned as
+    # getEmuWideString would
+    def enableStringHarvest(self, minLength=4):
+        self.disableStringHarvest()
+        self.harvestMinLength = minLength
+        self.harvestAsciiRe = re.compile("%s{%d,}" % (HARVEST_CHARS, minLength))
+        self.harvestWideRe = re.compile("(?:%s\\x00){%d,}" % (HARVEST_CHARS, minLength))
+        self.harvestHook = self.addMemAccessHook(self._harvestWriteHook, "write")
+
+    def disableStringHarvest(self):
+        if self.harvestHook is not None:
+            self.removeMemAccessHook(self.harvestHook)
+        self.harvestHook = None
+        self.harvestWrites = {}
+
+    def _harvestWriteHook(self, uc, access, address, size, value, userData):
+        self.harvestWrites[address] = (size, uc.reg_read(self.regs["pc"]))
+
+    # scans the memory written since the last scan for strings and adds them to harvestedStrings. adjacent and
+    # overlapping writes are merged so that each written range is read from the emulator once
+    def _harvestStrings(self):
+        writes = self.harvestWrites
+        self.harvestWrites = {}
+        ranges = []
+        writeAddrs = sorted(writes)
+        maxSize = max(size for size, pc in writes.values())
+        for address in writeAddrs:
+            end = address + writes[address][0]
+            if ranges and address <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([address, end])
+        for start, end in ranges:
+            try:
+                data = str(self.uc.mem_read(start, end - start))
+            except unicorn.UcError:
+                # the written memory was unmapped, e.g. freed, before emulation stopped
+                continue
+            for regex in [self.harvestAsciiRe, self.harvestWideRe]:
+                for m in regex.finditer(data):
+                    address = start + m.start()
+                    self.harvestedStrings.append((m.group(), address,
+                                                  self._getHarvestWriter(writes, writeAddrs, maxSize, address)))
+
+    # returns the pc of the recorded write with the nearest start that covers address. writeAddrs are the sorted
+    # start addresses of writes and maxSize the size of the largest one, which bounds how far back a covering write
+    # can start
+    def _getHarvestWriter(self, writes, writeAddrs, maxSize, address):
+        i = bisect.bisect_right(writeAddrs, address) - 1
+        while i >= 0 and writeAddrs[i] > address - maxSize:
+            writeAddr = writeAddrs[i]
+            if writeAddr + writes[writeAddr][0] > address:
+                return writes[writeAddr][1]
+            i -= 1
+        return None
+
+    # for debugging purposes, returns an EmuState snapshot of the registers, formatted only when converted to a string
+    def getEmuState(self):
+        names = [name for line in self.stateLayout for name in line]
+        regVals = self._readRegIds([self.stateRegs[name] for name in names])
+        return EmuState(dict(zip(names, regVals)), self.stateLayout, self.size_pointer * 2)
 
     # returns null-terminated string of bytes from the emulator's memory, starting at addr, do not necessarily need
     # to be printable characters
     def getEmuString(self, addr):
-        out = ""
-        while str(self.uc.mem_read(addr, 1)) != "\x00":
-            out += str(self.uc.mem_read(addr, 1))
-            addr += 1
+        out = self._readEmuString(addr)
+        if out is None:
+            raise unicorn.UcError(unicorn.UC_ERR_READ_UNMAPPED)
         return out
-    
+
     def getEmuWideString(self, addr):
-        out = ""
-        while str(self.uc.mem_read(addr, 2)) != "\x00\x00":
-            out += str(self.uc.mem_read(addr, 2))
-            addr += 2
+        out = self._readEmuString(addr, 2)
+        if out is None:
+            raise unicorn.UcError(unicorn.UC_ERR_READ_UNMAPPED)
         return out
 
+    # returns the number of contiguous mapped bytes starting at addr, 0 if addr is not mapped. in lazyLoad mode,
+    # binary pages that have not been loaded yet count as mapped
+    def getEmuMemExtent(self, addr):
+        if self.memExtentStarts is None:
+            self._buildMemExtents()
+        i = bisect.bisect_right(self.memExtentStarts, addr) - 1
+        if i < 0 or addr > self.memExtentEnds[i]:
+            return 0
+        return self.memExtentEnds[i] + 1 - addr
+
+    # merges the emulator's mapped regions, and in lazyLoad mode the binary's segments, into the sorted runs of
+    # contiguous memory used by getEmuMemExtent
+    def _buildMemExtents(self):
+        regions = [(start, end) for start, end, perms in self.uc.mem_regions()]
+        if self.lazyLoad:
+            regions += [(self.pageAlign(start), self.pageAlignUp(end) - 1)
+                        for start, end in zip(self.lazySegStarts, self.lazySegEnds)]
+        self.memExtentStarts = []
+        self.memExtentEnds = []
+        for start, end in sorted(regions):
+            if self.memExtentEnds and start <= self.memExtentEnds[-1] + 1:
+                self.memExtentEnds[-1] = max(self.memExtentEnds[-1], end)
+            else:
+                self.memExtentStarts.append(start)
+                self.memExtentEnds.append(end)
+
+    # drops the runs built by getEmuMemExtent, called whenever memory is mapped or unmapped
+    def _invalidateMemExtents(self):
+        self.memExtentStarts = None
+        self.memExtentEnds = None
+
+    # reads a string of <width> byte characters from the emulator's memory up to a null terminator, reading at
+    # most maxLen characters, or MAX_ALLOC_SIZE bytes if maxLen is not given. the string is read with a single read
+    # bounded by the end of mapped memory. returns None if addr is not mapped
+    def _readEmuString(self, addr, width=1, maxLen=None):
+        extent = self.getEmuMemExtent(addr)
+        if extent == 0:
+            return None
+        if maxLen is not None:
+            extent = min(extent, maxLen * width)
+        else:
+            extent = min(extent, MAX_ALLOC_SIZE)
+        extent -= extent % width
+        term = "\x00" * width
+        out = self.getEmuBytes(addr, extent)
+        idx = out.find(term)
+        # wide terminators must be character aligned
+        while idx != -1 and idx % width:
+            idx = out.find(term, idx + 1)
+        if idx != -1:
+            return out[:idx]
+        return out
+
+    # fills size bytes of emulator memory at addr with value using a single write
+    def _fillEmuMem(self, addr, value, size):
+        self._writeEmuMem(addr, chr(value) * size)
+
     # returns a <size> string of bytes read from <addr>
     def getEmuBytes(self, addr, size):
+        self._loadLazyPages(addr, size)
         return str(self.uc.mem_read(addr, size))
 
     # reads pointer value in emulator's memory
     def getEmuPtr(self, va):
-        return struct.unpack(self.pack_fmt, self.uc.mem_read(va, self.size_pointer))[0]
+        return struct.unpack(self.pack_fmt, self.getEmuBytes(va, self.size_pointer))[0]
         
     # writes a pointer value in emulator's memory
     def writeEmuPtr(self, va, value):
-        self.uc.mem_write(va, struct.pack(self.pack_fmt, value))
+        self._writeEmuMem(va, struct.pack(self.pack_fmt, value))
 
     # for debugging
     def formatBB(self, bb):
@@ -510,7 +1702,30 @@ class EmuHelper():
 
     # returns True if ea is in an area designated by IDA to be in thumb mode
     def isThumbMode(self, ea):
-        return idc.get_sreg(ea, "T") == 1
+        if self.thumbRangeStarts is None:
+            if self.arch != unicorn.UC_ARCH_ARM:
+                return idc.get_sreg(ea, "T") == 1
+            # rebuilt after IDB changes dropped it
+            self._buildThumbMap()
+        i = bisect.bisect_right(self.thumbRangeStarts, ea) - 1
+        if i < 0:
+            return False
+        endEA, isThumb = self.thumbRangeValues[i]
+        return isThumb and ea < endEA
+
+    # builds a sorted interval map of thumb and ARM ranges from IDA's T segment register ranges so the mode of an
+    # address is resolved with a bisect instead of an IDA API call
+    def _buildThumbMap(self):
+        starts = []
+        values = []
+        rg = idaapi.str2reg("T")
+        sregRange = idaapi.sreg_range_t()
+        for i in range(idaapi.get_sreg_ranges_qty(rg)):
+            if idaapi.getn_sreg_range(sregRange, rg, i):
+                starts.append(sregRange.start_ea)
+                values.append((sregRange.end_ea, sregRange.val == 1))
+        self.thumbRangeStarts = starts
+        self.thumbRangeValues = values
 
     def pageAlign(self, addr):
         return addr & 0xfffffffffffff000
@@ -619,48 +1834,17 @@ class EmuHelper():
                 self.size_pointer = 8
                 self.pack_fmt = "<Q"
                 self.pageMask = 0xfffffffffffff000
-                self.regs = {"ax": unicorn.x86_const.UC_X86_REG_RAX, "bx": unicorn.x86_const.UC_X86_REG_RBX,
-                             "cx": unicorn.x86_const.UC_X86_REG_RCX, "dx": unicorn.x86_const.UC_X86_REG_RDX,
-                             "di": unicorn.x86_const.UC_X86_REG_RDI, "si": unicorn.x86_const.UC_X86_REG_RSI,
-                             "bp": unicorn.x86_const.UC_X86_REG_RBP, "sp": unicorn.x86_const.UC_X86_REG_RSP,
-                             "ip": unicorn.x86_const.UC_X86_REG_RIP, "pc": unicorn.x86_const.UC_X86_REG_RIP,
-                             "rax": unicorn.x86_const.UC_X86_REG_RAX, "rbx": unicorn.x86_const.UC_X86_REG_RBX,
-                             "rcx": unicorn.x86_const.UC_X86_REG_RCX, "rdx": unicorn.x86_const.UC_X86_REG_RDX,
-                             "rdi": unicorn.x86_const.UC_X86_REG_RDI, "rsi": unicorn.x86_const.UC_X86_REG_RSI,
-                             "rbp": unicorn.x86_const.UC_X86_REG_RBP, "rsp": unicorn.x86_const.UC_X86_REG_RSP,
-                             "r8": unicorn.x86_const.UC_X86_REG_R8, "r9": unicorn.x86_const.UC_X86_REG_R9,
-                             "r10": unicorn.x86_const.UC_X86_REG_R10, "r11": unicorn.x86_const.UC_X86_REG_R11,
-                             "r12": unicorn.x86_const.UC_X86_REG_R12, "r13": unicorn.x86_const.UC_X86_REG_R13,
-                             "r14": unicorn.x86_const.UC_X86_REG_R14, "r15": unicorn.x86_const.UC_X86_REG_R15,
-                             "ret": unicorn.x86_const.UC_X86_REG_RAX}
                 if info.filetype == 11:
                     self.filetype = "PE"
                     self.tilName = "mssdk_win7"
-                    self.regs.update({"arg1": unicorn.x86_const.UC_X86_REG_RCX,
-                                      "arg2": unicorn.x86_const.UC_X86_REG_RDX,
-                                      "arg3": unicorn.x86_const.UC_X86_REG_R8,
-                                      "arg4": unicorn.x86_const.UC_X86_REG_R9})
                 elif info.filetype == 25:
                     self.filetype = "MACHO"
                     self.tilName = "macosx64"
-                    self.regs.update({"arg1": unicorn.x86_const.UC_X86_REG_RDI,
-                                      "arg2": unicorn.x86_const.UC_X86_REG_RSI,
-                                      "arg3": unicorn.x86_const.UC_X86_REG_RDX,
-                                      "arg4": unicorn.x86_const.UC_X86_REG_RCX})
                 elif info.filetype == 18:
                     self.filetype = "ELF"
                     self.tilName = "gnulnx_x64"
-                    self.regs.update({"arg1": unicorn.x86_const.UC_X86_REG_RDI,
-                                      "arg2": unicorn.x86_const.UC_X86_REG_RSI,
-                                      "arg3": unicorn.x86_const.UC_X86_REG_RDX,
-                                      "arg4": unicorn.x86_const.UC_X86_REG_RCX})
                 else:
                     self.filetype = "UNKNOWN"
-                    # assume PE for mem dumps
-                    self.regs.update({"arg1": unicorn.x86_const.UC_X86_REG_RCX,
-                                      "arg2": unicorn.x86_const.UC_X86_REG_RDX,
-                                      "arg3": unicorn.x86_const.UC_X86_REG_R8,
-                                      "arg4": unicorn.x86_const.UC_X86_REG_R9})
             elif info.is_32bit():
                 if info.filetype == 11:
                     self.filetype = "PE"
@@ -679,16 +1863,6 @@ class EmuHelper():
                 self.size_pointer = 4
                 self.pack_fmt = "<I"
                 self.pageMask = 0xfffff000
-                self.regs = {"ax": unicorn.x86_const.UC_X86_REG_EAX, "bx": unicorn.x86_const.UC_X86_REG_EBX,
-                             "cx": unicorn.x86_const.UC_X86_REG_ECX, "dx": unicorn.x86_const.UC_X86_REG_EDX,
-                             "di": unicorn.x86_const.UC_X86_REG_EDI, "si": unicorn.x86_const.UC_X86_REG_ESI,
-                             "bp": unicorn.x86_const.UC_X86_REG_EBP, "sp": unicorn.x86_const.UC_X86_REG_ESP,
-                             "ip": unicorn.x86_const.UC_X86_REG_EIP, "pc": unicorn.x86_const.UC_X86_REG_EIP,
-                             "eax": unicorn.x86_const.UC_X86_REG_EAX, "ebx": unicorn.x86_const.UC_X86_REG_EBX,
-                             "ecx": unicorn.x86_const.UC_X86_REG_ECX, "edx": unicorn.x86_const.UC_X86_REG_EDX,
-                             "edi": unicorn.x86_const.UC_X86_REG_EDI, "esi": unicorn.x86_const.UC_X86_REG_ESI,
-                             "ebp": unicorn.x86_const.UC_X86_REG_EBP, "esp": unicorn.x86_const.UC_X86_REG_ESP,
-                             "ret": unicorn.x86_const.UC_X86_REG_EAX}
             
             else:
                 logging.debug(
@@ -715,116 +1889,6 @@ class EmuHelper():
                 self.pack_fmt = "<Q"
                 self.derefPtr = idc.get_qword
                 self.pageMask = 0xfffffffffffff000
-                self.regs = {"R0": unicorn.arm64_const.UC_ARM64_REG_X0, "R1": unicorn.arm64_const.UC_ARM64_REG_X1,
-                             "R2": unicorn.arm64_const.UC_ARM64_REG_X2, "R3": unicorn.arm64_const.UC_ARM64_REG_X3,
-                             "R4": unicorn.arm64_const.UC_ARM64_REG_X4, "R5": unicorn.arm64_const.UC_ARM64_REG_X5,
-                             "R6": unicorn.arm64_const.UC_ARM64_REG_X6, "R7": unicorn.arm64_const.UC_ARM64_REG_X7,
-                             "R8": unicorn.arm64_const.UC_ARM64_REG_X8, "R9": unicorn.arm64_const.UC_ARM64_REG_X9,
-                             "R10": unicorn.arm64_const.UC_ARM64_REG_X10, "R11": unicorn.arm64_const.UC_ARM64_REG_X11,
-                             "R12": unicorn.arm64_const.UC_ARM64_REG_X12, "R13": unicorn.arm64_const.UC_ARM64_REG_X13,
-                             "R14": unicorn.arm64_const.UC_ARM64_REG_X14, "R15": unicorn.arm64_const.UC_ARM64_REG_X15,
-                             "X0": unicorn.arm64_const.UC_ARM64_REG_X0, "X1": unicorn.arm64_const.UC_ARM64_REG_X1,
-                             "X2": unicorn.arm64_const.UC_ARM64_REG_X2, "X3": unicorn.arm64_const.UC_ARM64_REG_X3,
-                             "X4": unicorn.arm64_const.UC_ARM64_REG_X4, "X5": unicorn.arm64_const.UC_ARM64_REG_X5,
-                             "X6": unicorn.arm64_const.UC_ARM64_REG_X6, "X7": unicorn.arm64_const.UC_ARM64_REG_X7,
-                             "X8": unicorn.arm64_const.UC_ARM64_REG_X8, "X9": unicorn.arm64_const.UC_ARM64_REG_X9,
-                             "X10": unicorn.arm64_const.UC_ARM64_REG_X10, "X11": unicorn.arm64_const.UC_ARM64_REG_X11,
-                             "X12": unicorn.arm64_const.UC_ARM64_REG_X12, "X13": unicorn.arm64_const.UC_ARM64_REG_X13,
-                             "X14": unicorn.arm64_const.UC_ARM64_REG_X14, "X15": unicorn.arm64_const.UC_ARM64_REG_X15,
-                             "X16": unicorn.arm64_const.UC_ARM64_REG_X16, "X17": unicorn.arm64_const.UC_ARM64_REG_X17,
-                             "X18": unicorn.arm64_const.UC_ARM64_REG_X18, "X19": unicorn.arm64_const.UC_ARM64_REG_X19,
-                             "X20": unicorn.arm64_const.UC_ARM64_REG_X20, "X21": unicorn.arm64_const.UC_ARM64_REG_X21,
-                             "X22": unicorn.arm64_const.UC_ARM64_REG_X22, "X23": unicorn.arm64_const.UC_ARM64_REG_X23,
-                             "X24": unicorn.arm64_const.UC_ARM64_REG_X24, "X25": unicorn.arm64_const.UC_ARM64_REG_X25,
-                             "X26": unicorn.arm64_const.UC_ARM64_REG_X26, "X27": unicorn.arm64_const.UC_ARM64_REG_X27,
-                             "X28": unicorn.arm64_const.UC_ARM64_REG_X28, "X29": unicorn.arm64_const.UC_ARM64_REG_X29,
-                             "X30": unicorn.arm64_const.UC_ARM64_REG_X30, "W0": unicorn.arm64_const.UC_ARM64_REG_X0,
-                             "W1": unicorn.arm64_const.UC_ARM64_REG_X1, "W2": unicorn.arm64_const.UC_ARM64_REG_X2,
-                             "W3": unicorn.arm64_const.UC_ARM64_REG_X3, "W4": unicorn.arm64_const.UC_ARM64_REG_X4,
-                             "W5": unicorn.arm64_const.UC_ARM64_REG_X5, "W6": unicorn.arm64_const.UC_ARM64_REG_X6,
-                             "W7": unicorn.arm64_const.UC_ARM64_REG_X7, "W8": unicorn.arm64_const.UC_ARM64_REG_X8,
-                             "W9": unicorn.arm64_const.UC_ARM64_REG_X9, "W10": unicorn.arm64_const.UC_ARM64_REG_X10,
-                             "W11": unicorn.arm64_const.UC_ARM64_REG_X11, "W12": unicorn.arm64_const.UC_ARM64_REG_X12,
-                             "W13": unicorn.arm64_const.UC_ARM64_REG_X13, "W14": unicorn.arm64_const.UC_ARM64_REG_X14,
-                             "W15": unicorn.arm64_const.UC_ARM64_REG_X15, "W16": unicorn.arm64_const.UC_ARM64_REG_X16,
-                             "W17": unicorn.arm64_const.UC_ARM64_REG_X17, "W18": unicorn.arm64_const.UC_ARM64_REG_X18,
-                             "W19": unicorn.arm64_const.UC_ARM64_REG_X19, "W20": unicorn.arm64_const.UC_ARM64_REG_X20,
-                             "W21": unicorn.arm64_const.UC_ARM64_REG_X21, "W22": unicorn.arm64_const.UC_ARM64_REG_X22,
-                             "W23": unicorn.arm64_const.UC_ARM64_REG_X23, "W24": unicorn.arm64_const.UC_ARM64_REG_X24,
-                             "W25": unicorn.arm64_const.UC_ARM64_REG_X25, "W26": unicorn.arm64_const.UC_ARM64_REG_X26,
-                             "W27": unicorn.arm64_const.UC_ARM64_REG_X27, "W28": unicorn.arm64_const.UC_ARM64_REG_X28,
-                             "W29": unicorn.arm64_const.UC_ARM64_REG_X29, "W30": unicorn.arm64_const.UC_ARM64_REG_X30,
-                             "PC": unicorn.arm64_const.UC_ARM64_REG_PC, "pc": unicorn.arm64_const.UC_ARM64_REG_PC,
-                             "LR": unicorn.arm64_const.UC_ARM64_REG_X30, "SP": unicorn.arm64_const.UC_ARM64_REG_SP,
-                             "sp": unicorn.arm64_const.UC_ARM64_REG_SP, "ret": unicorn.arm64_const.UC_ARM64_REG_X0,
-                             "S0": unicorn.arm64_const.UC_ARM64_REG_S0, "S1": unicorn.arm64_const.UC_ARM64_REG_S1,
-                             "S2": unicorn.arm64_const.UC_ARM64_REG_S2, "S3": unicorn.arm64_const.UC_ARM64_REG_S3,
-                             "S4": unicorn.arm64_const.UC_ARM64_REG_S4, "S5": unicorn.arm64_const.UC_ARM64_REG_S5,
-                             "S6": unicorn.arm64_const.UC_ARM64_REG_S6, "S7": unicorn.arm64_const.UC_ARM64_REG_S7,
-                             "S8": unicorn.arm64_const.UC_ARM64_REG_S8, "S9": unicorn.arm64_const.UC_ARM64_REG_S9,
-                             "S10": unicorn.arm64_const.UC_ARM64_REG_S10, "S11": unicorn.arm64_const.UC_ARM64_REG_S11,
-                             "S12": unicorn.arm64_const.UC_ARM64_REG_S12, "S13": unicorn.arm64_const.UC_ARM64_REG_S13,
-                             "S14": unicorn.arm64_const.UC_ARM64_REG_S14, "S15": unicorn.arm64_const.UC_ARM64_REG_S15,
-                             "S16": unicorn.arm64_const.UC_ARM64_REG_S16, "S17": unicorn.arm64_const.UC_ARM64_REG_S17,
-                             "S18": unicorn.arm64_const.UC_ARM64_REG_S18, "S19": unicorn.arm64_const.UC_ARM64_REG_S19,
-                             "S20": unicorn.arm64_const.UC_ARM64_REG_S20, "S21": unicorn.arm64_const.UC_ARM64_REG_S21,
-                             "S22": unicorn.arm64_const.UC_ARM64_REG_S22, "S23": unicorn.arm64_const.UC_ARM64_REG_S23,
-                             "S24": unicorn.arm64_const.UC_ARM64_REG_S24, "S25": unicorn.arm64_const.UC_ARM64_REG_S25,
-                             "S26": unicorn.arm64_const.UC_ARM64_REG_S26, "S27": unicorn.arm64_const.UC_ARM64_REG_S27,
-                             "S28": unicorn.arm64_const.UC_ARM64_REG_S28, "S29": unicorn.arm64_const.UC_ARM64_REG_S29,
-                             "S30": unicorn.arm64_const.UC_ARM64_REG_S30, "S31": unicorn.arm64_const.UC_ARM64_REG_S31,
-                             "D0": unicorn.arm64_const.UC_ARM64_REG_D0, "D1": unicorn.arm64_const.UC_ARM64_REG_D1,
-                             "D2": unicorn.arm64_const.UC_ARM64_REG_D2, "D3": unicorn.arm64_const.UC_ARM64_REG_D3,
-                             "D4": unicorn.arm64_const.UC_ARM64_REG_D4, "D5": unicorn.arm64_const.UC_ARM64_REG_D5,
-                             "D6": unicorn.arm64_const.UC_ARM64_REG_D6, "D7": unicorn.arm64_const.UC_ARM64_REG_D7,
-                             "D8": unicorn.arm64_const.UC_ARM64_REG_D8, "D9": unicorn.arm64_const.UC_ARM64_REG_D9,
-                             "D10": unicorn.arm64_const.UC_ARM64_REG_D10, "D11": unicorn.arm64_const.UC_ARM64_REG_D11,
-                             "D12": unicorn.arm64_const.UC_ARM64_REG_D12, "D13": unicorn.arm64_const.UC_ARM64_REG_D13,
-                             "D14": unicorn.arm64_const.UC_ARM64_REG_D14, "D15": unicorn.arm64_const.UC_ARM64_REG_D15,
-                             "D16": unicorn.arm64_const.UC_ARM64_REG_D16, "D17": unicorn.arm64_const.UC_ARM64_REG_D17,
-                             "D18": unicorn.arm64_const.UC_ARM64_REG_D18, "D19": unicorn.arm64_const.UC_ARM64_REG_D19,
-                             "D20": unicorn.arm64_const.UC_ARM64_REG_D20, "D21": unicorn.arm64_const.UC_ARM64_REG_D21,
-                             "D22": unicorn.arm64_const.UC_ARM64_REG_D22, "D23": unicorn.arm64_const.UC_ARM64_REG_D23,
-                             "D24": unicorn.arm64_const.UC_ARM64_REG_D24, "D25": unicorn.arm64_const.UC_ARM64_REG_D25,
-                             "D26": unicorn.arm64_const.UC_ARM64_REG_D26, "D27": unicorn.arm64_const.UC_ARM64_REG_D27,
-                             "D28": unicorn.arm64_const.UC_ARM64_REG_D28, "D29": unicorn.arm64_const.UC_ARM64_REG_D29,
-                             "D30": unicorn.arm64_const.UC_ARM64_REG_D30, "D31": unicorn.arm64_const.UC_ARM64_REG_D31,
-                             "H0": unicorn.arm64_const.UC_ARM64_REG_H0, "H1": unicorn.arm64_const.UC_ARM64_REG_H1,
-                             "H2": unicorn.arm64_const.UC_ARM64_REG_H2, "H3": unicorn.arm64_const.UC_ARM64_REG_H3,
-                             "H4": unicorn.arm64_const.UC_ARM64_REG_H4, "H5": unicorn.arm64_const.UC_ARM64_REG_H5,
-                             "H6": unicorn.arm64_const.UC_ARM64_REG_H6, "H7": unicorn.arm64_const.UC_ARM64_REG_H7,
-                             "H8": unicorn.arm64_const.UC_ARM64_REG_H8, "H9": unicorn.arm64_const.UC_ARM64_REG_H9,
-                             "H10": unicorn.arm64_const.UC_ARM64_REG_H10, "H11": unicorn.arm64_const.UC_ARM64_REG_H11,
-                             "H12": unicorn.arm64_const.UC_ARM64_REG_H12, "H13": unicorn.arm64_const.UC_ARM64_REG_H13,
-                             "H14": unicorn.arm64_const.UC_ARM64_REG_H14, "H15": unicorn.arm64_const.UC_ARM64_REG_H15,
-                             "H16": unicorn.arm64_const.UC_ARM64_REG_H16, "H17": unicorn.arm64_const.UC_ARM64_REG_H17,
-                             "H18": unicorn.arm64_const.UC_ARM64_REG_H18, "H19": unicorn.arm64_const.UC_ARM64_REG_H19,
-                             "H20": unicorn.arm64_const.UC_ARM64_REG_H20, "H21": unicorn.arm64_const.UC_ARM64_REG_H21,
-                             "H22": unicorn.arm64_const.UC_ARM64_REG_H22, "H23": unicorn.arm64_const.UC_ARM64_REG_H23,
-                             "H24": unicorn.arm64_const.UC_ARM64_REG_H24, "H25": unicorn.arm64_const.UC_ARM64_REG_H25,
-                             "H26": unicorn.arm64_const.UC_ARM64_REG_H26, "H27": unicorn.arm64_const.UC_ARM64_REG_H27,
-                             "H28": unicorn.arm64_const.UC_ARM64_REG_H28, "H29": unicorn.arm64_const.UC_ARM64_REG_H29,
-                             "H30": unicorn.arm64_const.UC_ARM64_REG_H30, "H31": unicorn.arm64_const.UC_ARM64_REG_H31,
-                             "Q0": unicorn.arm64_const.UC_ARM64_REG_Q0, "Q1": unicorn.arm64_const.UC_ARM64_REG_Q1,
-                             "Q2": unicorn.arm64_const.UC_ARM64_REG_Q2, "Q3": unicorn.arm64_const.UC_ARM64_REG_Q3,
-                             "Q4": unicorn.arm64_const.UC_ARM64_REG_Q4, "Q5": unicorn.arm64_const.UC_ARM64_REG_Q5,
-                             "Q6": unicorn.arm64_const.UC_ARM64_REG_Q6, "Q7": unicorn.arm64_const.UC_ARM64_REG_Q7,
-                             "Q8": unicorn.arm64_const.UC_ARM64_REG_Q8, "Q9": unicorn.arm64_const.UC_ARM64_REG_Q9,
-                             "Q10": unicorn.arm64_const.UC_ARM64_REG_Q10, "Q11": unicorn.arm64_const.UC_ARM64_REG_Q11,
-                             "Q12": unicorn.arm64_const.UC_ARM64_REG_Q12, "Q13": unicorn.arm64_const.UC_ARM64_REG_Q13,
-                             "Q14": unicorn.arm64_const.UC_ARM64_REG_Q14, "Q15": unicorn.arm64_const.UC_ARM64_REG_Q15,
-                             "Q16": unicorn.arm64_const.UC_ARM64_REG_Q16, "Q17": unicorn.arm64_const.UC_ARM64_REG_Q17,
-                             "Q18": unicorn.arm64_const.UC_ARM64_REG_Q18, "Q19": unicorn.arm64_const.UC_ARM64_REG_Q19,
-                             "Q20": unicorn.arm64_const.UC_ARM64_REG_Q20, "Q21": unicorn.arm64_const.UC_ARM64_REG_Q21,
-                             "Q22": unicorn.arm64_const.UC_ARM64_REG_Q22, "Q23": unicorn.arm64_const.UC_ARM64_REG_Q23,
-                             "Q24": unicorn.arm64_const.UC_ARM64_REG_Q24, "Q25": unicorn.arm64_const.UC_ARM64_REG_Q25,
-                             "Q26": unicorn.arm64_const.UC_ARM64_REG_Q26, "Q27": unicorn.arm64_const.UC_ARM64_REG_Q27,
-                             "Q28": unicorn.arm64_const.UC_ARM64_REG_Q28, "Q29": unicorn.arm64_const.UC_ARM64_REG_Q29,
-                             "Q30": unicorn.arm64_const.UC_ARM64_REG_Q30, "Q31": unicorn.arm64_const.UC_ARM64_REG_Q31}
-                self.regs.update({"arg1": unicorn.arm64_const.UC_ARM64_REG_X0,
-                                  "arg2": unicorn.arm64_const.UC_ARM64_REG_X1,
-                                  "arg3": unicorn.arm64_const.UC_ARM64_REG_X2,
-                                  "arg4": unicorn.arm64_const.UC_ARM64_REG_X3})
             elif info.is_32bit():
                 self.arch = unicorn.UC_ARCH_ARM
                 arch = "ARM"
@@ -843,36 +1907,6 @@ class EmuHelper():
                 self.pack_fmt = "<I"
                 self.derefPtr = idc.get_wide_dword
                 self.pageMask = 0xfffff000
-                self.regs = {"R0": unicorn.arm_const.UC_ARM_REG_R0, "R1": unicorn.arm_const.UC_ARM_REG_R1,
-                             "R2": unicorn.arm_const.UC_ARM_REG_R2, "R3": unicorn.arm_const.UC_ARM_REG_R3,
-                             "R4": unicorn.arm_const.UC_ARM_REG_R4, "R5": unicorn.arm_const.UC_ARM_REG_R5,
-                             "R6": unicorn.arm_const.UC_ARM_REG_R6, "R7": unicorn.arm_const.UC_ARM_REG_R7,
-                             "R8": unicorn.arm_const.UC_ARM_REG_R8, "R9": unicorn.arm_const.UC_ARM_REG_R9,
-                             "R10": unicorn.arm_const.UC_ARM_REG_R10, "R11": unicorn.arm_const.UC_ARM_REG_R11,
-                             "R12": unicorn.arm_const.UC_ARM_REG_R12, "R13": unicorn.arm_const.UC_ARM_REG_R13,
-                             "R14": unicorn.arm_const.UC_ARM_REG_R14, "R15": unicorn.arm_const.UC_ARM_REG_R15,
-                             "PC": unicorn.arm_const.UC_ARM_REG_R15, "pc": unicorn.arm_const.UC_ARM_REG_R15,
-                             "LR": unicorn.arm_const.UC_ARM_REG_R14, "SP": unicorn.arm_const.UC_ARM_REG_R13,
-                             "sp": unicorn.arm_const.UC_ARM_REG_R13, "apsr": unicorn.arm_const.UC_ARM_REG_APSR,
-                             "APSR": unicorn.arm_const.UC_ARM_REG_APSR, "ret": unicorn.arm_const.UC_ARM_REG_R0,
-                             "S0": unicorn.arm_const.UC_ARM_REG_S0, "S1": unicorn.arm_const.UC_ARM_REG_S1,
-                             "S2": unicorn.arm_const.UC_ARM_REG_S2, "S3": unicorn.arm_const.UC_ARM_REG_S3,
-                             "S4": unicorn.arm_const.UC_ARM_REG_S4, "S5": unicorn.arm_const.UC_ARM_REG_S5,
-                             "S6": unicorn.arm_const.UC_ARM_REG_S6, "S7": unicorn.arm_const.UC_ARM_REG_S7,
-                             "S8": unicorn.arm_const.UC_ARM_REG_S8, "S9": unicorn.arm_const.UC_ARM_REG_S9,
-                             "S10": unicorn.arm_const.UC_ARM_REG_S10, "S11": unicorn.arm_const.UC_ARM_REG_S11,
-                             "S12": unicorn.arm_const.UC_ARM_REG_S12, "S13": unicorn.arm_const.UC_ARM_REG_S13,
-                             "S14": unicorn.arm_const.UC_ARM_REG_S14, "S15": unicorn.arm_const.UC_ARM_REG_S15,
-                             "S16": unicorn.arm_const.UC_ARM_REG_S16, "S17": unicorn.arm_const.UC_ARM_REG_S17,
-                             "S18": unicorn.arm_const.UC_ARM_REG_S18, "S19": unicorn.arm_const.UC_ARM_REG_S19,
-                             "S20": unicorn.arm_const.UC_ARM_REG_S20, "S21": unicorn.arm_const.UC_ARM_REG_S21,
-                             "S22": unicorn.arm_const.UC_ARM_REG_S22, "S23": unicorn.arm_const.UC_ARM_REG_S23,
-                             "S24": unicorn.arm_const.UC_ARM_REG_S24, "S25": unicorn.arm_const.UC_ARM_REG_S25,
-                             "S26": unicorn.arm_const.UC_ARM_REG_S26, "S27": unicorn.arm_const.UC_ARM_REG_S27,
-                             "S28": unicorn.arm_const.UC_ARM_REG_S28, "S29": unicorn.arm_const.UC_ARM_REG_S29,
-                             "S30": unicorn.arm_const.UC_ARM_REG_S30, "S31": unicorn.arm_const.UC_ARM_REG_S31}
-                self.regs.update({"arg1": unicorn.arm_const.UC_ARM_REG_R0, "arg2": unicorn.arm_const.UC_ARM_REG_R1,
-                                  "arg3": unicorn.arm_const.UC_ARM_REG_R2, "arg4": unicorn.arm_const.UC_ARM_REG_R3})
             else:
                 logging.debug(
                     "sample contains code for unsupported processor architecture")
@@ -882,170 +1916,492 @@ class EmuHelper():
                 "sample contains code for unsupported processor architecture")
             return
 
-        # naive API hooks
-        self.apiHooks = {}
-        self.apiHooks["GetProcessHeap"] = self._returnHandleHook
-        self.apiHooks["HeapCreate"] = self._returnHandleHook
-        self.apiHooks["HeapAlloc"] = self._allocMem3Hook
-        self.apiHooks["HeapReAlloc"] = self._heapReAllocHook
-        self.apiHooks["RtlAllocateHeap"] = self._allocMem3Hook
-        self.apiHooks["AllocateHeap"] = self._allocMem1Hook
-        
-        # ignore LMEM_MOVEABLE flag, return mem ptr anyway, have Lock return ptr param
-        self.apiHooks["LocalAlloc"] = self._allocMem2Hook
-        self.apiHooks["LocalLock"] = self._returnParam1Hook
-        self.apiHooks["GlobalAlloc"] = self._allocMem2Hook
-        self.apiHooks["GlobalLock"] = self._returnParam1Hook
-        
-        # these ignore flags for now
-        self.apiHooks["LocalReAlloc"] = self._reallocHook
-        self.apiHooks["GlobalReAlloc"] = self._reallocHook
-        
-        self.apiHooks["VirtualAlloc"] = self._virtualAllocHook
-        self.apiHooks["VirtualAllocEx"] = self._virtualAllocExHook
-        self.apiHooks["malloc"] = self._allocMem1Hook
-        self.apiHooks["calloc"] = self._callocHook
-        self.apiHooks["realloc"] = self._reallocHook
-        self.apiHooks["memcpy"] = self._memcpyHook
-        self.apiHooks["memmove"] = self._memcpyHook
-        self.apiHooks["strlen"] = self._strlenHook
-        self.apiHooks["lstrlenA"] = self._strlenHook
-        self.apiHooks["strnlen"] = self._strnlenHook
-        self.apiHooks["strnlen_s"] = self._strnlenHook
-        self.apiHooks["strcmp"] = self._strcmpHook
-        self.apiHooks["lstrcmpA"] = self._strcmpHook
-        self.apiHooks["strncmp"] = self._strncmpHook
-        self.apiHooks["stricmp"] = self._stricmpHook
-        self.apiHooks["lstrcmpiA"] = self._stricmpHook
-        self.apiHooks["strnicmp"] = self._strnicmpHook
-        self.apiHooks["wcscmp"] = self._wcscmpHook
-        self.apiHooks["lstrcmpW"] = self._wcscmpHook
-        self.apiHooks["wcsncmp"] = self._wcsncmpHook
-        self.apiHooks["wcsicmp"] = self._wcsicmpHook
-        self.apiHooks["lstrcmpiW"] = self._wcsicmpHook
-        self.apiHooks["wcsnicmp"] = self._wcsnicmpHook
-        self.apiHooks["mbscmp"] = self._strcmpHook
-        self.apiHooks["mbsncmp"] = self._strncmpHook
-        self.apiHooks["mbsicmp"] = self._stricmpHook
-        self.apiHooks["mbsnicmp"] = self._strnicmpHook
-        self.apiHooks["strcpy"] = self._strcpyHook
-        self.apiHooks["strncpy"] = self._strncpyHook
-        self.apiHooks["lstrcpyA"] = self._strcpyHook
-        self.apiHooks["lstrcpynA"] = self._strncpyHook
-        self.apiHooks["strncpy_s"] = self._strncpysHook
-        self.apiHooks["wcscpy"] = self._wcscpyHook
-        self.apiHooks["wcsncpy"] = self._wcsncpyHook
-        self.apiHooks["lstrcpyW"] = self._wcscpyHook
-        self.apiHooks["lstrcpynW"] = self._wcsncpyHook
-        self.apiHooks["wcsncpy_s"] = self._wcsncpysHook
-        self.apiHooks["mbscpy"] = self._strcpyHook
-        self.apiHooks["mbsncpy"] = self._strncpyHook
-        self.apiHooks["mbsncpy_s"] = self._strncpysHook
-        self.apiHooks["memchr"] = self._memchrHook
-        self.apiHooks["strchr"] = self._strchrHook
-        self.apiHooks["wcschr"] = self._wcschrHook
-        self.apiHooks["mbschr"] = self._strchrHook
-        self.apiHooks["strrchr"] = self._strrchrHook
-        self.apiHooks["wcsrchr"] = self._wcsrchrHook
-        self.apiHooks["mbsrchr"] = self._strrchrHook
-        self.apiHooks["wcslen"] = self._wcslenHook
-        self.apiHooks["lstrlenW"] = self._wcslenHook
-        self.apiHooks["mbslen"] = self._strlenHook
-        self.apiHooks["mbstrlen"] = self._strlenHook
-        self.apiHooks["wcsnlen"] = self._wcsnlenHook
-        self.apiHooks["wcsnlen_s"] = self._wcsnlenHook
-        self.apiHooks["mbsnlen"] = self._strnlenHook
-        self.apiHooks["mbstrnlen"] = self._strnlenHook
-        self.apiHooks["strcat"] = self._strcatHook
-        self.apiHooks["lstrcatA"] = self._strcatHook
-        self.apiHooks["strncat"] = self._strncatHook
-        self.apiHooks["wcscat"] = self._wcscatHook
-        self.apiHooks["lstrcatW"] = self._wcscatHook
-        self.apiHooks["wcsncat"] = self._wcsncatHook
-        self.apiHooks["mbscat"] = self._strcatHook
-        self.apiHooks["mbsncat"] = self._strncatHook
-        self.apiHooks["strlwr"] = self._strlwrHook
-        self.apiHooks["strupr"] = self._struprHook
-        self.apiHooks["wcslwr"] = self._wcslwrHook
-        self.apiHooks["wcsupr"] = self._wcsuprHook
-        self.apiHooks["mbslwr"] = self._strlwrHook
-        self.apiHooks["mbsupr"] = self._struprHook
-        self.apiHooks["strdup"] = self._strdupHook
-        self.apiHooks["wcsdup"] = self._wcsdupHook
-        self.apiHooks["mbsdup"] = self._strdupHook
-        self.apiHooks["mbtowc"] = self._mbtowcHook
-        self.apiHooks["mbstowcs"] = self._mbstowcsHook
-        self.apiHooks["wctomb"] = self._wctombHook
-        self.apiHooks["wcstombs"] = self._wcstombsHook
-        self.apiHooks["MultiByteToWideChar"] = self._multiByteToWideCharHook
-        self.apiHooks["WideCharToMultiByte"] = self._wideCharToMultiByteHook
-        self.apiHooks["memset"] = self._memsetHook
-        self.apiHooks["ZeroMemory"] = self._bzeroHook
-        self.apiHooks["bzero"] = self._bzeroHook
-        
-        # builtins
-        self.apiHooks["umodsi3"] = self._modHook
-        
+        # naive API hooks, see API_HOOKS. they are resolved once per class and stored unbound, _handleApiHooks passes
+        # self to them
+        if self.__class__ not in API_HOOK_TABLES:
+            API_HOOK_TABLES[self.__class__] = dict((name, getattr(self.__class__, method))
+                                                   for name, method in self.API_HOOKS.items())
+        self.apiHookTable = API_HOOK_TABLES[self.__class__]
+        self.apiHooks = dict(self.apiHookTable)
+
         self.allocMap = {}
-        
+
+        tablesKey = (self.arch, self.mode, self.filetype)
+        if tablesKey not in ARCH_TABLES:
+            self._buildRegs()
+            self.canonicalRegs = self._getCanonicalRegs()
+            self._buildRegAccessors()
+            ARCH_TABLES[tablesKey] = (self.regs, self.canonicalRegs, self.regAccessors, self.stateLayout,
+                                      self.stateRegs)
+        regs, self.canonicalRegs, self.regAccessors, self.stateLayout, self.stateRegs = ARCH_TABLES[tablesKey]
+        self.regs = dict(regs)
+
+        if self.pooled and self._checkoutEngine():
+            return
+
         # Initialize emulator
         mu = unicorn.Uc(self.arch, self.mode)
         logging.debug("initialized emulator for %s with %s architecture in %s mode" % (
             self.filetype, arch, mode))
         self.uc = mu
+        if self.arch == unicorn.UC_ARCH_ARM:
+            self._buildThumbMap()
         if self.arch == unicorn.UC_ARCH_ARM or self.arch == unicorn.UC_ARCH_ARM64:
             self._enableVFP()
+        self._saveCleanContext()
+
+    # takes a released emulator for this binary from ENGINE_POOL, returns False if there is none
+    def _checkoutEngine(self):
+        self.engineKey = (self.arch, self.mode, idautils.GetInputFileMD5(), self.lazyLoad, self.imagePath,
+                          self.maxStackSize)
+        engine = ENGINE_POOL.checkout(self.engineKey)
+        if engine is None:
+            return False
+        for name in ENGINE_STATE:
+            setattr(self, name, engine[name])
+        self.engineReused = True
+        logging.debug("reusing pooled emulator")
+        return True
+
+    # returns the emulator of a pooled EmuHelper to ENGINE_POOL so that the next pooled EmuHelper for this binary can
+    # use it without loading the binary. the emulator is restored to its freshly loaded state first, the EmuHelper
+    # cannot be used for emulation afterwards
+    def release(self):
+        if not self.pooled or self.uc is None:
+            return
+        self.disableIDBSync()
+        self.resetEmuHooks()
+        self.restoreBinary()
+        # the write hooks call into this EmuHelper, the next one installs its own
+        for h in self.h_binarywritehooks:
+            self.uc.hook_del(h)
+        self.h_binarywritehooks = []
+        self.uc.context_restore(self.cleanContext)
+        ENGINE_POOL.checkin(self.engineKey, dict((name, getattr(self, name)) for name in ENGINE_STATE))
+        self.uc = None
 
     # unmap all emulator memory
     def resetEmulatorMemory(self):
         for region in self.uc.mem_regions():
             self.uc.mem_unmap(region[0], region[1] - region[0] + 1)
+        self._invalidateMemExtents()
 
     def resetEmulatorHeapAndStack(self):
+        self.autoMappedBytes = 0
         for region in self.uc.mem_regions():
-            if region[0] != self.baseAddr:
+            if not self._isBinaryAddr(region[0]):
                 self.uc.mem_unmap(region[0], region[1] - region[0] + 1)
                 logging.debug("unmapped %s to %s" % (
                     self.hexString(region[0]), self.hexString(region[1])))
+        self._invalidateMemExtents()
+        self._buildAddressSpace()
         self._buildStack()
 
     # reset emulator memory and rewrite binary segments to emulator memory, build new stack
     def reloadBinary(self):
         self.resetEmulatorMemory()
+        self.autoMappedBytes = 0
         baseAddr = idc.get_inf_attr(idc.INF_MIN_EA)
         endAddr = idc.get_inf_attr(idc.INF_MAX_EA)
         self.baseAddr = baseAddr
         memsize = endAddr - baseAddr
         memsize = self.pageAlignUp(memsize)
-        # map all binary segments as one memory region for easier management
-        self.uc.mem_map(baseAddr & self.pageMask, memsize)
+        self.binaryEnd = (baseAddr & self.pageMask) + memsize
+        self.deferredSegPages = set()
+        self.binaryRegions = self._getBinaryRegions()
+        self.binaryRegionStarts = [region[0] for region in self.binaryRegions]
+        self._buildAddressSpace()
+        self.pristinePages = {}
+        if self.lazyLoad:
+            # segments are mapped a page at a time by _loadLazyPages as they are accessed
+            self.lazyPages = set()
+            self._updateLazySegments()
+            if self.imagePath is not None and self.imageFile is None:
+                self.imageFile = open(self.imagePath, "rb")
+            self._buildStack()
+            return
+        # map each run of adjacent segments on its own so that segments far apart, as in memory dumps and kernel
+        # images, do not reserve the address space between them
+        for start, end in self.binaryRegions:
+            self.uc.mem_map(start, end - start)
         for segVA in idautils.Segments():
             segName = idc.get_segm_name(segVA)
             endVA = idc.get_segm_end(segVA)
-            segSizeTotal = endVA - segVA
             segSize = self.getSegSize(segVA, endVA)
             logging.debug("bytes in seg: %s" % self.hexString(segSize))
             logging.debug("mapping segment %s: %s - %s" %
                           (segName, self.hexString(segVA), self.hexString(endVA)))
-            if segSize > 0:
-                segBytes = idc.get_bytes(segVA, segSize, False)
-                self.uc.mem_write(segVA, segBytes)
-            segLeftover = segSizeTotal - segSize
-            if segLeftover > 0:
-                self.uc.mem_write(segVA + segSize, "\x00" * segLeftover)
+            self._writeSegment(segVA, endVA, segSize)
 
         self._buildStack()
 
+    # writes the bytes of the segment segVA..endVA from the IDB to emulator memory, of which segSize are initialized
+    # and the rest are zeroed
+    def _writeSegment(self, segVA, endVA, segSize):
+        if segSize > 0:
+            segBytes = idc.get_bytes(segVA, segSize, False)
+            self.uc.mem_write(segVA, segBytes)
+        segLeftover = endVA - segVA - segSize
+        if segLeftover > 0:
+            self.uc.mem_write(segVA + segSize, "\x00" * segLeftover)
+
+    # writes the contents of the binary's segments, as they would be mapped into emulator memory, to a file that can be
+    # passed as imagePath to load pages from in lazyLoad mode
+    def exportBinaryImage(self, path):
+        imageBase = self.baseAddr & self.pageMask
+        with open(path, "wb") as f:
+            for segVA in idautils.Segments():
+                endVA = idc.get_segm_end(segVA)
+                segSize = self.getSegSize(segVA, endVA)
+                f.seek(segVA - imageBase)
+                if segSize > 0:
+                    f.write(idc.get_bytes(segVA, segSize, False))
+                f.write("\x00" * (endVA - segVA - segSize))
+            f.truncate(self.binaryEnd - imageBase)
+
+    def _updateLazySegments(self):
+        self.lazySegStarts = []
+        self.lazySegEnds = []
+        for segVA in idautils.Segments():
+            self.lazySegStarts.append(segVA)
+            self.lazySegEnds.append(idc.get_segm_end(segVA))
+        self._invalidateMemExtents()
+
+    # in lazyLoad mode, maps and loads every binary page in the range addr..addr+size that has not been loaded yet.
+    # returns True if any page was loaded
+    def _loadLazyPages(self, addr, size):
+        if not self.lazyLoad:
+            return False
+        loaded = False
+        for page in range(addr & self.pageMask, addr + max(size, 1), PAGESIZE):
+            if page in self.lazyPages or page in self.deferredSegPages:
+                continue
+            i = bisect.bisect_right(self.lazySegStarts, page + PAGESIZE - 1) - 1
+            if i < 0 or self.lazySegEnds[i] <= page:
+                continue
+            self.uc.mem_map(page, PAGESIZE)
+            self.lazyPages.add(page)
+            if self.imageFile is not None:
+                self.imageFile.seek(page - (self.baseAddr & self.pageMask))
+                self.uc.mem_write(page, self.imageFile.read(PAGESIZE))
+            else:
+                # a page may contain the end of one segment and the start of the next
+                while i >= 0 and self.lazySegEnds[i] > page:
+                    start = max(page, self.lazySegStarts[i])
+                    end = min(page + PAGESIZE, self.lazySegEnds[i])
+                    segSize = self.getSegSize(start, end)
+                    if segSize > 0:
+                        self.uc.mem_write(start, idc.get_bytes(start, segSize, False))
+                    i -= 1
+            logging.debug("loaded binary page %s" % self.hexString(page))
+            loaded = True
+        return loaded
+
+    # returns the page aligned (start, end) address ranges covered by the binary's segments, merging segments that
+    # share or adjoin pages. deferred segment pages are left out
+    def _getBinaryRegions(self):
+        regions = []
+        for segVA in idautils.Segments():
+            start = segVA & self.pageMask
+            end = self.pageAlignUp(idc.get_segm_end(segVA))
+            if regions and start <= regions[-1][1]:
+                regions[-1] = (regions[-1][0], max(regions[-1][1], end))
+            else:
+                regions.append((start, end))
+        if not self.deferredSegPages:
+            return regions
+        split = []
+        for start, end in regions:
+            for page in range(start, end, PAGESIZE):
+                if page in self.deferredSegPages:
+                    continue
+                if split and split[-1][1] == page:
+                    split[-1] = (split[-1][0], page + PAGESIZE)
+                else:
+                    split.append((page, page + PAGESIZE))
+        return split
+
+    # starts tracking the emulator's address space with only the binary's segments in use
+    def _buildAddressSpace(self):
+        self.addrSpace = EmuAddressSpace(1 << min(self.size_pointer * 8, 48))
+        for start, end in self.binaryRegions:
+            self.addrSpace.reserve(start, end, "binary")
+
+    # returns True if addr is in one of the binary's page aligned segment ranges
+    def _isBinaryAddr(self, addr):
+        i = bisect.bisect_right(self.binaryRegionStarts, addr) - 1
+        return i >= 0 and addr < self.binaryRegions[i][1]
+
+    # starts tracking writes to the memory the binary is loaded in so that restoreBinary can undo them. the hooks are
+    # bound to the binary's address ranges, so writes to the stack and heap do not cross into Python
+    def trackBinaryWrites(self):
+        if not self.h_binarywritehooks:
+            for start, end in self.binaryRegions:
+                self.h_binarywritehooks.append(self.uc.hook_add(unicorn.UC_HOOK_MEM_WRITE, self._hookBinaryWrite,
+                                                                None, start, end - 1))
+
+    # returns emulator memory to its freshly loaded state without reloading the binary from the IDB: pages of the
+    # binary written since trackBinaryWrites was called are restored, and heap and stack memory is unmapped and the
+    # stack rebuilt
+    def restoreBinary(self):
+        for page in self.pristinePages:
+            self.uc.mem_write(page, self.pristinePages[page])
+        self.pristinePages = {}
+        self.allocMap = {}
+        self.resetEmulatorHeapAndStack()
+
+    def _hookBinaryWrite(self, uc, access, address, size, value, userData):
+        self._saveBinaryPages(address, size)
+
+    # saves the original contents of each page of the binary in address..address+size the first time it is written to
+    def _saveBinaryPages(self, address, size):
+        for page in range(address & self.pageMask, address + size, PAGESIZE):
+            if page not in self.pristinePages and self._isBinaryAddr(page):
+                self.pristinePages[page] = str(self.uc.mem_read(page, PAGESIZE))
+
+    # writes data to emulator memory on behalf of flare-emu, e.g. from its API hooks. writes made with mem_write do
+    # not trigger unicorn's memory hooks, so the bookkeeping that hooks do for emulated writes is done here instead
+    def _writeEmuMem(self, addr, data):
+        self._loadLazyPages(addr, len(data))
+        if self.h_binarywritehooks:
+            self._saveBinaryPages(addr, len(data))
+        if self.pathSnapshots:
+            self._savePathSnapshotPages(addr, len(data))
+        if self.harvestHook is not None and self.emulating and data:
+            # e.g. a string built by an API hook, attributed to the call that ran it
+            self.harvestWrites[addr] = (len(data), self.uc.reg_read(self.regs["pc"]))
+        self.uc.mem_write(addr, data)
+
+    # keeps this EmuHelper in sync with changes made to the IDB in IDA so that it can be used for a long session without
+    # reloadBinary: patched bytes are written to emulator memory, and to the pages saved by trackBinaryWrites, and
+    # segments added or deleted are mapped or unmapped. paths cached for iterate are dropped for functions whose code
+    # or boundaries change, and the result cache is cleared when bytes change or API hook names are renamed
+    def enableIDBSync(self):
+        if self.idbHooks is None:
+            self.idbHooks = EmuIDBHooks(self)
+            self.idbHooks.hook()
+
+    def disableIDBSync(self):
+        if self.idbHooks is not None:
+            self.idbHooks.unhook()
+            self.idbHooks = None
+
+    def _syncPatchedByte(self, ea):
+        self._invalidateCode(ea)
+        self._invalidateResultCache()
+        if not self._isBinaryAddr(ea):
+            return
+        value = chr(idc.get_wide_byte(ea))
+        page = ea & self.pageMask
+        if page in self.pristinePages:
+            pristine = self.pristinePages[page]
+            self.pristinePages[page] = pristine[:ea - page] + value + pristine[ea - page + 1:]
+        if self.lazyLoad and page not in self.lazyPages:
+            if self.imageFile is None:
+                # the page will be loaded from the IDB, patch included, when it is first accessed
+                return
+            self._loadLazyPages(ea, 1)
+        self.uc.mem_write(ea, value)
+
+    def _invalidateFunc(self, funcStart):
+        if self.paths.pop(funcStart, None) is not None:
+            logging.debug("dropped cached paths for %s" % self.hexString(funcStart))
+
+    # drops the cached paths of every function with a chunk in ea..endEA, or at ea if endEA is not given
+    def _invalidateCode(self, ea, endEA=None):
+        if endEA is None:
+            endEA = ea + 1
+        chunk = idaapi.get_fchunk(ea)
+        if chunk is None:
+            chunk = idaapi.get_next_fchunk(ea)
+        while chunk is not None and chunk.start_ea < endEA:
+            # get_func returns the owner of a tail chunk
+            func = idaapi.get_func(chunk.start_ea)
+            if func is not None:
+                self._invalidateFunc(func.start_ea)
+            chunk = idaapi.get_next_fchunk(chunk.start_ea)
+
+    # drops the thumb interval map after IDA's T segment register ranges changed, isThumbMode rebuilds it when it is
+    # next needed
+    def _invalidateThumbMap(self):
+        if self.arch == unicorn.UC_ARCH_ARM:
+            self.thumbRangeStarts = None
+
+    # marks the result cache as out of date. it is cleared when it is next used, so that a batch of IDB changes, such
+    # as a patch of many bytes, clears it once
+    def _invalidateResultCache(self):
+        if self.resultCache is not None:
+            self.resultCacheStale = True
+
+    # returns True if calls to name are handled by one of the API hooks
+    def _isApiHookName(self, name):
+        return self._normalizeApiName(name) in self.apiHooks
+
+    # maps and loads a segment added to the IDB after the binary was loaded. pages already used by the stack or heap
+    # are left as they are and deferred, i.e. kept out of the binary's regions, until the next reloadBinary
+    def _addBinarySegment(self, segVA, endVA):
+        runs = []
+        skipped = set()
+        for page in range(segVA & self.pageMask, self.pageAlignUp(endVA), PAGESIZE):
+            if self._isBinaryAddr(page):
+                continue
+            if not self.addrSpace.isFree(page, page + PAGESIZE):
+                logging.debug("segment page %s is in use by emulator memory, not mapped" % self.hexString(page))
+                skipped.add(page)
+                continue
+            if runs and runs[-1][1] == page:
+                runs[-1][1] = page + PAGESIZE
+            else:
+                runs.append([page, page + PAGESIZE])
+        for start, end in runs:
+            self.addrSpace.reserve(start, end, "binary")
+            if not self.lazyLoad:
+                self.uc.mem_map(start, end - start)
+            if self.h_binarywritehooks:
+                self.h_binarywritehooks.append(self.uc.hook_add(unicorn.UC_HOOK_MEM_WRITE, self._hookBinaryWrite,
+                                                                None, start, end - 1))
+        self.deferredSegPages.update(skipped)
+        self._invalidateMemExtents()
+        self.binaryRegions = self._getBinaryRegions()
+        self.binaryRegionStarts = [region[0] for region in self.binaryRegions]
+        self._invalidateThumbMap()
+        if self.lazyLoad:
+            self._updateLazySegments()
+        elif not skipped:
+            self._writeSegment(segVA, endVA, self.getSegSize(segVA, endVA))
+        else:
+            for page in range(segVA & self.pageMask, endVA, PAGESIZE):
+                if page not in skipped:
+                    start = max(page, segVA)
+                    end = min(page + PAGESIZE, endVA)
+                    self._writeSegment(start, end, self.getSegSize(start, end))
+        logging.debug("mapped added segment %s - %s" % (self.hexString(segVA), self.hexString(endVA)))
+
+    # unmaps the pages of a segment deleted from the IDB that are not shared with another segment. their address
+    # range stays reserved until the next resetEmulatorHeapAndStack or reloadBinary
+    def _removeBinarySegment(self, segVA, endVA):
+        self.binaryRegions = self._getBinaryRegions()
+        self.binaryRegionStarts = [region[0] for region in self.binaryRegions]
+        self._invalidateThumbMap()
+        for page in range(segVA & self.pageMask, self.pageAlignUp(endVA), PAGESIZE):
+            if self._isBinaryAddr(page) or page in self.deferredSegPages:
+                # a deferred page holds stack or heap memory
+                continue
+            self.pristinePages.pop(page, None)
+            if self.lazyLoad:
+                if page not in self.lazyPages:
+                    continue
+                self.lazyPages.discard(page)
+            try:
+                self.uc.mem_unmap(page, PAGESIZE)
+            except unicorn.UcError:
+                logging.debug("segment page %s was not mapped" % self.hexString(page))
+        self._invalidateMemExtents()
+        if self.lazyLoad:
+            self._updateLazySegments()
+        logging.debug("unmapped deleted segment %s - %s" % (self.hexString(segVA), self.hexString(endVA)))
+
+    # enables caching of emulateRange results for runs that declare their outputs with cacheOutputs. at most
+    # maxEntries results are kept in memory, if path is given results are also persisted to a shelve database there
+    # and reused across sessions
+    def enableResultCache(self, maxEntries=4096, path=None):
+        self.disableResultCache()
+        self.resultCache = EmuResultCache(maxEntries, path)
+        self.resultCacheStale = False
+
+    def disableResultCache(self):
+        if self.resultCache is not None:
+            self.resultCache.close()
+            self.resultCache = None
+
+    # returns a digest of the inputs to an emulateRange run. string arguments contribute their contents, integer
+    # arguments that point to emulator memory also contribute up to CACHE_PTR_BYTES of the memory they point to
+    def _getResultCacheKey(self, startAddr, endAddr, registers, stack, cacheOutputs, options):
+        digest = hashlib.sha1()
+        digest.update(repr((idautils.GetInputFileMD5(), startAddr, endAddr, options, cacheOutputs)).encode("utf-8"))
+        args = [(reg, registers[reg]) for reg in sorted(registers)] + list(enumerate(stack))
+        for name, val in args:
+            digest.update(repr(name).encode("utf-8"))
+            if isinstance(val, (int, long)):
+                digest.update(repr(val).encode("utf-8"))
+                extent = self.getEmuMemExtent(val)
+                if extent > 0:
+                    val = self.getEmuBytes(val, min(extent, CACHE_PTR_BYTES))
+                else:
+                    continue
+            digest.update(repr(val).encode("utf-8"))
+        return digest.hexdigest()
+
+    # resolves the pointers of the (pointer, size) cacheOutputs entries once the emulator context has been prepared
+    # and before emulation runs, so that registers the emulated code clobbers still refer to the buffers passed in
+    def _getCacheOutputPtrs(self, registers, cacheOutputs):
+        ptrs = []
+        for output in cacheOutputs:
+            if not isinstance(output, tuple):
+                continue
+            ptr = output[0]
+            if isinstance(ptr, (int, long)):
+                ptrs.append(ptr)
+            elif ptr in registers:
+                ptrs.append(registers[ptr])
+            else:
+                ptrs.append(self.getRegVal(ptr))
+        return ptrs
+
+    def _getCachedOutputs(self, ptrs, cacheOutputs):
+        regNames = ["ret"] + [output for output in cacheOutputs if not isinstance(output, tuple)]
+        regVals = self.readRegs(regNames)
+        bufs = []
+        ptrs = iter(ptrs)
+        for output in cacheOutputs:
+            if isinstance(output, tuple):
+                ptr = next(ptrs)
+                if output[1] is None:
+                    buf = self._readEmuString(ptr)
+                    if buf is not None:
+                        buf += "\x00"
+                else:
+                    buf = self.getEmuBytes(ptr, output[1])
+                bufs.append(buf)
+        return (regVals, bufs)
+
+    def _applyCachedOutputs(self, entry, ptrs):
+        regVals, bufs = entry
+        self.writeRegs(regVals)
+        for ptr, buf in zip(ptrs, bufs):
+            if buf is not None:
+                self._writeEmuMem(ptr, buf)
+
+    # configures how accesses to unmapped memory are handled during emulation. read, write and fetch are one of
+    # "map", to map zeroed memory in chunkSize aligned chunks and continue, "stop", to stop emulation with a
+    # "memory fault" stopReason, or "skip", to skip the faulting instruction. once maxAutoMapped bytes have been
+    # mapped this way, further faults stop emulation. unspecified settings are left unchanged
+    def setMemFaultPolicy(self, read=None, write=None, fetch=None, chunkSize=None, maxAutoMapped=None):
+        settings = {"read": read, "write": write, "fetch": fetch, "chunkSize": chunkSize,
+                    "maxAutoMapped": maxAutoMapped}
+        for name in settings:
+            if settings[name] is not None:
+                self.memFaultPolicy[name] = settings[name]
+
+    # handles faults in the range start..start+size with action instead of memFaultPolicy. with the "map" action,
+    # the whole range is mapped on the first fault and content, if provided, is written at start, e.g. to provide a
+    # prebuilt TEB or PEB
+    def addMemFaultRange(self, start, size, content=None, action="map"):
+        self.memFaultRanges.append((start, start + size, content, action))
+
     # allocs mem and writes bytes into it
     def loadBytes(self, bytes, addr=None):
         mem = self.allocEmuMem(len(bytes), addr)
-        self.uc.mem_write(mem, bytes)
+        self._writeEmuMem(mem, bytes)
         return mem
 
     def isValidEmuPtr(self, ptr):
         for region in self.uc.mem_regions():
             if ptr >= region[0] and ptr < region[1]:
                 return True
+        if self.lazyLoad:
+            i = bisect.bisect_right(self.lazySegStarts, ptr) - 1
+            return i >= 0 and ptr < self.lazySegEnds[i]
         return False
         
     def getEmuMemRegion(self, addr):
@@ -1054,43 +2410,62 @@ class EmuHelper():
                 return (region[0], region[1] + 1)
         return None
         
-    # allocate emulator memory, attempts to honor specified address, otherwise begins allocations 
-    # at the next page
-    # aligned address above the highest, returns address, rebased if necessary
+    # allocate emulator memory, attempts to honor specified address, otherwise allocates in the
+    # smallest unused gap of the address space that fits, which may be between segments or left
+    # by freed allocations, returns address, rebased if necessary
     def allocEmuMem(self, size, addr=None):
         allocSize = self.pageAlignUp(size)
         if addr is None:
-            baseAddr = addr = self._findUnusedMemRegion()
+            baseAddr = addr = self._findFreeMem(allocSize)
         else:
-            isValid = True
             baseAddr = self.pageAlign(addr)
             offs = addr - baseAddr
-            for region in self.uc.mem_regions():
-                # if start or end of region falls in range of a previous region
-                if ((baseAddr >= region[0] and baseAddr < region[1]) or
-                        (baseAddr + allocSize >= region[0] and baseAddr + allocSize < region[1])):
-                    isValid = False
-                    break
-                # if region completely envelopes a previous region
-                if baseAddr < region[0] and baseAddr + allocSize > region[1]:
-                    isValid = False
-                    break
-            if isValid is False:
-                baseAddr = self._findUnusedMemRegion()
+            allocSize = self.pageAlignUp(offs + size)
+            if not self.addrSpace.isFree(baseAddr, baseAddr + allocSize):
+                baseAddr = self._findFreeMem(allocSize)
                 addr = baseAddr + offs
         logging.debug("mapping %s bytes @%s" %
                       (self.hexString(allocSize), self.hexString(baseAddr)))
         self.uc.mem_map(baseAddr, allocSize)
+        self._invalidateMemExtents()
+        self.addrSpace.reserve(baseAddr, baseAddr + allocSize, "alloc")
         return addr
+
+    # returns the address of a free range of size bytes in the emulator's address space, raises MemoryError if there
+    # is none
+    def _findFreeMem(self, size):
+        addr = self.addrSpace.findFree(size)
+        if addr is None:
+            raise MemoryError("no free range of %s bytes left in the emulator's address space" %
+                              self.hexString(size))
+        return addr
+
+    # unmaps memory allocated with allocEmuMem so that its address range can be reused. returns False if addr is not
+    # in an allocation
+    def freeEmuMem(self, addr):
+        used = self.addrSpace.getUsed(addr)
+        if used is None or used[2] != "alloc":
+            logging.debug("no allocation to free @%s" % self.hexString(addr))
+            return False
+        logging.debug("unmapping %s bytes @%s" % (self.hexString(used[1] - used[0]), self.hexString(used[0])))
+        # a path snapshot maps the allocation again if it was taken before the free, with these contents
+        self._savePathSnapshotPages(used[0], used[1] - used[0])
+        self.uc.mem_unmap(used[0], used[1] - used[0])
+        self._invalidateMemExtents()
+        self.addrSpace.release(used[0])
+        for allocAddr in list(self.allocMap):
+            if self.allocMap[allocAddr][0] >= used[0] and self.allocMap[allocAddr][0] < used[1]:
+                del self.allocMap[allocAddr]
+        return True
      
     
     def copyEmuMem(self, dstAddr, srcAddr, size, userData):
         size = self._checkMemSize(size, userData)
         try:
-            mem = str(self.uc.mem_read(srcAddr, size))
-            self.uc.mem_write(dstAddr, mem)
+            mem = self.getEmuBytes(srcAddr, size)
+            self._writeEmuMem(dstAddr, mem)
         except Exception as e:
-            logging.debug("exception in copyEmuMem @%s: %s" % (self.hexString(address), str(e)))
+            logging.debug("exception in copyEmuMem @%s: %s" % (self.hexString(dstAddr), str(e)))
         
     def getCallTargetName(self, address):
         if idc.get_operand_type(address, 0) == 1:
@@ -1106,52 +2481,37 @@ class EmuHelper():
     # we don't know the number of args to a given function and we're not considering SSE args
     # this is just a convenience, use the emulator object if you have specific needs
     def getArgv(self):
-        if self.arch == unicorn.UC_ARCH_X86:
-            if self.mode == unicorn.UC_MODE_64:
-                if self.filetype == "MACHO" or self.filetype == "ELF":
-                    argv = [
-                        self.getRegVal("rdi"),
-                        self.getRegVal("rsi"),
-                        self.getRegVal("rdx"),
-                        self.getRegVal("rcx"),
-                        self.getRegVal("r8"),
-                        self.getRegVal("r9")]
-                else:
-                    argv = [
-                        self.getRegVal("rcx"),
-                        self.getRegVal("rdx"),
-                        self.getRegVal("r8"),
-                        self.getRegVal("r9")]
+        if self.arch == unicorn.UC_ARCH_X86 and self.mode == unicorn.UC_MODE_32:
+            sp = self.getRegVal("esp")
+            argv = list(struct.unpack("<6I", str(self.uc.mem_read(sp, 24))))
+        elif self.arch == unicorn.UC_ARCH_X86:
+            if self.filetype == "MACHO" or self.filetype == "ELF":
+                argRegs = ["rdi", "rsi", "rdx", "rcx", "r8", "r9"]
             else:
-                sp = self.getRegVal("esp")
-                argv = [
-                    struct.unpack("<I", str(self.uc.mem_read(sp, 4)))[0],
-                    struct.unpack("<I", str(self.uc.mem_read(sp + 4, 4)))[0],
-                    struct.unpack("<I", str(self.uc.mem_read(sp + 8, 4)))[0],
-                    struct.unpack("<I", str(self.uc.mem_read(sp + 12, 4)))[0],
-                    struct.unpack("<I", str(self.uc.mem_read(sp + 16, 4)))[0],
-                    struct.unpack("<I", str(self.uc.mem_read(sp + 20, 4)))[0]]
+                argRegs = ["rcx", "rdx", "r8", "r9"]
         elif self.arch == unicorn.UC_ARCH_ARM:
-            argv = [
-                self.getRegVal("R0"),
-                self.getRegVal("R1"),
-                self.getRegVal("R2"),
-                self.getRegVal("R3")]
+            argRegs = ["R0", "R1", "R2", "R3"]
         elif self.arch == unicorn.UC_ARCH_ARM64:
-            argv = [
-                self.getRegVal("X0"),
-                self.getRegVal("X1"),
-                self.getRegVal("X2"),
-                self.getRegVal("X3"),
-                self.getRegVal("X4"),
-                self.getRegVal("X5"),
-                self.getRegVal("X6"),
-                self.getRegVal("X7")]
+            argRegs = ["X0", "X1", "X2", "X3", "X4", "X5", "X6", "X7"]
         else:
-            argv = None
-                
+            return None
+
+        if self.arch != unicorn.UC_ARCH_X86 or self.mode == unicorn.UC_MODE_64:
+            regVals = self.readRegs(argRegs)
+            argv = [regVals[reg] for reg in argRegs]
         return argv
- 
+
+    # returns the number of writable bytes at the destination buffer argv[idx] of an API hook, allocating a buffer
+    # of size bytes and updating argv[idx] if the destination does not exist
+    def _getHookDstExtent(self, address, argv, idx, size, funcName):
+        self._loadLazyPages(argv[idx], size)
+        extent = self.getEmuMemExtent(argv[idx])
+        if extent == 0:
+            logging.debug("dest memory does not exist for %s @%s" % (funcName, self.hexString(address)))
+            argv[idx] = self.allocEmuMem(size)
+            extent = self.pageAlignUp(size)
+        return extent
+
     def _checkMemSize(self, size, userData):
         if size > MAX_ALLOC_SIZE:
             logging.debug("allocation size (%s) truncated @%s" % 
@@ -1244,59 +2604,80 @@ class EmuHelper():
         self.allocMap[allocAddr] = (memAddr, allocSize)
         self.uc.reg_write(self.regs["ret"], memAddr)
         
+    def _freeHook(self, address, argv, funcName, userData):
+        self.freeEmuMem(argv[0])
+
+    def _heapFreeHook(self, address, argv, funcName, userData):
+        self.freeEmuMem(argv[2])
+        self.uc.reg_write(self.regs["ret"], 1)
+
+    # returns NULL on success
+    def _localFreeHook(self, address, argv, funcName, userData):
+        self.freeEmuMem(argv[0])
+        self.uc.reg_write(self.regs["ret"], 0)
+
+    # only MEM_RELEASE frees the allocation, decommitted memory stays mapped
+    def _virtualFreeHook(self, address, argv, funcName, userData):
+        MEM_RELEASE = 0x8000
+        if argv[2] & MEM_RELEASE:
+            self.freeEmuMem(argv[0])
+        self.uc.reg_write(self.regs["ret"], 1)
+
     def _memcpyHook(self, address, argv, funcName, userData):
         copySize = argv[2]
         copySize = self._checkMemSize(copySize, userData)
-        srcRegion = self.getEmuMemRegion(argv[1])
-        dstRegion = self.getEmuMemRegion(argv[0])
-        if dstRegion is None:
-            logging.debug("dest memory does not exist for memcpy @%s" % self.hexString(address))
-            dstRegion = self.getEmuMemRegion(self.allocEmuMem(copySize))
-            argv[0] = dstRegion[0]
-        if srcRegion is None:
+        srcExtent = self.getEmuMemExtent(argv[1])
+        dstExtent = self._getHookDstExtent(address, argv, 0, copySize, funcName)
+        if srcExtent == 0:
             logging.debug("source memory does not exist for memcpy @%s" % self.hexString(address))
         else:
-            if copySize <= srcRegion[1] - argv[1] and copySize <= dstRegion[1] - argv[0]:
+            if copySize <= srcExtent and copySize <= dstExtent:
                 self.copyEmuMem(argv[0], argv[1], copySize, userData)
             else:
                 logging.debug("dest memory not large enough @%s" % self.hexString(address))
         self.uc.reg_write(self.regs["ret"], argv[0])
-        
+
     def _strlenHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            self.uc.reg_write(self.regs["ret"], len(self.getEmuString(argv[0])))
+        s = self._readEmuString(argv[0])
+        if s is not None:
+            self.uc.reg_write(self.regs["ret"], len(s))
         else:
             self.uc.reg_write(self.regs["ret"], 0)
-            
+
     def _wcslenHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            self.uc.reg_write(self.regs["ret"], len(self.getEmuWideString(argv[0]).decode("utf-16")))
+        s = self._readEmuString(argv[0], 2)
+        if s is not None:
+            self.uc.reg_write(self.regs["ret"], len(s) // 2)
         else:
             self.uc.reg_write(self.regs["ret"], 0)
-    
+
     def _strnlenHook(self, address, argv, funcName, userData):
         strnlen = self._checkMemSize(argv[1], userData)
-        if self.isValidEmuPtr(argv[0]):
-            strlen = len(self.getEmuString(argv[0]))
-            strlen = min(strlen, strnlen)
-            self.uc.reg_write(self.regs["ret"], strlen)
+        s = self._readEmuString(argv[0], maxLen=strnlen)
+        if s is not None:
+            self.uc.reg_write(self.regs["ret"], len(s))
         else:
             self.uc.reg_write(self.regs["ret"], 0)
-            
+
     def _wcsnlenHook(self, address, argv, funcName, userData):
         strnlen = self._checkMemSize(argv[1], userData)
-        if self.isValidEmuPtr(argv[0]):
-            strlen = len(self.getEmuWideString(argv[0]).decode("utf-16"))
-            if strlen > strnlen:
-                strlen = argv[1]
-            self.uc.reg_write(self.regs["ret"], strnlen)
+        s = self._readEmuString(argv[0], 2, strnlen)
+        if s is not None:
+            self.uc.reg_write(self.regs["ret"], len(s) // 2)
         else:
             self.uc.reg_write(self.regs["ret"], 0)
-    
-    def _strcmpHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]) and self.isValidEmuPtr(argv[1]):
-            str1 = self.getEmuString(argv[1])
-            str2 = self.getEmuString(argv[0])
+
+    # shared implementation of the str*cmp and wcs*cmp family, returns 0 on a match and -1 otherwise
+    def _cmpStrings(self, argv, width=1, maxLen=None, ignoreCase=False):
+        str1 = self._readEmuString(argv[1], width, maxLen)
+        str2 = self._readEmuString(argv[0], width, maxLen)
+        if str1 is not None and str2 is not None:
+            if width == 2:
+                str1 = str1.decode("utf-16")
+                str2 = str2.decode("utf-16")
+            if ignoreCase:
+                str1 = str1.lower()
+                str2 = str2.lower()
             if str1 == str2:
                 self.uc.reg_write(self.regs["ret"], 0)
                 return
@@ -1305,136 +2686,58 @@ class EmuHelper():
         else:
             val = 0xffffffff
         self.uc.reg_write(self.regs["ret"], val)
-        
+
+    def _strcmpHook(self, address, argv, funcName, userData):
+        self._cmpStrings(argv)
+
     def _strncmpHook(self, address, argv, funcName, userData):
-        strnlen = self._checkMemSize(argv[2], userData)
-        if self.isValidEmuPtr(argv[0]) and self.isValidEmuPtr(argv[1]):
-            str1 = self.getEmuString(argv[1])
-            str2 = self.getEmuString(argv[0])
-            if str1[:strnlen] == str2[:strnlen]:
-                self.uc.reg_write(self.regs["ret"], 0)
+        self._cmpStrings(argv, maxLen=self._checkMemSize(argv[2], userData))
+
+    def _stricmpHook(self, address, argv, funcName, userData):
+        self._cmpStrings(argv, ignoreCase=True)
+
+    def _strnicmpHook(self, address, argv, funcName, userData):
+        self._cmpStrings(argv, maxLen=self._checkMemSize(argv[2], userData), ignoreCase=True)
+
+    def _wcscmpHook(self, address, argv, funcName, userData):
+        self._cmpStrings(argv, 2)
+
+    def _wcsncmpHook(self, address, argv, funcName, userData):
+        self._cmpStrings(argv, 2, self._checkMemSize(argv[2], userData))
+
+    def _wcsicmpHook(self, address, argv, funcName, userData):
+        self._cmpStrings(argv, 2, ignoreCase=True)
+
+    def _wcsnicmpHook(self, address, argv, funcName, userData):
+        self._cmpStrings(argv, 2, self._checkMemSize(argv[2], userData), True)
+
+    def _strcpyHook(self, address, argv, funcName, userData):
+        src = self._readEmuString(argv[1])
+        if src is not None:
+            src += "\x00"
+            dstExtent = self._getHookDstExtent(address, argv, 0, len(src), funcName)
+            if len(src) <= dstExtent:
+                self._writeEmuMem(argv[0], src)
+                self.uc.reg_write(self.regs["ret"], argv[0])
                 return
+            else:
+                logging.debug("dest memory not large enough @%s" % self.hexString(address))
+
         if self.size_pointer == 8:
             val = 0xffffffffffffffff
         else:
             val = 0xffffffff
         self.uc.reg_write(self.regs["ret"], val)
-        
-    def _stricmpHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]) and self.isValidEmuPtr(argv[1]):
-            str1 = self.getEmuString(argv[1])
-            str2 = self.getEmuString(argv[0])
-            if str1.lower() == str2.lower():
-                self.uc.reg_write(self.regs["ret"], 0)
-                return
-        if self.size_pointer == 8:
-            val = 0xffffffffffffffff
-        else:
-            val = 0xffffffff
-        self.uc.reg_write(self.regs["ret"], val)
-        
-    def _strnicmpHook(self, address, argv, funcName, userData):
-        strnlen = self._checkMemSize(argv[2], userData)
-        if self.isValidEmuPtr(argv[0]) and self.isValidEmuPtr(argv[1]):
-            str1 = self.getEmuString(argv[1])
-            str2 = self.getEmuString(argv[0])
-            if str1[:strnlen].lower() == str2[:strnlen].lower():
-                self.uc.reg_write(self.regs["ret"], 0)
-                return
-        if self.size_pointer == 8:
-            val = 0xffffffffffffffff
-        else:
-            val = 0xffffffff
-        self.uc.reg_write(self.regs["ret"], val)
-        
-    def _wcscmpHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]) and self.isValidEmuPtr(argv[1]):
-            str1 = self.getEmuWideString(argv[1]).decode("utf-16")
-            str2 = self.getEmuWideString(argv[0]).decode("utf-16")
-            if str1 == str2:
-                self.uc.reg_write(self.regs["ret"], 0)
-                return
-        if self.size_pointer == 8:
-            val = 0xffffffffffffffff
-        else:
-            val = 0xffffffff
-        self.uc.reg_write(self.regs["ret"], val)
-        
-    def _wcsncmpHook(self, address, argv, funcName, userData):
-        strnlen = self._checkMemSize(argv[2], userData)
-        if self.isValidEmuPtr(argv[0]) and self.isValidEmuPtr(argv[1]):
-            str1 = self.getEmuWideString(argv[1]).decode("utf-16")
-            str2 = self.getEmuWideString(argv[0]).decode("utf-16")
-            if str1[:strnlen] == str2[:strnlen]:
-                self.uc.reg_write(self.regs["ret"], 0)
-                return
-        if self.size_pointer == 8:
-            val = 0xffffffffffffffff
-        else:
-            val = 0xffffffff
-        self.uc.reg_write(self.regs["ret"], val)
-        
-    def _wcsicmpHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]) and self.isValidEmuPtr(argv[1]):
-            str1 = self.getEmuWideString(argv[1]).decode("utf-16")
-            str2 = self.getEmuWideString(argv[0]).decode("utf-16")
-            if str1.lower() == str2.lower():
-                self.uc.reg_write(self.regs["ret"], 0)
-                return
-        if self.size_pointer == 8:
-            val = 0xffffffffffffffff
-        else:
-            val = 0xffffffff
-        self.uc.reg_write(self.regs["ret"], val)
-        
-    def _wcsnicmpHook(self, address, argv, funcName, userData):
-        strnlen = self._checkMemSize(argv[2], userData)
-        if self.isValidEmuPtr(argv[0]) and self.isValidEmuPtr(argv[1]):
-            str1 = self.getEmuWideString(argv[1]).decode("utf-16")
-            str2 = self.getEmuWideString(argv[0]).decode("utf-16")
-            if str1[:strnlen].lower() == str2[:strnlen].lower():
-                self.uc.reg_write(self.regs["ret"], 0)
-                return
-        if self.size_pointer == 8:
-            val = 0xffffffffffffffff
-        else:
-            val = 0xffffffff
-        self.uc.reg_write(self.regs["ret"], val)
-        
-    def _strcpyHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            src = self.getEmuString(argv[1]) + "\x00"
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for strcpy @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(len(src)))
-                argv[0] = dstRegion[0]
-            if len(src) <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], src)
-                self.uc.reg_write(self.regs["ret"], argv[0])
-                return
-            else:
-                logging.debug("dest memory not large enough @%s" % self.hexString(address))
 
-        if self.size_pointer == 8:
-            val = 0xffffffffffffffff
-        else:
-            val = 0xffffffff
-        self.uc.reg_write(self.regs["ret"], val)
-        
     def _strncpyHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            strnlen = self._checkMemSize(argv[2], userData)
-            src = self.getEmuString(argv[1])
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for strncpy @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(strnlen))
-                argv[0] = dstRegion[0]
-            if strnlen <= dstRegion[1] - argv[0]:
+        strnlen = self._checkMemSize(argv[2], userData)
+        src = self._readEmuString(argv[1], maxLen=strnlen)
+        if src is not None:
+            dstExtent = self._getHookDstExtent(address, argv, 0, strnlen, funcName)
+            if strnlen <= dstExtent:
                 if strnlen > len(src):
                     src = src.ljust(strnlen, "\x00")
-                self.uc.mem_write(argv[0], src)
+                self._writeEmuMem(argv[0], src)
                 self.uc.reg_write(self.regs["ret"], argv[0])
                 return
             else:
@@ -1445,20 +2748,14 @@ class EmuHelper():
         else:
             val = 0xffffffff
         self.uc.reg_write(self.regs["ret"], val)
-        
+
     def _strncpysHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[2]):
-            strnlen = self._checkMemSize(argv[3], userData)
-            src = self.getEmuString(argv[2])
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for strncpy_s @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(strnlen))
-                argv[0] = dstRegion[0]
-            
-            strnlen = min(strnlen, len(src))
-            if strnlen + 1 <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], src + "\x00")
+        strnlen = self._checkMemSize(argv[3], userData)
+        src = self._readEmuString(argv[2], maxLen=strnlen)
+        if src is not None:
+            dstExtent = self._getHookDstExtent(address, argv, 0, strnlen, funcName)
+            if len(src) + 1 <= dstExtent:
+                self._writeEmuMem(argv[0], src + "\x00")
                 self.uc.reg_write(self.regs["ret"], 0)
                 return
             else:
@@ -1469,17 +2766,14 @@ class EmuHelper():
         else:
             val = 0xffffffff
         self.uc.reg_write(self.regs["ret"], val)
-       
+
     def _wcscpyHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            src = self.getEmuWideString(argv[1]) + "\x00\x00"
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for wcscpy @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(len(src)))
-                argv[0] = dstRegion[0]
-            if len(src) <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], src)
+        src = self._readEmuString(argv[1], 2)
+        if src is not None:
+            src += "\x00\x00"
+            dstExtent = self._getHookDstExtent(address, argv, 0, len(src), funcName)
+            if len(src) <= dstExtent:
+                self._writeEmuMem(argv[0], src)
                 self.uc.reg_write(self.regs["ret"], argv[0])
                 return
             else:
@@ -1490,20 +2784,16 @@ class EmuHelper():
         else:
             val = 0xffffffff
         self.uc.reg_write(self.regs["ret"], val)
-        
+
     def _wcsncpyHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            strnlen = self._checkMemSize(argv[2] * 2, userData)
-            src = self.getEmuWideString(argv[1])
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for wcsncpy @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(strnlen))
-                argv[0] = dstRegion[0]
-            if strnlen <= dstRegion[1] - argv[0]:
+        strnlen = self._checkMemSize(argv[2] * 2, userData)
+        src = self._readEmuString(argv[1], 2, strnlen // 2)
+        if src is not None:
+            dstExtent = self._getHookDstExtent(address, argv, 0, strnlen, funcName)
+            if strnlen <= dstExtent:
                 if strnlen > len(src):
                     src = src.ljust(strnlen, "\x00")
-                self.uc.mem_write(argv[0], src)
+                self._writeEmuMem(argv[0], src)
                 self.uc.reg_write(self.regs["ret"], argv[0])
                 return
             else:
@@ -1514,20 +2804,14 @@ class EmuHelper():
         else:
             val = 0xffffffff
         self.uc.reg_write(self.regs["ret"], val)
-        
+
     def _wcsncpysHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[2]):
-            strnlen = self._checkMemSize(argv[3] * 2, userData)
-            src = self.getEmuWideString(argv[2])
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for wcsncpy_s @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(strnlen))
-                argv[0] = dstRegion[0]
-                
-            strnlen = min(strnlen, len(src))
-            if strnlen + 2 <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], src[:strnlen] + "\x00\x00")
+        strnlen = self._checkMemSize(argv[3] * 2, userData)
+        src = self._readEmuString(argv[2], 2, strnlen // 2)
+        if src is not None:
+            dstExtent = self._getHookDstExtent(address, argv, 0, strnlen, funcName)
+            if len(src) + 2 <= dstExtent:
+                self._writeEmuMem(argv[0], src + "\x00\x00")
                 self.uc.reg_write(self.regs["ret"], 0)
                 return
             else:
@@ -1538,376 +2822,270 @@ class EmuHelper():
         else:
             val = 0xffffffff
         self.uc.reg_write(self.regs["ret"], val)
-    
+
     def _memchrHook(self, address, argv, funcName, userData):
-        dstRegion = self.getEmuMemRegion(argv[0])
-        if dstRegion is not None:
-            srch = chr(argv[1] & 0xFF)
-            srchlen = argv[2]
-            # truncate search to end of region
-            if argv[0] + srchlen > dstRegion[1]:
-                srchlen = dstRegion[1] - argv[0]
-            buf = str(self.uc.mem_read(argv[0], srchlen))
-            offs = buf.find(srch)
+        # truncate search to end of mapped memory
+        srchlen = min(argv[2], self.getEmuMemExtent(argv[0]))
+        if srchlen > 0:
+            buf = self.getEmuBytes(argv[0], srchlen)
+            offs = buf.find(chr(argv[1] & 0xFF))
             if offs > -1:
                 self.uc.reg_write(self.regs["ret"], argv[0] + offs)
                 return
-                
-        self.uc.reg_write(self.regs["ret"], 0)
-        
-    def _mbstowcsHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            bufSize = self._checkMemSize(argv[2] * 2, userData)
-            src = self.getEmuString(argv[1])
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for mbtowc variant @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(bufSize))
-                argv[0] = dstRegion[0]
-
-            if argv[2] > len(src):
-                src = src.ljust(argv[2], "\x00")
-            else:
-                src += "\x00"
-            if len(src.encode("utf-16")[2:]) <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], src.encode("utf-16")[2:])
-                self.uc.reg_write(self.regs["ret"], len(src))
-                return
-            else:
-                logging.debug("dest memory not large enough @%s" % self.hexString(address))
 
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _mbtowcHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            src = self.getEmuString(argv[1])[0]
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
+        src = self._readEmuString(argv[1], maxLen=1)
+        if src is not None:
+            if self.getEmuMemExtent(argv[0]) == 0:
                 logging.debug("dest memory does not exist for mbtowc variant @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(0x1000))
-                argv[0] = dstRegion[0]
-            self.uc.mem_write(argv[0], src.encode("utf-16")[2:4])
+                argv[0] = self.allocEmuMem(0x1000)
+            self._writeEmuMem(argv[0], src.ljust(1, "\x00").encode("utf-16")[2:4])
             self.uc.reg_write(self.regs["ret"], 1)
             return
 
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _mbstowcsHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
+        src = self._readEmuString(argv[1], maxLen=argv[2])
+        if src is not None:
             maxBufSize = self._checkMemSize(argv[2] * 2, userData)
-            src = self.getEmuString(argv[1])
             if len(src) < argv[2]:
                 src += "\x00"
-            else:
-                src = src[:argv[2]]
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for mbtowc variant @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(maxBufSize))
-                argv[0] = dstRegion[0]
-            if len(src) * 2 + 2 <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], src.encode("utf-16")[2:] + "\x00\x00")
+            dstExtent = self._getHookDstExtent(address, argv, 0, maxBufSize, "mbtowc variant")
+            if len(src) * 2 + 2 <= dstExtent:
+                self._writeEmuMem(argv[0], src.encode("utf-16")[2:] + "\x00\x00")
                 self.uc.reg_write(self.regs["ret"], len(src.replace("\x00", "")))
                 return
             else:
                 logging.debug("dest memory not large enough @%s" % self.hexString(address))
 
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _wctombHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            src = self.getEmuWideString(argv[1]).decode("utf-16")
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
+        src = self._readEmuString(argv[1], 2, 1)
+        if src is not None:
+            src = src.decode("utf-16")
+            if self.getEmuMemExtent(argv[0]) == 0:
                 logging.debug("dest memory does not exist for wctomb variant @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(0x1000))
-            argv[0] = dstRegion[0]
-            self.uc.mem_write(argv[0], src[0])
+                argv[0] = self.allocEmuMem(0x1000)
+            self._writeEmuMem(argv[0], str(src[:1]).ljust(1, "\x00"))
             self.uc.reg_write(self.regs["ret"], 1)
             return
 
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _wcstombsHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
+        src = self._readEmuString(argv[1], 2, argv[2])
+        if src is not None:
             bufSize = self._checkMemSize(argv[2], userData)
-            src = self.getEmuWideString(argv[1]).decode("utf-16")
+            src = src.decode("utf-16")
             if len(src) < argv[2]:
                 src += "\x00"
-            else:
-                src = src[:argv[2]]
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for wctomb variant @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(bufSize))
-                argv[0] = dstRegion[0]
-            if bufSize + 1 <= dstRegion[1] - argv[0]:
+            dstExtent = self._getHookDstExtent(address, argv, 0, bufSize, "wctomb variant")
+            if bufSize + 1 <= dstExtent:
                 if bufSize > len(src):
                     src = src.ljust(bufSize, "\x00")
-                self.uc.mem_write(argv[0], src + "\x00")
+                self._writeEmuMem(argv[0], str(src + "\x00"))
                 self.uc.reg_write(self.regs["ret"], len(src.replace("\x00", "")))
                 return
             else:
                 logging.debug("dest memory not large enough @%s" % self.hexString(address))
 
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _multiByteToWideCharHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[2]):
-            src = self.getEmuString(argv[2])
+        if argv[3] == -1:
+            src = self._readEmuString(argv[2])
+        else:
+            src = self._readEmuString(argv[2], maxLen=argv[3])
+        if src is not None:
             if argv[3] == -1:
                 src += "\x00"
                 maxBufSize = self._checkMemSize(len(src) * 2, userData)
             else:
                 maxBufSize = self._checkMemSize(argv[3] * 2, userData)
-            
+
             if len(src) < argv[3]:
                 src += "\x00"
-            elif argv[3] != -1:
-                src = src[:argv[3]]
-                
+
             if argv[5] == 0:
                 self.uc.reg_write(self.regs["ret"], len(src) * 2)
                 return
-            dstRegion = self.getEmuMemRegion(argv[4])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for mbtowc variant @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(maxBufSize))
-                argv[4] = dstRegion[0]
-            if len(src) * 2 + 2 <= dstRegion[1] - argv[4]:
-                self.uc.mem_write(argv[4], src.encode("utf-16")[2:] + "\x00\x00")
+            dstExtent = self._getHookDstExtent(address, argv, 4, maxBufSize, "mbtowc variant")
+            if len(src) * 2 + 2 <= dstExtent:
+                self._writeEmuMem(argv[4], src.encode("utf-16")[2:] + "\x00\x00")
                 self.uc.reg_write(self.regs["ret"], len(src))
                 return
             else:
                 logging.debug("dest memory not large enough @%s" % self.hexString(address))
 
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _wideCharToMultiByteHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[2]):
-            src = self.getEmuWideString(argv[2]).decode("utf-16")
+        if argv[3] == -1:
+            src = self._readEmuString(argv[2], 2)
+        else:
+            src = self._readEmuString(argv[2], 2, argv[3])
+        if src is not None:
+            src = src.decode("utf-16")
             if argv[3] == -1:
                 src += "\x00"
                 maxBufSize = self._checkMemSize(len(src), userData)
             else:
                 maxBufSize = self._checkMemSize(argv[3], userData)
-            
+
             if len(src) < argv[3]:
                 src += "\x00"
-            elif argv[3] != -1:
-                src = src[:argv[3]]
-                
+
             if argv[5] == 0:
                 self.uc.reg_write(self.regs["ret"], len(src))
                 return
-            dstRegion = self.getEmuMemRegion(argv[4])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for mbtowc variant @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(maxBufSize))
-                argv[4] = dstRegion[0]
-            if len(src) + 1 <= dstRegion[1] - argv[4]:
-                self.uc.mem_write(argv[4], src + "\x00")
+            dstExtent = self._getHookDstExtent(address, argv, 4, maxBufSize, "wctomb variant")
+            if len(src) + 1 <= dstExtent:
+                self._writeEmuMem(argv[4], str(src + "\x00"))
                 self.uc.reg_write(self.regs["ret"], len(src))
                 return
             else:
                 logging.debug("dest memory not large enough @%s" % self.hexString(address))
 
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _memsetHook(self, address, argv, funcName, userData):
         setSize = argv[2]
         setSize = self._checkMemSize(setSize, userData)
-        dstRegion = self.getEmuMemRegion(argv[0])
-        src = chr(argv[1] & 0xFF)
-        if dstRegion is None:
-            logging.debug("dest memory does not exist for memset @%s" % self.hexString(address))
-            dstRegion = self.getEmuMemRegion(self.allocEmuMem(setSize))
-            argv[0] = dstRegion[0]
-        if setSize <= dstRegion[1] - argv[0]:
-            self.uc.mem_write(argv[0], src * setSize)
+        dstExtent = self._getHookDstExtent(address, argv, 0, setSize, funcName)
+        if setSize <= dstExtent:
+            self._fillEmuMem(argv[0], argv[1] & 0xFF, setSize)
         else:
             logging.debug("dest memory not large enough @%s" % self.hexString(address))
         self.uc.reg_write(self.regs["ret"], argv[0])
-    
+
     def _bzeroHook(self, address, argv, funcName, userData):
         setSize = argv[1]
         setSize = self._checkMemSize(setSize, userData)
-        dstRegion = self.getEmuMemRegion(argv[0])
-        src = "\x00"
-        if dstRegion is None:
-            logging.debug("dest memory does not exist for memset @%s" % self.hexString(address))
-            dstRegion = self.getEmuMemRegion(self.allocEmuMem(setSize))
-            argv[0] = dstRegion[0]
-        if setSize <= dstRegion[1] - argv[0]:
-            self.uc.mem_write(argv[0], src * setSize)
+        dstExtent = self._getHookDstExtent(address, argv, 0, setSize, funcName)
+        if setSize <= dstExtent:
+            self._fillEmuMem(argv[0], 0, setSize)
         else:
             logging.debug("dest memory not large enough @%s" % self.hexString(address))
         self.uc.reg_write(self.regs["ret"], argv[0])
-        
-    def _strcatHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            src = self.getEmuString(argv[1]) + "\x00"
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for strcat @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(len(src) + 1))
-                argv[0] = dstRegion[0]
-            dst = self.getEmuString(argv[0])
-            if len(dst) + len(src) <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], dst + src)
+
+    # shared implementation of the str*cat and wcs*cat family, appends at most maxLen characters of the source
+    # string and a terminator to the destination string with a single write at the end of the destination string
+    def _catStrings(self, address, argv, funcName, width=1, maxLen=None):
+        term = "\x00" * width
+        src = self._readEmuString(argv[1], width, maxLen)
+        if src is not None:
+            src += term
+            dstExtent = self._getHookDstExtent(address, argv, 0, len(src), funcName)
+            dst = self._readEmuString(argv[0], width)
+            if dst is None:
+                dst = ""
+            if len(dst) + len(src) <= dstExtent:
+                self._writeEmuMem(argv[0] + len(dst), src)
                 self.uc.reg_write(self.regs["ret"], argv[0])
                 return
 
         self.uc.reg_write(self.regs["ret"], 0)
-                    
+
+    def _strcatHook(self, address, argv, funcName, userData):
+        self._catStrings(address, argv, funcName)
+
     def _strncatHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            strnlen = self._checkMemSize(argv[2], userData)
-            src = self.getEmuString(argv[1])
-            strnlen = min(strnlen, len(src))
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for strncat @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(strnlen + 1))
-                argv[0] = dstRegion[0]
-            dst = self.getEmuString(argv[0])
-            if len(dst) + strnlen + 1 <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], dst + src[:strnlen] + "\x00")
-                self.uc.reg_write(self.regs["ret"], argv[0])
-                return
+        self._catStrings(address, argv, funcName, maxLen=self._checkMemSize(argv[2], userData))
 
-        self.uc.reg_write(self.regs["ret"], 0)
-    
     def _wcscatHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            src = self.getEmuWideString(argv[1]) + "\x00\x00"
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for wcscat @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(len(src)))
-                argv[0] = dstRegion[0]
-            dst = self.getEmuWideString(argv[0])
-            if len(dst) + len(src) <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], dst + src)
-                self.uc.reg_write(self.regs["ret"], argv[0])
-                return
+        self._catStrings(address, argv, funcName, 2)
 
-        self.uc.reg_write(self.regs["ret"], 0)
-    
     def _wcsncatHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[1]):
-            strnlen = self._checkMemSize(argv[2], userData)
-            src = self.getEmuWideString(argv[1])
-            strnlen = min(strnlen * 2, len(src))
-            dstRegion = self.getEmuMemRegion(argv[0])
-            if dstRegion is None:
-                logging.debug("dest memory does not exist for wcsncat @%s" % self.hexString(address))
-                dstRegion = self.getEmuMemRegion(self.allocEmuMem(strnlen + 2))
-                argv[0] = dstRegion[0]
-            dst = self.getEmuWideString(argv[0])
-            if len(dst) + strnlen + 2 <= dstRegion[1] - argv[0]:
-                self.uc.mem_write(argv[0], dst + src[:strnlen] + "\x00\x00")
-                self.uc.reg_write(self.regs["ret"], argv[0])
+        self._catStrings(address, argv, funcName, 2, self._checkMemSize(argv[2], userData))
+
+    # shared implementation of the str*chr and wcs*chr family
+    def _findChar(self, argv, width=1, reverse=False):
+        s = self._readEmuString(argv[0], width)
+        if s is not None:
+            if width == 2:
+                s = s.decode("utf-16")
+            if reverse:
+                idx = s.rfind(chr(argv[1] & 0xFF))
+            else:
+                idx = s.find(chr(argv[1] & 0xFF))
+            if idx != -1:
+                self.uc.reg_write(self.regs["ret"], argv[0] + idx * width)
                 return
 
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _strchrHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuString(argv[0])
-            idx = s.find(chr(argv[1] & 0xFF))
-            if idx != -1:
-                self.uc.reg_write(self.regs["ret"], argv[0] + idx)
-                return
+        self._findChar(argv)
 
-        self.uc.reg_write(self.regs["ret"], 0)
-    
     def _wcschrHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuWideString(argv[0]).decode("utf-16")
-            idx = s.find(chr(argv[1] & 0xFF))
-            if idx != -1:
-                self.uc.reg_write(self.regs["ret"], argv[0] + idx * 2)
-                return
+        self._findChar(argv, 2)
 
-        self.uc.reg_write(self.regs["ret"], 0)
-    
     def _strrchrHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuString(argv[0])
-            idx = s.rfind(chr(argv[1] & 0xFF))
-            if idx != -1:
-                self.uc.reg_write(self.regs["ret"], argv[0] + idx)
-                return
-        
-        self.uc.reg_write(self.regs["ret"], 0)
-            
+        self._findChar(argv, reverse=True)
+
     def _wcsrchrHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuWideString(argv[0]).decode("utf-16")
-            idx = s.rfind(chr(argv[1] & 0xFF))
-            if idx != -1:
-                self.uc.reg_write(self.regs["ret"], argv[0] + idx * 2)
-                return
+        self._findChar(argv, 2, True)
 
-        self.uc.reg_write(self.regs["ret"], 0)
-        
     def _strlwrHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuString(argv[0])
-            self.uc.mem_write(argv[0], s.lower())
+        s = self._readEmuString(argv[0])
+        if s is not None:
+            self._writeEmuMem(argv[0], s.lower())
             self.uc.reg_write(self.regs["ret"], argv[0])
             return
-        
+
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _struprHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuString(argv[0])
-            self.uc.mem_write(argv[0], s.upper())
+        s = self._readEmuString(argv[0])
+        if s is not None:
+            self._writeEmuMem(argv[0], s.upper())
             self.uc.reg_write(self.regs["ret"], argv[0])
             return
-        
+
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _wcslwrHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuWideString(argv[0]).decode("utf-16")
-            self.uc.mem_write(argv[0], s.lower().encode("utf-16")[2:])
+        s = self._readEmuString(argv[0], 2)
+        if s is not None:
+            self._writeEmuMem(argv[0], s.decode("utf-16").lower().encode("utf-16")[2:])
             self.uc.reg_write(self.regs["ret"], argv[0])
             return
-        
+
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _wcsuprHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuWideString(argv[0]).decode("utf-16")
-            self.uc.mem_write(argv[0], s.upper().encode("utf-16")[2:])
+        s = self._readEmuString(argv[0], 2)
+        if s is not None:
+            self._writeEmuMem(argv[0], s.decode("utf-16").upper().encode("utf-16")[2:])
             self.uc.reg_write(self.regs["ret"], argv[0])
             return
-        
+
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _strdupHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuString(argv[0])
+        s = self._readEmuString(argv[0])
+        if s is not None:
             memAddr = self.allocEmuMem(len(s) + 1)
-            self.uc.mem_write(memAddr, s)
+            self._writeEmuMem(memAddr, s)
             self.uc.reg_write(self.regs["ret"], memAddr)
             return
-        
+
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _wcsdupHook(self, address, argv, funcName, userData):
-        if self.isValidEmuPtr(argv[0]):
-            s = self.getEmuWideString(argv[0])
+        s = self._readEmuString(argv[0], 2)
+        if s is not None:
             memAddr = self.allocEmuMem(len(s) + 2)
-            self.uc.mem_write(memAddr, s)
+            self._writeEmuMem(memAddr, s)
             self.uc.reg_write(self.regs["ret"], memAddr)
             return
-        
+
         self.uc.reg_write(self.regs["ret"], 0)
-        
+
     def _modHook(self, address, argv, funcName, userData):
         self.uc.reg_write(self.regs["ret"], argv[0] % argv[1])
         
@@ -1915,18 +3093,111 @@ class EmuHelper():
     # END API HOOKS
     ############################################
         
-    # maps null memory as requested during emulation
+    # handles accesses to unmapped memory during emulation as configured with setMemFaultPolicy and
+    # addMemFaultRange. each fault is counted in memFaults by faulting instruction and access type
     def _hookMemInvalid(self, uc, access, address, size, value, userData):
-        logging.debug("invalid memory operation for %s @%s" %
-                      (self.hexString(address), self.hexString(userData['currAddr'])))
+        if self._loadLazyPages(address, size):
+            return True
+        if self._growStack(address, userData):
+            return True
+        if access == unicorn.UC_MEM_FETCH_UNMAPPED:
+            accessType = "fetch"
+        elif access == unicorn.UC_MEM_WRITE_UNMAPPED:
+            accessType = "write"
+        else:
+            accessType = "read"
+        self.memFaults[(userData['currAddr'], accessType)] += 1
+        logging.debug("invalid memory %s for %s @%s" %
+                      (accessType, self.hexString(address), self.hexString(userData['currAddr'])))
+        action = self.memFaultPolicy[accessType]
+        content = None
+        for start, end, rangeContent, rangeAction in self.memFaultRanges:
+            if address >= start and address < end:
+                action = rangeAction
+                content = rangeContent
+                chunk = (start & self.pageMask, self.pageAlignUp(end))
+                break
+        else:
+            chunk = self._getMemFaultChunk(address)
+
+        if action == "map":
+            if self.autoMappedBytes + chunk[1] - chunk[0] > self.memFaultPolicy["maxAutoMapped"]:
+                logging.debug("auto mapped memory limit reached @%s" % self.hexString(userData['currAddr']))
+                action = "stop"
+            else:
+                try:
+                    # newly mapped memory is zeroed by unicorn
+                    uc.mem_map(chunk[0], chunk[1] - chunk[0])
+                    self._invalidateMemExtents()
+                    # the chunk can be in a range that is reserved but not mapped, which stays as it is
+                    self.addrSpace.reserveFree(chunk[0], chunk[1], "fault")
+                    if content is not None:
+                        uc.mem_write(start, content)
+                    self.autoMappedBytes += chunk[1] - chunk[0]
+                    return True
+                except Exception:
+                    action = "skip"
+        if action == "stop":
+            self.stopReason = "memory fault"
+            self.stopEmulation(userData)
+            return False
+        logging.debug("skipping invalid memory %s, changing IP from %s to %s" % (accessType, self.hexString(
+            userData['currAddr']), self.hexString(userData['currAddr'] + userData['currAddrSize'])))
+        uc.reg_write(
+            self.regs["pc"], userData['currAddr'] + userData['currAddrSize'])
+        return True
+
+    # returns the (start, end) range to map for a fault at address: the chunkSize aligned chunk containing it,
+    # trimmed to the free gap of the address space it is in
+    def _getMemFaultChunk(self, address):
+        chunkSize = self.memFaultPolicy["chunkSize"]
+        start = address - address % chunkSize
+        end = start + chunkSize
+        gap = self.addrSpace.getGap(address)
+        if gap is None:
+            return (address & self.pageMask, (address & self.pageMask) + PAGESIZE)
+        return (max(start, gap[0]), min(end, gap[1]))
+
+    # runs the emulator. a run stopped because memFaultPolicy says to stop on a memory fault is not an error
+    def _emuStart(self, begin, until, count=0):
+        if self.asyncJob is not None and self.asyncJob.cancelled:
+            logging.debug("async job cancelled before emulation started")
+            return
+        self.emulating = True
         try:
-            uc.mem_map(address & self.pageMask, PAGESIZE)
-            uc.mem_write(address & self.pageMask, "\x00" * PAGESIZE)
-        except Exception:
-            logging.debug("error writing to %s, changing IP from %s to %s" % (self.hexString(address), self.hexString(
-                userData['currAddr']), self.hexString(userData['currAddr'] + userData['currAddrSize'])))
-            uc.reg_write(
-                self.regs["pc"], userData['currAddr'] + userData['currAddrSize'])
+            self.uc.emu_start(begin, until, count=count)
+        except unicorn.UcError as e:
+            self._logTrace("emulation error: %s" % str(e))
+            if self.stopReason != "memory fault":
+                raise
+        else:
+            if self.stopReason is not None:
+                self._logTrace("emulation stopped: %s" % self.stopReason)
+        finally:
+            self.emulating = False
+            if self.harvestWrites:
+                self._harvestStrings()
+
+    # maps stack pages down to address when the stack grows into its reserved range. touching the guard page below
+    # the reserved range maps it so the faulting instruction can complete, then stops emulation with a stack overflow
+    # stopReason. returns True if the fault was in the stack's reserved range
+    def _growStack(self, address, userData):
+        if self.stackReserve is None or address < self.stackReserve[0] or address >= self.stackCommitted:
+            return False
+        guard = self.stackReserve[0]
+        if address < guard + PAGESIZE:
+            logging.debug("stack overflow @%s" % self.hexString(userData["currAddr"]))
+            self.uc.mem_map(guard, PAGESIZE)
+            self._invalidateMemExtents()
+            self.stackGuardMapped = True
+            self.stopReason = "stack overflow"
+            self.stopEmulation(userData)
+            return True
+        page = address & self.pageMask
+        logging.debug("growing stack to %s" % self.hexString(page))
+        self.uc.mem_map(page, self.stackCommitted - page)
+        self._invalidateMemExtents()
+        self.stackCommitted = page
         return True
 
     # cannot seem to move IP forward from this hook for some reason..
@@ -1934,24 +3205,38 @@ class EmuHelper():
     def _hookInterrupt(self, uc, intno, userData):
         logging.debug("interrupt #%d received @%s" % ((intno), self.hexString(userData["currAddr"])))
         if self.arch == unicorn.UC_ARCH_X86:
-            uc.mem_write(userData["currAddr"], X86NOP *
-                         userData["currAddrSize"])
+            self._writeEmuMem(userData["currAddr"], X86NOP * userData["currAddrSize"])
         elif self.arch == unicorn.UC_ARCH_ARM:
-            if self.mode == unicorn.UC_MODE_THUMB:
-                uc.mem_write(userData["currAddr"],
-                             ARMTHUMBNOP * (userData["currAddrSize"] / 2))
+            if self.isThumbMode(userData["currAddr"]):
+                self._writeEmuMem(userData["currAddr"], ARMTHUMBNOP * (userData["currAddrSize"] / 2))
             else:
-                uc.mem_write(
+                self._writeEmuMem(
                     userData["currAddr"], ARMNOP * (userData["currAddrSize"] / 4))
         elif self.arch == unicorn.UC_ARCH_ARM64:
-            uc.mem_write(
+            self._writeEmuMem(
                 userData["currAddr"], ARM64NOP * (userData["currAddrSize"] / 4))
         self.enteredBlock = False
         return True
 
     # handle common runtime functions
     def _handleApiHooks(self, address, argv, funcName, userData):
-        # normalize funcName
+        funcName = self._normalizeApiName(funcName)
+        if funcName not in self.apiHooks:
+            return False
+        hook = self.apiHooks[funcName]
+        try:
+            if hook is self.apiHookTable.get(funcName):
+                hook(self, address, argv, funcName, userData)
+            else:
+                hook(address, argv, funcName, userData)
+        except Exception as e:
+            logging.debug("error handling API hook: %s @%s" % (e, self.hexString(address)))
+            
+        self.skipInstruction(userData)
+        return True
+
+    # strips the decorations IDA Pro and runtimes add to function names, giving the name API hooks are looked up by
+    def _normalizeApiName(self, funcName):
         # remove appended _n from IDA Pro names
         funcName = re.sub(r"_[\d]+$", "", funcName)
             
@@ -1963,17 +3248,7 @@ class EmuHelper():
             funcName = funcName[2:]
 
         # remove prepended underscores
-        funcName = re.sub(r"^_+", "", funcName)
-        
-        if funcName not in self.apiHooks:
-            return False
-        try:
-            self.apiHooks[funcName](address, argv, funcName, userData)
-        except Exception as e:
-            logging.debug("error handling API hook: %s @%s" % (e, self.hexString(address)))
-            
-        self.skipInstruction(userData)
-        return True
+        return re.sub(r"^_+", "", funcName)
     
     # instruction hook used by emulateRange function
     # implements bare bones instrumentation to handle basic code flow
@@ -1981,11 +3256,6 @@ class EmuHelper():
         try:
             userData['currAddr'] = address
             userData['currAddrSize'] = size
-            if self.arch == unicorn.UC_ARCH_ARM and userData["changeThumbMode"]:
-                self._handleThumbMode(address)
-                userData["changeThumbMode"] = False
-                return
-
             if self.verbose > 0:
                 if self.verbose > 1:
                     logging.debug(self.getEmuState())
@@ -2001,7 +3271,7 @@ class EmuHelper():
                 self.skipInstruction(userData)
                 return
             # stop annoying run ons if we end up somewhere we dont belong
-            if str(self.uc.mem_read(address, size)) == "\x00" * size:
+            if self.getEmuBytes(address, size) == "\x00" * size:
                 logging.debug("pc ended up in null memory @%s" %
                               self.hexString(address))
                 self.stopEmulation(userData)
@@ -2013,11 +3283,6 @@ class EmuHelper():
                     userData["funcStart"]):
                 self.stopEmulation(userData)
                 return
-            elif self.isRetInstruction(address) and self.arch == unicorn.UC_ARCH_ARM:
-                # check mode of return address if ARM
-                retAddr = self.getEmuPtr(self.getRegVal("LR"))
-                if self.isThumbMode(retAddr):
-                    userData["changeThumbMode"] = True
 
             if (idc.print_insn_mnem(address) in self.callMnems or
                     (idc.print_insn_mnem(address) == "B" and
@@ -2030,11 +3295,10 @@ class EmuHelper():
                 if userData["callHook"]:
                     userData["callHook"](address, self.getArgv(), funcName, userData)
 
-                if self.arch == unicorn.UC_ARCH_ARM:
-                    userData["changeThumbMode"] = True
-                    
                 # if the pc has been changed by the hook, don't skip instruction and undo the change
                 if self.getRegVal("pc") != userData["currAddr"]:
+                    if self.arch == unicorn.UC_ARCH_ARM:
+                        self._setPC(self.getRegVal("pc"))
                     # get IDA's SP delta value for next instruction to adjust stack accordingly since we are skipping this
                     # instruction
                     uc.reg_write(self.regs["sp"], self.getRegVal("sp") +
@@ -2047,7 +3311,7 @@ class EmuHelper():
                 # skip calls if specified or there are no instructions to emulate at destination address
                 if (userData["skipCalls"] is True or
                         (idc.get_operand_type(address, 0) == 7 and
-                         str(uc.mem_read(idc.get_operand_value(address, 0), self.size_pointer)) ==
+                         self.getEmuBytes(idc.get_operand_value(address, 0), self.size_pointer) ==
                          "\x00" * self.size_pointer)):
                     self.skipInstruction(userData)
             # handle x86 instructions moving import pointers to a register
@@ -2055,7 +3319,7 @@ class EmuHelper():
                   idc.get_operand_type(address, 1) == 2 and 
                   idc.get_operand_type(address, 0) == 1 and
                   idc.print_operand(address, 1)[:3] == "ds:" and 
-                  str(uc.mem_read(idc.get_operand_value(address, 1), self.size_pointer)) ==
+                  self.getEmuBytes(idc.get_operand_value(address, 1), self.size_pointer) ==
                   "\x00" * self.size_pointer):
                   uc.reg_write(self.regs[idc.print_operand(address, 0)], idc.get_operand_value(address, 1))
                   self.skipInstruction(userData)
@@ -2063,8 +3327,49 @@ class EmuHelper():
         except Exception as err:
             logging.debug("exception in emulateRange_codehook @%s: %s" % (self.hexString(address), str(err)))
             print("exception in emulateRange_codehook @%s: %s" % (self.hexString(address), str(err)))
+            self._logTrace("exception in emulateRange_codehook")
             self.stopEmulation(userData)
 
+    # returns a list of addresses in the function starting at funcStart that _emulateRangeCodeHook must inspect when
+    # running in fastMode, along with whether the function contains any calls
+    def _getFastModeSites(self, funcStart):
+        sites = []
+        hasCalls = False
+        for addr in idautils.FuncItems(funcStart):
+            mnem = idc.print_insn_mnem(addr)
+            if mnem in self.callMnems:
+                hasCalls = True
+                sites.append(addr)
+            elif mnem == "B":
+                # branches to the start of a function are treated as calls
+                target = idc.get_operand_value(addr, 0)
+                if target == idc.get_func_attr(target, idc.FUNCATTR_START):
+                    hasCalls = True
+                    sites.append(addr)
+            elif mnem in ["jmp", "BR", "BREQ"] and idc.get_operand_type(addr, 0) == 1:
+                sites.append(addr)
+            elif (mnem == "mov" and idc.get_operand_type(addr, 1) == 2 and idc.get_operand_type(addr, 0) == 1 and
+                    idc.print_operand(addr, 1)[:3] == "ds:"):
+                sites.append(addr)
+        return sites, hasCalls
+
+    # code hook attached to individual call sites by fastMode
+    def _fastSiteHook(self, uc, address, size, userData):
+        self._emulateRangeCodeHook(uc, address, size, userData)
+
+    def _fastSentinelHook(self, uc, address, size, userData):
+        self.stopEmulation(userData)
+
+    # fastMode does not track the current instruction, recover it from the pc before handling the fault
+    def _fastHookMemInvalid(self, uc, access, address, size, value, userData):
+        userData["currAddr"] = self.getRegVal("pc")
+        userData["currAddrSize"] = idc.get_item_size(userData["currAddr"])
+        return self._hookMemInvalid(uc, access, address, size, value, userData)
+
+    def _fastHookInterrupt(self, uc, intno, userData):
+        logging.debug("interrupt #%d received in fastMode @%s, stopping" % (intno, self.hexString(self.getRegVal("pc"))))
+        self.stopEmulation(userData)
+
     # instruction hook used by emulateBytes function
     # implements bare bones instrumentation to handle basic code flow
     def _emulateBytesCodeHook(self, uc, address, size, userData):
@@ -2078,7 +3383,7 @@ class EmuHelper():
                     return
 
             # stop annoying run ons if we end up somewhere we dont belong
-            if str(self.uc.mem_read(address, 0x10)) == "\x00" * 0x10:
+            if self.getEmuBytes(address, 0x10) == "\x00" * 0x10:
                 self.stopEmulation(userData)
                 logging.debug("pc ended up in null memory @%s" %
                               self.hexString(address))
@@ -2087,6 +3392,7 @@ class EmuHelper():
         except Exception as err:
             logging.debug("exception in emulateBytes_codehook @%s: %s" % (self.hexString(address), str(err)))
             print("exception in emulateBytes_codehook @%s: %s" % (self.hexString(address), str(err)))
+            self._logTrace("exception in emulateBytes_codehook")
             self.stopEmulation(userData)
 
     # this instruction hook is used by the iterate feature, forces execution down a specified path
@@ -2094,10 +3400,6 @@ class EmuHelper():
         try:
             userData['currAddr'] = address
             userData['currAddrSize'] = size
-            if self.arch == unicorn.UC_ARCH_ARM and userData["changeThumbMode"]:
-                self._handleThumbMode(address)
-                userData["changeThumbMode"] = False
-                return
             if self.verbose > 0:
                 if self.verbose > 1:
                     logging.debug(self.getEmuState())
@@ -2125,11 +3427,7 @@ class EmuHelper():
                                   (self.blockIdx, self.hexString(bbStart), self.hexString(bbEnd),
                                    self.hexString(flow[paths[self.pathIdx][self.blockIdx + 1]][0])))
                     # force PC to follow paths
-                    uc.reg_write(self.regs["pc"], flow[paths[self.pathIdx][self.blockIdx + 1]][0])
-                    self.blockIdx += 1
-                    self.enteredBlock = False
-                    if self.arch == unicorn.UC_ARCH_ARM:
-                        userData["changeThumbMode"] = True
+                    self._forceNextBlock(flow, paths, userData)
                     return
                 else:
                     logging.debug(
@@ -2150,11 +3448,7 @@ class EmuHelper():
                                self.blockIdx, self.hexString(bbStart),
                                self.hexString(bbEnd), self.hexString(flow[paths[self.pathIdx][self.blockIdx + 1]][0])))
                 # force PC to follow paths
-                uc.reg_write(self.regs["pc"], flow[paths[self.pathIdx][self.blockIdx + 1]][0])
-                self.blockIdx += 1
-                self.enteredBlock = False
-                if self.arch == unicorn.UC_ARCH_ARM:
-                    userData["changeThumbMode"] = True
+                self._forceNextBlock(flow, paths, userData)
                 return
 
             if address == bbStart:
@@ -2170,7 +3464,7 @@ class EmuHelper():
                 return
 
             # stop annoying run ons if we end up somewhere we dont belong
-            if str(self.uc.mem_read(address, 0x10)) == "\x00" * 0x10:
+            if self.getEmuBytes(address, 0x10) == "\x00" * 0x10:
                 logging.debug("pc ended up in null memory @%s" %
                               self.hexString(address))
                 self.stopEmulation(userData)
@@ -2199,12 +3493,10 @@ class EmuHelper():
                 if userData["callHook"]:
                     userData["callHook"](address, self.getArgv(), funcName, userData)
 
-                
-                if self.arch == unicorn.UC_ARCH_ARM:
-                    userData["changeThumbMode"] = True
-
                 # if the pc has been changed by the hook, don't skip instruction and undo the change
                 if self.getRegVal("pc") != userData["currAddr"]:
+                    if self.arch == unicorn.UC_ARCH_ARM:
+                        self._setPC(self.getRegVal("pc"))
                     # get IDA's SP delta value for next instruction to adjust stack accordingly since we are skipping this
                     # instruction
                     uc.reg_write(self.regs["sp"], self.getRegVal("sp") +
@@ -2226,23 +3518,26 @@ class EmuHelper():
         except Exception as e:
             logging.debug("exception in _guidedHook @%s: %s" % (self.hexString(address), e))
             print("exception in _guidedHook @%s: %s" % (self.hexString(address), e))
+            self._logTrace("exception in _guidedHook")
             self.stopEmulation(userData)
 
+    # moves the pc to the start of the next block of the path being emulated. if the following path starts with the
+    # blocks emulated so far, the engine state is saved first so that it can resume from here
+    def _forceNextBlock(self, flow, paths, userData):
+        self.blockIdx += 1
+        if self.blockIdx <= userData["sharedBlocks"] and (not self.pathSnapshots or
+                                                           self.pathSnapshots[-1][0] < self.blockIdx):
+            logging.debug("saving engine state after %d basic blocks" % self.blockIdx)
+            self.pathSnapshots.append((self.blockIdx, self.uc.context_save(), {}, self._getPathSnapshotMem()))
+        self._setPC(flow[paths[self.pathIdx][self.blockIdx]][0])
+        self.enteredBlock = False
+
     # scans ahead from address until IDA finds an instruction
     def _scanForCode(self, address):
         while idc.print_insn_mnem(address) == "":
             address = idc.next_head(address, idc.get_inf_attr(idc.INF_MAX_EA))
         return address
 
-    # checks ARM mode for address and aligns address accordingly
-    def _handleThumbMode(self, address):
-        if self.isThumbMode(address):
-            self.uc.reg_write(self.regs["pc"], self.getRegVal("pc") | 1)
-            self.mode = unicorn.UC_MODE_THUMB
-        else:
-            self.uc.reg_write(self.regs["pc"], self.getRegVal("pc") & ~1)
-            self.mode = unicorn.UC_MODE_ARM
-
     # called when an iterate target is reached
     def _targetHit(self, address, userData):
         try:
@@ -2311,25 +3606,24 @@ class EmuHelper():
                 return r
         self.explorePaths[self.explorePathIdx].pop()
 
-    def _findUnusedMemRegion(self):
-        # start at 0x10000 to avoid collision with null mem references during emulation
-        highest = 0x10000
-        for region in self.uc.mem_regions():
-            if region[1] > highest:
-                highest = region[1]
-        for segVA in idautils.Segments():
-            endVA = idc.get_segm_end(segVA)
-            if endVA > highest:
-                highest = endVA
-        highest += PAGESIZE
-        return self.pageAlignUp(highest)
-
     # stack setup
-    # stack pointer will begin in the middle of allocated stack size
+    # reserves maxStackSize bytes below the stack pointer, a guard page below that and half of stackSize above it for
+    # stack arguments. only stackSize bytes centered on the stack pointer are mapped, _growStack maps the rest of the
+    # reserved range as the stack grows into it
     def _buildStack(self):
-        self.stack = self.allocEmuMem(self.stackSize) + self.stackSize / 2
-        self.uc.mem_write(self.stack - self.stackSize /
-                          2, "\x00" * self.stackSize)
+        self.stackGuardMapped = False
+        reserveSize = PAGESIZE + self.pageAlignUp(self.maxStackSize) + self.stackSize // 2
+        guard = self._findFreeMem(reserveSize)
+        self.stackReserve = (guard, guard + reserveSize)
+        self.addrSpace.reserve(guard, guard + reserveSize, "stack")
+        self.stack = guard + reserveSize - self.stackSize // 2
+        self.stackCommitted = self.stack - self.stackSize // 2
+        logging.debug("mapping stack %s bytes @%s" % (self.hexString(self.stackSize),
+                                                      self.hexString(self.stackCommitted)))
+        self.uc.mem_map(self.stackCommitted, self.stackSize)
+        self._invalidateMemExtents()
+        # return address planted by fastMode, emulation stops as soon as it is reached
+        self.sentinel = self.allocEmuMem(PAGESIZE)
 
     def _enableVFP(self):
         if self.arch == unicorn.UC_ARCH_ARM:
@@ -2354,41 +3648,314 @@ class EmuHelper():
             MSR  CPACR_EL1, X2
             NOP # <-- handle Unicorn bug
             """
+            if hasattr(unicorn.arm64_const, "UC_ARM64_REG_CPACR_EL1"):
+                tmp = self.uc.reg_read(unicorn.arm64_const.UC_ARM64_REG_CPACR_EL1)
+                self.uc.reg_write(unicorn.arm64_const.UC_ARM64_REG_CPACR_EL1, tmp | 0x300000)
+                return
             ENABLE_VFP_CODE = "\x42\x10\x38\xd5\x42\x04\x6c\xb2\x42\x10\x18\xd5\x1f\x20\x03\xd5"
-            self.emulateBytes(ENABLE_VFP_CODE)
+            # runs before the binary is loaded and the address space is tracked, so the code is run from a page that
+            # is mapped directly and unmapped again so the binary can be mapped there
+            self.uc.mem_map(0x400000, PAGESIZE)
+            self.uc.mem_write(0x400000, ENABLE_VFP_CODE)
+            self.uc.emu_start(0x400000, 0x400000 + len(ENABLE_VFP_CODE))
+            self.uc.mem_unmap(0x400000, PAGESIZE)
 
     # prepare thread context
     def _prepEmuContext(self, registers, stack):
         mu = self.uc
-        for reg in self.regs:
-            mu.reg_write(self.regs[reg], 0)
-        mu.reg_write(self.regs["sp"], self.stack)
+        self._resetEmuContext()
+        self.harvestedStrings = []
         for reg in registers:
             val = registers[reg]
             if isinstance(val, str):
                 mem = self.allocEmuMem(len(val))
-                mu.mem_write(mem, val)
+                self._writeEmuMem(mem, val)
                 val = mem
             elif isinstance(val, (int, long)):
                 pass
             else:
                 logging.debug("incorrect type for %s" % reg)
                 return None
-            mu.reg_write(self.regs[reg], val)
             registers[reg] = val
+        self.writeRegs(registers)
 
         # setup stack
         for i in range(0, len(stack)):
             if isinstance(stack[i], str):
                 mem = self.allocEmuMem(len(stack[i]))
-                mu.mem_write(mem, stack[i])
+                self._writeEmuMem(mem, stack[i])
                 stack[i] = mem
-                val = mem
-            elif isinstance(stack[i], (int, long)):
-                val = stack[i]
-            else:
+            elif not isinstance(stack[i], (int, long)):
                 logging.debug("incorrect type for stack[%d]" % (i))
                 return None
 
-            mu.mem_write(self.getRegVal("sp") + i *
-                         self.size_pointer, struct.pack(self.pack_fmt, val))
+        if len(stack) > 0:
+            # registers may have moved the stack pointer away from self.stack
+            self._writeEmuMem(self.getRegVal("sp"), struct.pack(self.pack_fmt[0] + self.pack_fmt[1] * len(stack), *stack))
+
+    # zeroes the cpu context and points the stack pointer at the emulated stack. restores the clean context captured
+    # at initialization if available, otherwise writes each canonical register
+    def _resetEmuContext(self):
+        self.stopReason = None
+        self.runCount += 1
+        if self.stackGuardMapped:
+            self.uc.mem_unmap(self.stackReserve[0], PAGESIZE)
+            self._invalidateMemExtents()
+            self.stackGuardMapped = False
+        if self.cleanContext is not None:
+            self.uc.context_restore(self.cleanContext)
+        else:
+            for reg in self.canonicalRegs:
+                self.uc.reg_write(reg, 0)
+        self.uc.reg_write(self.regs["sp"], self.stack)
+
+    # builds the register name table for the emulator's architecture, mode and filetype
+    def _buildRegs(self):
+        if self.arch == unicorn.UC_ARCH_X86:
+            if self.mode == unicorn.UC_MODE_64:
+                self.regs = {"ax": unicorn.x86_const.UC_X86_REG_RAX, "bx": unicorn.x86_const.UC_X86_REG_RBX,
+                             "cx": unicorn.x86_const.UC_X86_REG_RCX, "dx": unicorn.x86_const.UC_X86_REG_RDX,
+                             "di": unicorn.x86_const.UC_X86_REG_RDI, "si": unicorn.x86_const.UC_X86_REG_RSI,
+                             "bp": unicorn.x86_const.UC_X86_REG_RBP, "sp": unicorn.x86_const.UC_X86_REG_RSP,
+                             "ip": unicorn.x86_const.UC_X86_REG_RIP, "pc": unicorn.x86_const.UC_X86_REG_RIP,
+                             "rax": unicorn.x86_const.UC_X86_REG_RAX, "rbx": unicorn.x86_const.UC_X86_REG_RBX,
+                             "rcx": unicorn.x86_const.UC_X86_REG_RCX, "rdx": unicorn.x86_const.UC_X86_REG_RDX,
+                             "rdi": unicorn.x86_const.UC_X86_REG_RDI, "rsi": unicorn.x86_const.UC_X86_REG_RSI,
+                             "rbp": unicorn.x86_const.UC_X86_REG_RBP, "rsp": unicorn.x86_const.UC_X86_REG_RSP,
+                             "r8": unicorn.x86_const.UC_X86_REG_R8, "r9": unicorn.x86_const.UC_X86_REG_R9,
+                             "r10": unicorn.x86_const.UC_X86_REG_R10, "r11": unicorn.x86_const.UC_X86_REG_R11,
+                             "r12": unicorn.x86_const.UC_X86_REG_R12, "r13": unicorn.x86_const.UC_X86_REG_R13,
+                             "r14": unicorn.x86_const.UC_X86_REG_R14, "r15": unicorn.x86_const.UC_X86_REG_R15,
+                             "ret": unicorn.x86_const.UC_X86_REG_RAX}
+                if self.filetype == "PE":
+                    self.regs.update({"arg1": unicorn.x86_const.UC_X86_REG_RCX,
+                                      "arg2": unicorn.x86_const.UC_X86_REG_RDX,
+                                      "arg3": unicorn.x86_const.UC_X86_REG_R8,
+                                      "arg4": unicorn.x86_const.UC_X86_REG_R9})
+                elif self.filetype == "MACHO":
+                    self.regs.update({"arg1": unicorn.x86_const.UC_X86_REG_RDI,
+                                      "arg2": unicorn.x86_const.UC_X86_REG_RSI,
+                                      "arg3": unicorn.x86_const.UC_X86_REG_RDX,
+                                      "arg4": unicorn.x86_const.UC_X86_REG_RCX})
+                elif self.filetype == "ELF":
+                    self.regs.update({"arg1": unicorn.x86_const.UC_X86_REG_RDI,
+                                      "arg2": unicorn.x86_const.UC_X86_REG_RSI,
+                                      "arg3": unicorn.x86_const.UC_X86_REG_RDX,
+                                      "arg4": unicorn.x86_const.UC_X86_REG_RCX})
+                else:
+                    # assume PE for mem dumps
+                    self.regs.update({"arg1": unicorn.x86_const.UC_X86_REG_RCX,
+                                      "arg2": unicorn.x86_const.UC_X86_REG_RDX,
+                                      "arg3": unicorn.x86_const.UC_X86_REG_R8,
+                                      "arg4": unicorn.x86_const.UC_X86_REG_R9})
+            else:
+                self.regs = {"ax": unicorn.x86_const.UC_X86_REG_EAX, "bx": unicorn.x86_const.UC_X86_REG_EBX,
+                             "cx": unicorn.x86_const.UC_X86_REG_ECX, "dx": unicorn.x86_const.UC_X86_REG_EDX,
+                             "di": unicorn.x86_const.UC_X86_REG_EDI, "si": unicorn.x86_const.UC_X86_REG_ESI,
+                             "bp": unicorn.x86_const.UC_X86_REG_EBP, "sp": unicorn.x86_const.UC_X86_REG_ESP,
+                             "ip": unicorn.x86_const.UC_X86_REG_EIP, "pc": unicorn.x86_const.UC_X86_REG_EIP,
+                             "eax": unicorn.x86_const.UC_X86_REG_EAX, "ebx": unicorn.x86_const.UC_X86_REG_EBX,
+                             "ecx": unicorn.x86_const.UC_X86_REG_ECX, "edx": unicorn.x86_const.UC_X86_REG_EDX,
+                             "edi": unicorn.x86_const.UC_X86_REG_EDI, "esi": unicorn.x86_const.UC_X86_REG_ESI,
+                             "ebp": unicorn.x86_const.UC_X86_REG_EBP, "esp": unicorn.x86_const.UC_X86_REG_ESP,
+                             "ret": unicorn.x86_const.UC_X86_REG_EAX}
+        elif self.arch == unicorn.UC_ARCH_ARM64:
+            self.regs = {"R0": unicorn.arm64_const.UC_ARM64_REG_X0, "R1": unicorn.arm64_const.UC_ARM64_REG_X1,
+                         "R2": unicorn.arm64_const.UC_ARM64_REG_X2, "R3": unicorn.arm64_const.UC_ARM64_REG_X3,
+                         "R4": unicorn.arm64_const.UC_ARM64_REG_X4, "R5": unicorn.arm64_const.UC_ARM64_REG_X5,
+                         "R6": unicorn.arm64_const.UC_ARM64_REG_X6, "R7": unicorn.arm64_const.UC_ARM64_REG_X7,
+                         "R8": unicorn.arm64_const.UC_ARM64_REG_X8, "R9": unicorn.arm64_const.UC_ARM64_REG_X9,
+                         "R10": unicorn.arm64_const.UC_ARM64_REG_X10, "R11": unicorn.arm64_const.UC_ARM64_REG_X11,
+                         "R12": unicorn.arm64_const.UC_ARM64_REG_X12, "R13": unicorn.arm64_const.UC_ARM64_REG_X13,
+                         "R14": unicorn.arm64_const.UC_ARM64_REG_X14, "R15": unicorn.arm64_const.UC_ARM64_REG_X15,
+                         "X0": unicorn.arm64_const.UC_ARM64_REG_X0, "X1": unicorn.arm64_const.UC_ARM64_REG_X1,
+                         "X2": unicorn.arm64_const.UC_ARM64_REG_X2, "X3": unicorn.arm64_const.UC_ARM64_REG_X3,
+                         "X4": unicorn.arm64_const.UC_ARM64_REG_X4, "X5": unicorn.arm64_const.UC_ARM64_REG_X5,
+                         "X6": unicorn.arm64_const.UC_ARM64_REG_X6, "X7": unicorn.arm64_const.UC_ARM64_REG_X7,
+                         "X8": unicorn.arm64_const.UC_ARM64_REG_X8, "X9": unicorn.arm64_const.UC_ARM64_REG_X9,
+                         "X10": unicorn.arm64_const.UC_ARM64_REG_X10, "X11": unicorn.arm64_const.UC_ARM64_REG_X11,
+                         "X12": unicorn.arm64_const.UC_ARM64_REG_X12, "X13": unicorn.arm64_const.UC_ARM64_REG_X13,
+                         "X14": unicorn.arm64_const.UC_ARM64_REG_X14, "X15": unicorn.arm64_const.UC_ARM64_REG_X15,
+                         "X16": unicorn.arm64_const.UC_ARM64_REG_X16, "X17": unicorn.arm64_const.UC_ARM64_REG_X17,
+                         "X18": unicorn.arm64_const.UC_ARM64_REG_X18, "X19": unicorn.arm64_const.UC_ARM64_REG_X19,
+                         "X20": unicorn.arm64_const.UC_ARM64_REG_X20, "X21": unicorn.arm64_const.UC_ARM64_REG_X21,
+                         "X22": unicorn.arm64_const.UC_ARM64_REG_X22, "X23": unicorn.arm64_const.UC_ARM64_REG_X23,
+                         "X24": unicorn.arm64_const.UC_ARM64_REG_X24, "X25": unicorn.arm64_const.UC_ARM64_REG_X25,
+                         "X26": unicorn.arm64_const.UC_ARM64_REG_X26, "X27": unicorn.arm64_const.UC_ARM64_REG_X27,
+                         "X28": unicorn.arm64_const.UC_ARM64_REG_X28, "X29": unicorn.arm64_const.UC_ARM64_REG_X29,
+                         "X30": unicorn.arm64_const.UC_ARM64_REG_X30, "W0": unicorn.arm64_const.UC_ARM64_REG_X0,
+                         "W1": unicorn.arm64_const.UC_ARM64_REG_X1, "W2": unicorn.arm64_const.UC_ARM64_REG_X2,
+                         "W3": unicorn.arm64_const.UC_ARM64_REG_X3, "W4": unicorn.arm64_const.UC_ARM64_REG_X4,
+                         "W5": unicorn.arm64_const.UC_ARM64_REG_X5, "W6": unicorn.arm64_const.UC_ARM64_REG_X6,
+                         "W7": unicorn.arm64_const.UC_ARM64_REG_X7, "W8": unicorn.arm64_const.UC_ARM64_REG_X8,
+                         "W9": unicorn.arm64_const.UC_ARM64_REG_X9, "W10": unicorn.arm64_const.UC_ARM64_REG_X10,
+                         "W11": unicorn.arm64_const.UC_ARM64_REG_X11, "W12": unicorn.arm64_const.UC_ARM64_REG_X12,
+                         "W13": unicorn.arm64_const.UC_ARM64_REG_X13, "W14": unicorn.arm64_const.UC_ARM64_REG_X14,
+                         "W15": unicorn.arm64_const.UC_ARM64_REG_X15, "W16": unicorn.arm64_const.UC_ARM64_REG_X16,
+                         "W17": unicorn.arm64_const.UC_ARM64_REG_X17, "W18": unicorn.arm64_const.UC_ARM64_REG_X18,
+                         "W19": unicorn.arm64_const.UC_ARM64_REG_X19, "W20": unicorn.arm64_const.UC_ARM64_REG_X20,
+                         "W21": unicorn.arm64_const.UC_ARM64_REG_X21, "W22": unicorn.arm64_const.UC_ARM64_REG_X22,
+                         "W23": unicorn.arm64_const.UC_ARM64_REG_X23, "W24": unicorn.arm64_const.UC_ARM64_REG_X24,
+                         "W25": unicorn.arm64_const.UC_ARM64_REG_X25, "W26": unicorn.arm64_const.UC_ARM64_REG_X26,
+                         "W27": unicorn.arm64_const.UC_ARM64_REG_X27, "W28": unicorn.arm64_const.UC_ARM64_REG_X28,
+                         "W29": unicorn.arm64_const.UC_ARM64_REG_X29, "W30": unicorn.arm64_const.UC_ARM64_REG_X30,
+                         "PC": unicorn.arm64_const.UC_ARM64_REG_PC, "pc": unicorn.arm64_const.UC_ARM64_REG_PC,
+                         "LR": unicorn.arm64_const.UC_ARM64_REG_X30, "SP": unicorn.arm64_const.UC_ARM64_REG_SP,
+                         "sp": unicorn.arm64_const.UC_ARM64_REG_SP, "ret": unicorn.arm64_const.UC_ARM64_REG_X0,
+                         "S0": unicorn.arm64_const.UC_ARM64_REG_S0, "S1": unicorn.arm64_const.UC_ARM64_REG_S1,
+                         "S2": unicorn.arm64_const.UC_ARM64_REG_S2, "S3": unicorn.arm64_const.UC_ARM64_REG_S3,
+                         "S4": unicorn.arm64_const.UC_ARM64_REG_S4, "S5": unicorn.arm64_const.UC_ARM64_REG_S5,
+                         "S6": unicorn.arm64_const.UC_ARM64_REG_S6, "S7": unicorn.arm64_const.UC_ARM64_REG_S7,
+                         "S8": unicorn.arm64_const.UC_ARM64_REG_S8, "S9": unicorn.arm64_const.UC_ARM64_REG_S9,
+                         "S10": unicorn.arm64_const.UC_ARM64_REG_S10, "S11": unicorn.arm64_const.UC_ARM64_REG_S11,
+                         "S12": unicorn.arm64_const.UC_ARM64_REG_S12, "S13": unicorn.arm64_const.UC_ARM64_REG_S13,
+                         "S14": unicorn.arm64_const.UC_ARM64_REG_S14, "S15": unicorn.arm64_const.UC_ARM64_REG_S15,
+                         "S16": unicorn.arm64_const.UC_ARM64_REG_S16, "S17": unicorn.arm64_const.UC_ARM64_REG_S17,
+                         "S18": unicorn.arm64_const.UC_ARM64_REG_S18, "S19": unicorn.arm64_const.UC_ARM64_REG_S19,
+                         "S20": unicorn.arm64_const.UC_ARM64_REG_S20, "S21": unicorn.arm64_const.UC_ARM64_REG_S21,
+                         "S22": unicorn.arm64_const.UC_ARM64_REG_S22, "S23": unicorn.arm64_const.UC_ARM64_REG_S23,
+                         "S24": unicorn.arm64_const.UC_ARM64_REG_S24, "S25": unicorn.arm64_const.UC_ARM64_REG_S25,
+                         "S26": unicorn.arm64_const.UC_ARM64_REG_S26, "S27": unicorn.arm64_const.UC_ARM64_REG_S27,
+                         "S28": unicorn.arm64_const.UC_ARM64_REG_S28, "S29": unicorn.arm64_const.UC_ARM64_REG_S29,
+                         "S30": unicorn.arm64_const.UC_ARM64_REG_S30, "S31": unicorn.arm64_const.UC_ARM64_REG_S31,
+                         "D0": unicorn.arm64_const.UC_ARM64_REG_D0, "D1": unicorn.arm64_const.UC_ARM64_REG_D1,
+                         "D2": unicorn.arm64_const.UC_ARM64_REG_D2, "D3": unicorn.arm64_const.UC_ARM64_REG_D3,
+                         "D4": unicorn.arm64_const.UC_ARM64_REG_D4, "D5": unicorn.arm64_const.UC_ARM64_REG_D5,
+                         "D6": unicorn.arm64_const.UC_ARM64_REG_D6, "D7": unicorn.arm64_const.UC_ARM64_REG_D7,
+                         "D8": unicorn.arm64_const.UC_ARM64_REG_D8, "D9": unicorn.arm64_const.UC_ARM64_REG_D9,
+                         "D10": unicorn.arm64_const.UC_ARM64_REG_D10, "D11": unicorn.arm64_const.UC_ARM64_REG_D11,
+                         "D12": unicorn.arm64_const.UC_ARM64_REG_D12, "D13": unicorn.arm64_const.UC_ARM64_REG_D13,
+                         "D14": unicorn.arm64_const.UC_ARM64_REG_D14, "D15": unicorn.arm64_const.UC_ARM64_REG_D15,
+                         "D16": unicorn.arm64_const.UC_ARM64_REG_D16, "D17": unicorn.arm64_const.UC_ARM64_REG_D17,
+                         "D18": unicorn.arm64_const.UC_ARM64_REG_D18, "D19": unicorn.arm64_const.UC_ARM64_REG_D19,
+                         "D20": unicorn.arm64_const.UC_ARM64_REG_D20, "D21": unicorn.arm64_const.UC_ARM64_REG_D21,
+                         "D22": unicorn.arm64_const.UC_ARM64_REG_D22, "D23": unicorn.arm64_const.UC_ARM64_REG_D23,
+                         "D24": unicorn.arm64_const.UC_ARM64_REG_D24, "D25": unicorn.arm64_const.UC_ARM64_REG_D25,
+                         "D26": unicorn.arm64_const.UC_ARM64_REG_D26, "D27": unicorn.arm64_const.UC_ARM64_REG_D27,
+                         "D28": unicorn.arm64_const.UC_ARM64_REG_D28, "D29": unicorn.arm64_const.UC_ARM64_REG_D29,
+                         "D30": unicorn.arm64_const.UC_ARM64_REG_D30, "D31": unicorn.arm64_const.UC_ARM64_REG_D31,
+                         "H0": unicorn.arm64_const.UC_ARM64_REG_H0, "H1": unicorn.arm64_const.UC_ARM64_REG_H1,
+                         "H2": unicorn.arm64_const.UC_ARM64_REG_H2, "H3": unicorn.arm64_const.UC_ARM64_REG_H3,
+                         "H4": unicorn.arm64_const.UC_ARM64_REG_H4, "H5": unicorn.arm64_const.UC_ARM64_REG_H5,
+                         "H6": unicorn.arm64_const.UC_ARM64_REG_H6, "H7": unicorn.arm64_const.UC_ARM64_REG_H7,
+                         "H8": unicorn.arm64_const.UC_ARM64_REG_H8, "H9": unicorn.arm64_const.UC_ARM64_REG_H9,
+                         "H10": unicorn.arm64_const.UC_ARM64_REG_H10, "H11": unicorn.arm64_const.UC_ARM64_REG_H11,
+                         "H12": unicorn.arm64_const.UC_ARM64_REG_H12, "H13": unicorn.arm64_const.UC_ARM64_REG_H13,
+                         "H14": unicorn.arm64_const.UC_ARM64_REG_H14, "H15": unicorn.arm64_const.UC_ARM64_REG_H15,
+                         "H16": unicorn.arm64_const.UC_ARM64_REG_H16, "H17": unicorn.arm64_const.UC_ARM64_REG_H17,
+                         "H18": unicorn.arm64_const.UC_ARM64_REG_H18, "H19": unicorn.arm64_const.UC_ARM64_REG_H19,
+                         "H20": unicorn.arm64_const.UC_ARM64_REG_H20, "H21": unicorn.arm64_const.UC_ARM64_REG_H21,
+                         "H22": unicorn.arm64_const.UC_ARM64_REG_H22, "H23": unicorn.arm64_const.UC_ARM64_REG_H23,
+                         "H24": unicorn.arm64_const.UC_ARM64_REG_H24, "H25": unicorn.arm64_const.UC_ARM64_REG_H25,
+                         "H26": unicorn.arm64_const.UC_ARM64_REG_H26, "H27": unicorn.arm64_const.UC_ARM64_REG_H27,
+                         "H28": unicorn.arm64_const.UC_ARM64_REG_H28, "H29": unicorn.arm64_const.UC_ARM64_REG_H29,
+                         "H30": unicorn.arm64_const.UC_ARM64_REG_H30, "H31": unicorn.arm64_const.UC_ARM64_REG_H31,
+                         "Q0": unicorn.arm64_const.UC_ARM64_REG_Q0, "Q1": unicorn.arm64_const.UC_ARM64_REG_Q1,
+                         "Q2": unicorn.arm64_const.UC_ARM64_REG_Q2, "Q3": unicorn.arm64_const.UC_ARM64_REG_Q3,
+                         "Q4": unicorn.arm64_const.UC_ARM64_REG_Q4, "Q5": unicorn.arm64_const.UC_ARM64_REG_Q5,
+                         "Q6": unicorn.arm64_const.UC_ARM64_REG_Q6, "Q7": unicorn.arm64_const.UC_ARM64_REG_Q7,
+                         "Q8": unicorn.arm64_const.UC_ARM64_REG_Q8, "Q9": unicorn.arm64_const.UC_ARM64_REG_Q9,
+                         "Q10": unicorn.arm64_const.UC_ARM64_REG_Q10, "Q11": unicorn.arm64_const.UC_ARM64_REG_Q11,
+                         "Q12": unicorn.arm64_const.UC_ARM64_REG_Q12, "Q13": unicorn.arm64_const.UC_ARM64_REG_Q13,
+                         "Q14": unicorn.arm64_const.UC_ARM64_REG_Q14, "Q15": unicorn.arm64_const.UC_ARM64_REG_Q15,
+                         "Q16": unicorn.arm64_const.UC_ARM64_REG_Q16, "Q17": unicorn.arm64_const.UC_ARM64_REG_Q17,
+                         "Q18": unicorn.arm64_const.UC_ARM64_REG_Q18, "Q19": unicorn.arm64_const.UC_ARM64_REG_Q19,
+                         "Q20": unicorn.arm64_const.UC_ARM64_REG_Q20, "Q21": unicorn.arm64_const.UC_ARM64_REG_Q21,
+                         "Q22": unicorn.arm64_const.UC_ARM64_REG_Q22, "Q23": unicorn.arm64_const.UC_ARM64_REG_Q23,
+                         "Q24": unicorn.arm64_const.UC_ARM64_REG_Q24, "Q25": unicorn.arm64_const.UC_ARM64_REG_Q25,
+                         "Q26": unicorn.arm64_const.UC_ARM64_REG_Q26, "Q27": unicorn.arm64_const.UC_ARM64_REG_Q27,
+                         "Q28": unicorn.arm64_const.UC_ARM64_REG_Q28, "Q29": unicorn.arm64_const.UC_ARM64_REG_Q29,
+                         "Q30": unicorn.arm64_const.UC_ARM64_REG_Q30, "Q31": unicorn.arm64_const.UC_ARM64_REG_Q31}
+            self.regs.update({"arg1": unicorn.arm64_const.UC_ARM64_REG_X0,
+                              "arg2": unicorn.arm64_const.UC_ARM64_REG_X1,
+                              "arg3": unicorn.arm64_const.UC_ARM64_REG_X2,
+                              "arg4": unicorn.arm64_const.UC_ARM64_REG_X3})
+        else:
+            self.regs = {"R0": unicorn.arm_const.UC_ARM_REG_R0, "R1": unicorn.arm_const.UC_ARM_REG_R1,
+                         "R2": unicorn.arm_const.UC_ARM_REG_R2, "R3": unicorn.arm_const.UC_ARM_REG_R3,
+                         "R4": unicorn.arm_const.UC_ARM_REG_R4, "R5": unicorn.arm_const.UC_ARM_REG_R5,
+                         "R6": unicorn.arm_const.UC_ARM_REG_R6, "R7": unicorn.arm_const.UC_ARM_REG_R7,
+                         "R8": unicorn.arm_const.UC_ARM_REG_R8, "R9": unicorn.arm_const.UC_ARM_REG_R9,
+                         "R10": unicorn.arm_const.UC_ARM_REG_R10, "R11": unicorn.arm_const.UC_ARM_REG_R11,
+                         "R12": unicorn.arm_const.UC_ARM_REG_R12, "R13": unicorn.arm_const.UC_ARM_REG_R13,
+                         "R14": unicorn.arm_const.UC_ARM_REG_R14, "R15": unicorn.arm_const.UC_ARM_REG_R15,
+                         "PC": unicorn.arm_const.UC_ARM_REG_R15, "pc": unicorn.arm_const.UC_ARM_REG_R15,
+                         "LR": unicorn.arm_const.UC_ARM_REG_R14, "SP": unicorn.arm_const.UC_ARM_REG_R13,
+                         "sp": unicorn.arm_const.UC_ARM_REG_R13, "apsr": unicorn.arm_const.UC_ARM_REG_APSR,
+                         "APSR": unicorn.arm_const.UC_ARM_REG_APSR, "ret": unicorn.arm_const.UC_ARM_REG_R0,
+                         "S0": unicorn.arm_const.UC_ARM_REG_S0, "S1": unicorn.arm_const.UC_ARM_REG_S1,
+                         "S2": unicorn.arm_const.UC_ARM_REG_S2, "S3": unicorn.arm_const.UC_ARM_REG_S3,
+                         "S4": unicorn.arm_const.UC_ARM_REG_S4, "S5": unicorn.arm_const.UC_ARM_REG_S5,
+                         "S6": unicorn.arm_const.UC_ARM_REG_S6, "S7": unicorn.arm_const.UC_ARM_REG_S7,
+                         "S8": unicorn.arm_const.UC_ARM_REG_S8, "S9": unicorn.arm_const.UC_ARM_REG_S9,
+                         "S10": unicorn.arm_const.UC_ARM_REG_S10, "S11": unicorn.arm_const.UC_ARM_REG_S11,
+                         "S12": unicorn.arm_const.UC_ARM_REG_S12, "S13": unicorn.arm_const.UC_ARM_REG_S13,
+                         "S14": unicorn.arm_const.UC_ARM_REG_S14, "S15": unicorn.arm_const.UC_ARM_REG_S15,
+                         "S16": unicorn.arm_const.UC_ARM_REG_S16, "S17": unicorn.arm_const.UC_ARM_REG_S17,
+                         "S18": unicorn.arm_const.UC_ARM_REG_S18, "S19": unicorn.arm_const.UC_ARM_REG_S19,
+                         "S20": unicorn.arm_const.UC_ARM_REG_S20, "S21": unicorn.arm_const.UC_ARM_REG_S21,
+                         "S22": unicorn.arm_const.UC_ARM_REG_S22, "S23": unicorn.arm_const.UC_ARM_REG_S23,
+                         "S24": unicorn.arm_const.UC_ARM_REG_S24, "S25": unicorn.arm_const.UC_ARM_REG_S25,
+                         "S26": unicorn.arm_const.UC_ARM_REG_S26, "S27": unicorn.arm_const.UC_ARM_REG_S27,
+                         "S28": unicorn.arm_const.UC_ARM_REG_S28, "S29": unicorn.arm_const.UC_ARM_REG_S29,
+                         "S30": unicorn.arm_const.UC_ARM_REG_S30, "S31": unicorn.arm_const.UC_ARM_REG_S31}
+            self.regs.update({"arg1": unicorn.arm_const.UC_ARM_REG_R0, "arg2": unicorn.arm_const.UC_ARM_REG_R1,
+                              "arg3": unicorn.arm_const.UC_ARM_REG_R2, "arg4": unicorn.arm_const.UC_ARM_REG_R3})
+
+    # precompiles (register id, shift, mask) accessors for every register name in self.regs plus the x86 and ARM64
+    # subregisters, as well as the register layout used by getEmuState
+    def _buildRegAccessors(self):
+        self.regAccessors = {}
+        for name in self.regs:
+            self.regAccessors[name] = (self.regs[name], 0, None)
+        if self.arch == unicorn.UC_ARCH_X86:
+            if self.mode == unicorn.UC_MODE_64:
+                prefix = "r"
+                for i in range(8, 16):
+                    regId = self.regs["r%d" % i]
+                    self.regAccessors["r%dd" % i] = (regId, 0, 0xFFFFFFFF)
+                    self.regAccessors["r%dw" % i] = (regId, 0, 0xFFFF)
+                    self.regAccessors["r%db" % i] = (regId, 0, 0xFF)
+                for r in ["ax", "bx", "cx", "dx", "di", "si", "bp", "sp"]:
+                    self.regAccessors["e" + r] = (self.regs[r], 0, 0xFFFFFFFF)
+                self.stateLayout = [["RAX", "RBX"], ["RCX", "RDX"], ["RDI", "RSI"], ["R8", "R9"], ["RBP", "RSP"],
+                                    ["RIP"]]
+            else:
+                prefix = "e"
+                self.stateLayout = [["EAX", "EBX"], ["ECX", "EDX"], ["EDI", "ESI"], ["EBP", "ESP"], ["EIP"]]
+            for r in ["a", "b", "c", "d"]:
+                regId = self.regs[prefix + r + "x"]
+                self.regAccessors[r + "l"] = (regId, 0, 0xFF)
+                self.regAccessors[r + "h"] = (regId, 8, 0xFF)
+            regConsts = unicorn.x86_const
+            regPrefix = "UC_X86_REG_"
+        elif self.arch == unicorn.UC_ARCH_ARM64:
+            for i in range(31):
+                self.regAccessors["W%d" % i] = (self.regs["X%d" % i], 0, 0xFFFFFFFF)
+            self.stateLayout = [["X%d" % i, "X%d" % (i + 1)] for i in range(0, 30, 2)] + [["X30"], ["PC"], ["SP"]]
+            regConsts = unicorn.arm64_const
+            regPrefix = "UC_ARM64_REG_"
+        else:
+            self.stateLayout = [["R%d" % i, "R%d" % (i + 1)] for i in range(0, 16, 2)] + [["PC"], ["SP"]]
+            regConsts = unicorn.arm_const
+            regPrefix = "UC_ARM_REG_"
+        self.stateRegs = {}
+        for line in self.stateLayout:
+            for name in line:
+                self.stateRegs[name] = getattr(regConsts, regPrefix + name)
+
+    # deduplicated list of the unicorn register ids in self.regs. register name aliases such as arg1/ret/pc as well
+    # as ARM64 S/D/H views of the Q registers are dropped
+    def _getCanonicalRegs(self):
+        regs = set()
+        for name in self.regs:
+            if self.arch == unicorn.UC_ARCH_ARM64 and name[0] in ["S", "D", "H"] and name[1:].isdigit():
+                continue
+            regs.add(self.regs[name])
+        return sorted(regs)
+
+    # captures the cpu context with all canonical registers zeroed, restored before each emulation run
+    def _saveCleanContext(self):
+        for reg in self.canonicalRegs:
+            self.uc.reg_write(reg, 0)
+        self.cleanContext = self.uc.context_save()
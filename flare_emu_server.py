@@ -0,0 +1,153 @@
+############################################
+# Copyright (C) 2018 FireEye, Inc.
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-BSD-3-CLAUSE or
+# https://opensource.org/licenses/BSD-3-Clause>, at your option. This file may not be
+# copied, modified, or distributed except according to those terms.
+#
+# IDApython script that keeps an IDB and a loaded EmuHelper resident and serves emulation requests over a local
+# socket, so that repeated emulations of the same binary do not pay for starting IDA, loading the IDB and mapping the
+# binary each time. Run it headless against an analyzed IDB:
+#
+#   idat -A -S"flare_emu_server.py /tmp/flare_emu.sock" sample.idb
+#   idat -A -S"flare_emu_server.py 7878" sample.idb
+#
+# The argument is either a Unix socket path or a TCP port bound on 127.0.0.1. Requests and responses are single lines
+# of JSON. A request looks like:
+#
+#   {"start": 4198400, "end": 4198464, "registers": {"arg1": 16, "arg2": {"hex": "41424300"}},
+#    "stack": [0, 1, {"hex": "ff"}], "skipCalls": true, "count": 0, "fastMode": false,
+#    "read": [{"name": "out", "ptr": "arg1", "type": "string"}, {"name": "buf", "addr": 4210688, "size": 16}],
+#    "regs": ["eax", "ecx"]}
+#
+# Register and stack values are integers or {"hex": ...} byte buffers, which are written to emulator memory and
+# replaced with their addresses. Each "read" entry reads either a string, a wide string or "size" bytes from an address
+# given directly with "addr" or taken from a register named by "ptr". "ptr" uses the value the request passed in for
+# that register, so buffers handed to the emulated code can be read back after it clobbers the register, and falls
+# back to the register's value after the run if the request did not set it. The response contains the return value,
+# the requested registers and the requested buffers, hex encoded:
+#
+#   {"ok": true, "ret": 3, "regs": {"eax": 3, "ecx": 0}, "read": {"out": "414243", "buf": "00..."}}
+#
+# Send {"op": "shutdown"} to stop the server and exit IDA.
+#
+# Dependencies:
+# https://github.com/fireeye/flare-emu
+############################################
+
+from __future__ import print_function
+import flare_emu
+import binascii
+import json
+import logging
+import os
+import socket
+import idc
+
+
+class EmuServer(object):
+    def __init__(self, eh):
+        self.eh = eh
+        self.eh.trackBinaryWrites()
+        self.running = True
+
+    # converts a request value to something flare-emu accepts, loading {"hex": ...} buffers into emulator memory
+    def _loadValue(self, value):
+        if isinstance(value, dict):
+            return self.eh.loadBytes(binascii.unhexlify(value["hex"]))
+        return value
+
+    # reads a "read" entry, resolving "ptr" from the request's input registers before the registers after the run
+    def _read(self, spec, registers, regs):
+        if "ptr" in spec:
+            addr = registers.get(spec["ptr"], regs.get(spec["ptr"]))
+        else:
+            addr = spec["addr"]
+        readType = spec.get("type", "bytes")
+        if readType == "string":
+            data = self.eh.getEmuString(addr)
+        elif readType == "wstring":
+            data = self.eh.getEmuWideString(addr)
+        else:
+            data = self.eh.getEmuBytes(addr, spec["size"])
+        return binascii.hexlify(data).decode("ascii")
+
+    def handle(self, request):
+        if request.get("op") == "shutdown":
+            self.running = False
+            return {"ok": True}
+
+        # undo whatever the previous request did to emulator memory instead of reloading the binary
+        self.eh.restoreBinary()
+        registers = {}
+        for reg, value in request.get("registers", {}).items():
+            registers[reg] = self._loadValue(value)
+        stack = [self._loadValue(value) for value in request.get("stack", [])]
+        self.eh.emulateRange(request["start"], endAddr=request.get("end"), registers=registers, stack=stack,
+                             skipCalls=request.get("skipCalls", True), count=request.get("count", 0),
+                             fastMode=request.get("fastMode", False))
+
+        regNames = list(request.get("regs", []))
+        ptrRegs = [spec["ptr"] for spec in request.get("read", []) if "ptr" in spec and spec["ptr"] not in registers]
+        regs = self.eh.readRegs(["ret"] + regNames + ptrRegs)
+        response = {"ok": True, "ret": regs["ret"], "regs": {}, "read": {}}
+        for reg in regNames:
+            response["regs"][reg] = regs[reg]
+        for spec in request.get("read", []):
+            try:
+                response["read"][spec["name"]] = self._read(spec, registers, regs)
+            except Exception as e:
+                response["read"][spec["name"]] = None
+                logging.debug("failed to read %s: %s" % (spec["name"], str(e)))
+        return response
+
+    def serveClient(self, conn):
+        f = conn.makefile("rb")
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    response = self.handle(json.loads(line.decode("utf-8")))
+                except Exception as e:
+                    response = {"ok": False, "error": "%s: %s" % (type(e).__name__, str(e))}
+                conn.sendall((json.dumps(response) + "\n").encode("utf-8"))
+                if not self.running:
+                    break
+        finally:
+            f.close()
+
+    def serve(self, address):
+        if isinstance(address, int):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("127.0.0.1", address))
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(address)
+        sock.listen(1)
+        print("flare-emu server listening on %s" % str(address))
+        try:
+            while self.running:
+                conn, _ = sock.accept()
+                try:
+                    self.serveClient(conn)
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            if not isinstance(address, int) and os.path.exists(address):
+                os.unlink(address)
+
+
+if __name__ == '__main__':
+    idc.auto_wait()
+    address = idc.ARGV[1] if len(idc.ARGV) > 1 else "7878"
+    if address.isdigit():
+        address = int(address)
+    EmuServer(flare_emu.EmuHelper()).serve(address)
+    idc.qexit(0)
@@ -9,7 +9,8 @@
 # Author: James T. Bennett
 #
 # IDApython script that names global variables after their import names when dynamically resolved using GetProcAddress
-# Point it to a target function (or somewhere within the function) to begin emulation from
+# Point it to a target function (or somewhere within the function) to begin emulation from, or let it find and emulate
+# every call to GetProcAddress, LdrGetProcedureAddress and dlsym in the binary
 #
 # Dependencies:
 # https://github.com/fireeye/flare-emu
@@ -22,15 +23,140 @@ import idautils
 import logging
 
 
-def makeName(addr, name):
-    names = list(map(lambda x: x[1], list(idautils.Names())))
-    i = 0
-    myname = name
-    while myname in names:
-        myname = name + "_%d" % i
-        i += 1
+# set of the names in the IDB, built once and updated as names are assigned, with the next suffix to try for each
+# base name so that generating a unique name does not rescan or reprobe every name in the IDB
+class NameIndex(object):
+    def __init__(self):
+        self.names = set(name for _, name in idautils.Names())
+        self.suffixes = {}
 
-    idc.set_name(addr, myname, idc.SN_CHECK)
+    def makeName(self, addr, name):
+        i = self.suffixes.get(name, 0)
+        myname = name
+        while myname in self.names:
+            myname = name + "_%d" % i
+            i += 1
+        self.suffixes[name] = i
+
+        if idc.set_name(addr, myname, idc.SN_CHECK):
+            self.names.add(myname)
+
+
+RESOLVERS = ["GetProcAddress", "LdrGetProcedureAddress", "dlsym"]
+DUMMY_PREFIXES = ["dword_", "qword_", "off_", "unk_"]
+# number of instructions after a resolver call searched for the store of its return value
+STORE_SEARCH_DEPTH = 8
+# lowercase mnemonics of the x86, ARM and ARM64 instructions that store a register, with the operand index of the
+# register stored
+STORE_MNEMS = {"mov": 1, "str": 0, "stur": 0}
+
+
+def getImportAddr(name):
+    for impName in [name, "__imp_" + name, "_" + name, "." + name]:
+        ea = idc.get_name_ea_simple(impName)
+        if ea != idc.BADADDR:
+            return ea
+    return None
+
+
+# returns the addresses of the calls to a resolver, including calls through a register loaded with its import pointer
+def getCallSites(eh, impAddr):
+    sites = []
+    for x in idautils.XrefsTo(impAddr):
+        if idc.print_insn_mnem(x.frm) in eh.callMnems:
+            sites.append(x.frm)
+        elif idc.print_insn_mnem(x.frm).lower() in ["mov", "ldr"] and idc.get_operand_type(x.frm, 0) == idc.o_reg:
+            reg = idc.print_operand(x.frm, 0)
+            funcEnd = idc.get_func_attr(x.frm, idc.FUNCATTR_END)
+            if funcEnd == idc.BADADDR:
+                continue
+            ea = idc.next_head(x.frm, funcEnd)
+            while ea != idc.BADADDR and ea < funcEnd:
+                if idc.print_operand(ea, 0) == reg:
+                    if idc.print_insn_mnem(ea) in eh.callMnems:
+                        sites.append(ea)
+                    else:
+                        # register was overwritten
+                        break
+                ea = idc.next_head(ea, funcEnd)
+    return sites
+
+
+# returns the global variable the return value of the call at address is stored in, if it has not been named yet
+def getResultStore(eh, address):
+    retNames = [name.lower() for name in eh.regs if eh.regs[name] == eh.regs["ret"]]
+    ea = address
+    for i in range(STORE_SEARCH_DEPTH):
+        ea = idc.next_head(ea, idc.get_inf_attr(idc.INF_MAX_EA))
+        if ea == idc.BADADDR or idc.print_insn_mnem(ea) in eh.callMnems:
+            break
+        mnem = idc.print_insn_mnem(ea).lower()
+        if mnem not in STORE_MNEMS or idc.print_operand(ea, STORE_MNEMS[mnem]).lower() not in retNames:
+            continue
+        if mnem == "mov":
+            if idc.get_operand_type(ea, 0) != idc.o_mem:
+                continue
+            dst = idc.get_operand_value(ea, 0)
+        else:
+            # ARM stores through a register, IDA resolves the global it points to as a data reference
+            drefs = list(idautils.DataRefsFrom(ea))
+            if not drefs:
+                return None
+            dst = drefs[0]
+        if any(idc.get_name(dst).startswith(prefix) for prefix in DUMMY_PREFIXES):
+            return dst
+        return None
+    return None
+
+
+# iterate callback for batch mode, records the name being resolved at each call site and where the result goes
+def resolverHit(eh, address, argv, userData):
+    funcName = userData["sites"][address]
+    if funcName == "LdrGetProcedureAddress":
+        # FunctionName is an ANSI_STRING and the result is written through the FunctionAddress argument
+        if argv[1] == 0:
+            return
+        namePtr = eh.getEmuPtr(argv[1] + eh.size_pointer)
+        dst = argv[3]
+        if not any(idc.get_name(dst).startswith(prefix) for prefix in DUMMY_PREFIXES):
+            dst = None
+    else:
+        namePtr = argv[1]
+        dst = getResultStore(eh, address)
+    if dst is None:
+        userData["unresolved"] += 1
+        return
+    # ordinals are not names
+    if namePtr < 0x10000:
+        return
+    try:
+        imp = eh.getEmuString(namePtr)
+    except Exception:
+        return
+    if len(imp) > 2:
+        userData["renames"][dst] = imp
+
+
+def renameAll():
+    eh = flare_emu.EmuHelper()
+    sites = {}
+    for funcName in RESOLVERS:
+        impAddr = getImportAddr(funcName)
+        if impAddr is None:
+            continue
+        for site in getCallSites(eh, impAddr):
+            sites[site] = funcName
+    print "Emulating %d resolver call sites" % len(sites)
+    userData = {"sites": sites, "renames": {}, "unresolved": 0}
+    eh.iterate(list(sites.keys()), resolverHit, hookData=userData)
+
+    # apply all renames at once after emulation
+    nameIndex = NameIndex()
+    for dst in sorted(userData["renames"]):
+        nameIndex.makeName(dst, userData["renames"][dst])
+    print "Renamed %d globals" % len(userData["renames"])
+    if userData["unresolved"]:
+        print "Could not find an unnamed global storing the result of %d calls" % userData["unresolved"]
 
 
 def instructionHook(uc, address, size, userData):
@@ -40,7 +166,7 @@ def instructionHook(uc, address, size, userData):
                 idc.get_operand_type(address, 0) == 2 and
                 idc.get_name(idc.get_operand_value(address, 0))[:6] == "dword_"):
             if "imp" in userData:
-                makeName(idc.get_operand_value(address, 0), userData["imp"])
+                userData["nameIndex"].makeName(idc.get_operand_value(address, 0), userData["imp"])
                 del(userData["imp"])
 
     except Exception as err:
@@ -65,15 +191,21 @@ def callHook(address, argv, funcName, userData):
 
 
 if __name__ == '__main__':
-    eh = flare_emu.EmuHelper()
-    sVa = idc.ida_kernwin.ask_str("0", 0, "Enter the start address (hex)")
-    sVa = int(sVa, 16)
-    eVa = idc.ida_kernwin.ask_str("0", 0, "Enter the end address (hex), specify 0 to emulate to end of function")
-    eVa = int(eVa, 16)
-    if (sVa >= idc.get_inf_attr(idc.INF_MIN_EA) and sVa <= idc.get_inf_attr(idc.INF_MAX_EA) and
-            (eVa == 0 or (eVa >= idc.get_inf_attr(idc.INF_MIN_EA) and eVa <= idc.get_inf_attr(idc.INF_MAX_EA)))):
-        if eVa == 0:
-            eVa = None
-        mu = eh.emulateRange(sVa, eVa, instructionHook=instructionHook, callHook=callHook)
-    else:
-        print "Error: supplied addresses not within IDB address range"
+    batch = idc.ida_kernwin.ask_yn(1, "Resolve every GetProcAddress, LdrGetProcedureAddress and dlsym call in the "
+                                      "binary?\nChoose No to emulate a single range")
+    if batch == 1:
+        renameAll()
+    elif batch == 0:
+        eh = flare_emu.EmuHelper()
+        sVa = idc.ida_kernwin.ask_str("0", 0, "Enter the start address (hex)")
+        sVa = int(sVa, 16)
+        eVa = idc.ida_kernwin.ask_str("0", 0, "Enter the end address (hex), specify 0 to emulate to end of function")
+        eVa = int(eVa, 16)
+        if (sVa >= idc.get_inf_attr(idc.INF_MIN_EA) and sVa <= idc.get_inf_attr(idc.INF_MAX_EA) and
+                (eVa == 0 or (eVa >= idc.get_inf_attr(idc.INF_MIN_EA) and eVa <= idc.get_inf_attr(idc.INF_MAX_EA)))):
+            if eVa == 0:
+                eVa = None
+            mu = eh.emulateRange(sVa, eVa, instructionHook=instructionHook, callHook=callHook,
+                                 hookData={"nameIndex": NameIndex()})
+        else:
+            print "Error: supplied addresses not within IDB address range"
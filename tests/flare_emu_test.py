@@ -30,6 +30,13 @@ def decode(argv):
     mu = myEH.emulateRange(idc.get_name_ea_simple("_xorCrypt"), registers = {"arg1":argv[0], "arg2":argv[1], 
                            "arg3":argv[2], "arg4":argv[3]})
     return myEH.getEmuString(argv[0])
+
+def decodeFast(argv):
+    myEH = flare_emu.EmuHelper()
+    print("testing emulateRange fastMode for _xorCrypt function")
+    mu = myEH.emulateRange(idc.get_name_ea_simple("_xorCrypt"), registers = {"arg1":argv[0], "arg2":argv[1], 
+                           "arg3":argv[2], "arg4":argv[3]}, fastMode=True)
+    return myEH.getEmuString(argv[0])
     
 def ch(address, argv, funcName, userData):
     eh = userData["EmuHelper"]
@@ -40,6 +47,12 @@ def ch(address, argv, funcName, userData):
             print("FAILED: incorrect decoded string @ %016X" % address)
         else:
             print("emulateRange xorCrypt passed")
+        if decodeFast(argv) != dec:
+            print("FAILED: fastMode decoded string differs @ %016X" % address)
+        else:
+            print("emulateRange fastMode xorCrypt passed")
+        test_result_cache(eh, argv, dec)
+        test_watch(argv)
     
 def iterateHook(eh, address, argv, userData):
     fmtStr = eh.getEmuString(argv[0])
@@ -49,6 +62,116 @@ def iterateHook(eh, address, argv, userData):
         print("printf test passed")
 
 
+def test_result_cache(eh, argv, dec):
+    """ Run _xorCrypt twice with the same inputs, the second run must be a result cache hit with the same output. """
+    print("testing emulateRange result cache for _xorCrypt function")
+    myEH = flare_emu.EmuHelper()
+    myEH.enableResultCache()
+    buf = eh.getEmuBytes(argv[0], argv[1])
+    outputs = []
+    for i in range(2):
+        registers = {"arg1":buf, "arg2":argv[1], "arg3":argv[2], "arg4":argv[3]}
+        myEH.emulateRange(idc.get_name_ea_simple("_xorCrypt"), registers=registers,
+                          cacheOutputs=[("arg1", argv[1])])
+        # the string argument is replaced with the address of the buffer it was written to
+        outputs.append(myEH.getEmuBytes(registers["arg1"], argv[1]))
+    if myEH.resultCache.misses != 1 or myEH.resultCache.hits != 1:
+        print("FAILED: expected one result cache miss and one hit, got %d and %d" % (myEH.resultCache.misses,
+                                                                                     myEH.resultCache.hits))
+    elif outputs[0] != outputs[1] or outputs[0][:len(dec)] != dec:
+        print("FAILED: result cache hit output differs from emulated output")
+    else:
+        print("result cache test passed")
+
+
+def test_watch(argv):
+    """ A watchpoint with stopAfter must stop each emulation run after its first write to the buffer. """
+    print("testing watch stopAfter for _xorCrypt function")
+    myEH = flare_emu.EmuHelper()
+    handle = myEH.watch(argv[0], argv[1], stopAfter=1)
+    for i in range(2):
+        myEH.emulateRange(idc.get_name_ea_simple("_xorCrypt"), registers = {"arg1":argv[0], "arg2":argv[1],
+                          "arg3":argv[2], "arg4":argv[3]})
+        if myEH.stopReason != "watchpoint" or len(myEH.getWatchLog(handle)) != i + 1:
+            print("FAILED: watch stopAfter count was not reset for run %d" % (i + 1))
+            return
+    print("watch stopAfter test passed")
+
+
+def test_address_space():
+    """ Reserve, release and reuse ranges of an EmuAddressSpace and of the emulator's own address space. """
+    print("\ntesting address space allocation and free")
+    space = flare_emu.EmuAddressSpace(0x100000)
+    space.reserve(0x20000, 0x30000, "binary")
+    # the smallest gap that fits, above minAddr and after a guard page
+    addr = space.findFree(0x2000)
+    if addr != 0x11000:
+        print("FAILED: findFree returned %X instead of the gap below the binary" % addr)
+        return
+    space.reserve(addr, addr + 0x2000, "alloc")
+    if space.getUsed(addr + 0x1000) != (addr, addr + 0x2000, "alloc") or space.isFree(addr, addr + 0x1000):
+        print("FAILED: reserved range is not in use")
+        return
+    space.release(addr)
+    if space.getGap(addr) != (0, 0x20000) or space.findFree(0x2000) != addr:
+        print("FAILED: released range was not merged back into its gap")
+        return
+    myEH = flare_emu.EmuHelper()
+    addr = myEH.allocEmuMem(0x2000)
+    if not myEH.freeEmuMem(addr) or myEH.getEmuMemExtent(addr) != 0:
+        print("FAILED: freeEmuMem did not unmap the allocation")
+    elif myEH.allocEmuMem(0x2000) != addr:
+        print("FAILED: freed allocation was not reused")
+    else:
+        print("address space test passed")
+
+
+def test_write_regs():
+    """ 8 and 16-bit subregisters are merged into their parent register, 32-bit ones are zero extended. """
+    print("\ntesting writeRegs subregister merging")
+    myEH = flare_emu.EmuHelper()
+    myEH.writeRegs({"eax":0x11223344})
+    myEH.writeRegs({"al":0x55, "ah":0x66})
+    if myEH.getRegVal("eax") != 0x11226655:
+        print("FAILED: al and ah were not merged into eax, got %X" % myEH.getRegVal("eax"))
+        return
+    if myEH.size_pointer == 8:
+        myEH.writeRegs({"r8":0x1122334455667788})
+        myEH.writeRegs({"r8w":0x99AA})
+        if myEH.getRegVal("r8") != 0x11223344556699AA:
+            print("FAILED: r8w was not merged into r8, got %X" % myEH.getRegVal("r8"))
+            return
+        myEH.writeRegs({"r8d":0x1})
+        if myEH.getRegVal("r8") != 0x1:
+            print("FAILED: r8d was not zero extended into r8, got %X" % myEH.getRegVal("r8"))
+            return
+    print("writeRegs test passed")
+
+
+def recordStateHook(eh, address, argv, userData):
+    userData["states"][address] = (dict(eh.getEmuState()), eh.getEmuString(argv[0]))
+
+
+def test_share_prefixes():
+    """ iterate must reach the same targets with the same registers whether or not paths share prefixes. """
+    print("\ntesting iterate sharePrefixes for printf function")
+    states = []
+    for sharePrefixes in [False, True]:
+        myEH = flare_emu.EmuHelper()
+        userData = {"states": {}}
+        myEH.iterate(idc.get_name_ea_simple("_printf"), recordStateHook, hookData=userData,
+                     sharePrefixes=sharePrefixes)
+        states.append(userData["states"])
+    if sorted(states[0]) != sorted(states[1]):
+        print("FAILED: sharePrefixes reached different targets")
+        return
+    for address in states[0]:
+        if states[0][address] != states[1][address]:
+            print("FAILED: sharePrefixes register state differs @ %016X" % address)
+            return
+    print("sharePrefixes test passed")
+
+
 def test_memory_access_hook():
     """ Compare memory access identified in IDA and hooked instructions. """
     print("\ntesting memory access hook")
@@ -102,7 +225,10 @@ if __name__ == '__main__':
     eh = flare_emu.EmuHelper()
     print("testing iterate feature for printf function")
     eh.iterate(idc.get_name_ea_simple("_printf"), iterateHook, callHook = ch)
+    test_share_prefixes()
+    test_address_space()
 
     # currently only test on x86/AMD64
     if eh.arch == UC_ARCH_X86:
         test_memory_access_hook()
+        test_write_regs()